@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+The benchmark of the compression filters of diopy.output.write_h5
+
+It reports the file size and the write/read throughput of a synthetic AnnData for no compression, gzip and lzf,
+and for blosc and zstd when hdf5plugin is installed.
+
+Usage:
+------
+$ python benchmarks/bench_compression.py --cells 100000 --genes 2000 --density 0.05
+------
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import anndata
+from scipy import sparse
+import diopy
+
+
+def make_adata(n_cells, n_genes, density, seed=0):
+    rng = np.random.default_rng(seed)
+    X = sparse.random(n_cells, n_genes, density=density, format='csr', random_state=seed, dtype=np.float32)
+    # the count-like values compress as the real data
+    X.data = rng.poisson(3, size=X.nnz).astype(np.float32) + 1
+    obs = pd.DataFrame({'cluster': pd.Categorical(rng.integers(0, 20, n_cells).astype(str)),
+                        'n_counts': np.asarray(X.sum(axis=1)).ravel()},
+                       index=['cell_%d' % i for i in range(n_cells)])
+    var = pd.DataFrame(index=['gene_%d' % i for i in range(n_genes)])
+    adata = anndata.AnnData(X=X, obs=obs, var=var)
+    adata.obsm['X_pca'] = rng.normal(size=(n_cells, 50)).astype(np.float32)
+    return adata
+
+
+def filters():
+    yield 'none', dict()
+    yield 'gzip-4', dict(compression='gzip', compression_opts=4, shuffle=True)
+    yield 'lzf', dict(compression='lzf', shuffle=True)
+    try:
+        import hdf5plugin
+    except ImportError:
+        return
+    yield 'blosc-lz4', dict(compression=hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    yield 'zstd', dict(compression=hdf5plugin.Zstd())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='The benchmark of the compression filters of write_h5')
+    parser.add_argument('--cells', type=int, default=50000)
+    parser.add_argument('--genes', type=int, default=2000)
+    parser.add_argument('--density', type=float, default=0.05)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    adata = make_adata(args.cells, args.genes, args.density)
+    raw_mb = (adata.X.data.nbytes + adata.X.indices.nbytes + adata.X.indptr.nbytes) / 2**20
+    print('%d cells x %d genes, %.1f MB of sparse X' % (args.cells, args.genes, raw_mb))
+    print('%-10s %12s %12s %12s' % ('filter', 'size(MB)', 'write(MB/s)', 'read(MB/s)'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, opts in filters():
+            file = os.path.join(tmp, name + '.h5')
+            w, r = [], []
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                diopy.output.write_h5(adata, file, **opts)
+                w.append(time.perf_counter() - t0)
+                t0 = time.perf_counter()
+                diopy.input.read_h5(file)
+                r.append(time.perf_counter() - t0)
+            print('%-10s %12.1f %12.1f %12.1f' % (name, os.path.getsize(file) / 2**20, raw_mb / min(w), raw_mb / min(r)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+The benchmark of diopy.input.h5_to_df against the decoder of diopy 0.4.0
+
+It writes a synthetic obs table with the barcodes, the categorical, string, bool and number columns, 
+then reports the decoding time of both implementations.
+
+Usage:
+------
+$ python benchmarks/bench_h5_to_df.py --rows 2000000 --columns 100
+------
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import h5py
+import diopy
+
+
+def h5_to_df_legacy(h5df):
+    # the decoder of diopy 0.4.0, kept for the comparison
+    to_dict = {}
+    to_dict['index'] = h5df['index'][()].astype(str).astype(object)
+    for i in h5df.keys():
+        if(len(h5df[i].attrs.keys())>0):
+            if np.array(h5df[i].attrs['origin_dtype']).astype(str).astype(object) == 'category':
+                e0 = h5df[i][()].astype(int)
+                if np.min(e0) == -2147483648:
+                    e0[e0==-2147483648] = -1
+                lvl = h5df['category'][i][()].astype(str).astype(object)
+                lvl = pd.CategoricalDtype(lvl)
+                to_dict[i] = pd.Categorical.from_codes(codes=e0, dtype=lvl)
+            if np.array(h5df[i].attrs['origin_dtype']).astype(str).astype(object) == 'string':
+                e0 = h5df[i][()].astype(int)
+                if np.min(e0) == -2147483648:
+                    e0[e0==-2147483648] = -1
+                lvl = h5df['category'][i][()].astype(str).astype(object)
+                lvl = pd.CategoricalDtype(lvl)
+                to_dict[i] = pd.Categorical.from_codes(codes=e0, dtype=lvl)
+            if np.array(h5df[i].attrs['origin_dtype']).astype(str).astype(object) == 'bool':
+                e0 = h5df[i][()].astype(int)
+                to_dict[i] = e0.astype(bool)
+            if np.array(h5df[i].attrs['origin_dtype']).astype(str).astype(object) == 'number':
+                e0 = h5df[i][()]
+                to_dict[i] = e0
+    df = pd.DataFrame(to_dict)
+    df.set_index('index', inplace=True)
+    if 'colnames' in h5df.keys():
+        cnames = h5df['colnames'][()].astype(str).astype(object)
+        df = df[cnames]
+    return df
+
+
+def make_df(n_rows, n_columns, cardinality, seed=0):
+    rng = np.random.default_rng(seed)
+    cols = {}
+    for j in range(n_columns):
+        kind = j % 4
+        if kind == 0:
+            cols['cate_%d' % j] = pd.Categorical(rng.integers(0, cardinality, n_rows).astype(str))
+        elif kind == 1:
+            cols['str_%d' % j] = rng.integers(0, cardinality, n_rows).astype(str).astype(object)
+        elif kind == 2:
+            cols['bool_%d' % j] = rng.random(n_rows) > 0.5
+        else:
+            cols['num_%d' % j] = rng.normal(size=n_rows)
+    index = pd.Index(np.char.add('AAACCTGAGCGTAGTG-', np.arange(n_rows).astype(str)))
+    return pd.DataFrame(cols, index=index)
+
+
+def timeit(fun, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='The benchmark of h5_to_df')
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--columns', type=int, default=40)
+    parser.add_argument('--cardinality', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    df = make_df(args.rows, args.columns, args.cardinality)
+    with tempfile.TemporaryDirectory() as tmp:
+        file = os.path.join(tmp, 'df.h5')
+        with h5py.File(file, 'w') as h5:
+            diopy.output.df_to_h5(df=df, h5=h5, gr_name='obs')
+        with h5py.File(file, 'r') as h5:
+            t_old = timeit(lambda: h5_to_df_legacy(h5['obs']), args.repeat)
+            t_new = timeit(lambda: diopy.input.h5_to_df(h5['obs']), args.repeat)
+        print('%d rows x %d columns' % (args.rows, args.columns))
+        print('%-10s %10s' % ('decoder', 'time(s)'))
+        print('%-10s %10.3f' % ('legacy', t_old))
+        print('%-10s %10.3f' % ('h5_to_df', t_new))
+        print('speedup %.2fx' % (t_old / t_new))
+
+
+if __name__ == '__main__':
+    main()
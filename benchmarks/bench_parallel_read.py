@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+The benchmark of diopy.input.read_h5(n_jobs=...)
+
+It writes a synthetic AnnData with the compressed X, raw.X and layers, then reports the read time and the speedup
+for the increasing number of workers.
+
+Usage:
+------
+$ python benchmarks/bench_parallel_read.py --cells 200000 --genes 2000 --jobs 1 2 4 8
+------
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import diopy
+from bench_compression import make_adata
+
+
+def main():
+    parser = argparse.ArgumentParser(description='The benchmark of read_h5(n_jobs=...)')
+    parser.add_argument('--cells', type=int, default=50000)
+    parser.add_argument('--genes', type=int, default=2000)
+    parser.add_argument('--density', type=float, default=0.05)
+    parser.add_argument('--layers', type=int, default=2)
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    adata = make_adata(args.cells, args.genes, args.density)
+    adata.raw = adata
+    for i in range(args.layers):
+        adata.layers['layer_%d' % i] = adata.X.copy()
+    with tempfile.TemporaryDirectory() as tmp:
+        file = os.path.join(tmp, 'parallel.h5')
+        diopy.output.write_h5(adata, file, compression='gzip', compression_opts=4, shuffle=True)
+        print('%d cells x %d genes, %d layers, %.1f MB on disk' % (args.cells, args.genes, args.layers, os.path.getsize(file) / 2**20))
+        print('%-8s %10s %10s' % ('n_jobs', 'time(s)', 'speedup'))
+        base = None
+        for n_jobs in args.jobs:
+            times = []
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                diopy.input.read_h5(file, n_jobs=n_jobs)
+                times.append(time.perf_counter() - t0)
+            base = min(times) if base is None else base
+            print('%-8d %10.2f %10.2f' % (n_jobs, min(times), base / min(times)))
+
+
+if __name__ == '__main__':
+    main()
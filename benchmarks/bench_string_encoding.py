@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+The benchmark of the string encodings of diopy.output.df_to_h5
+
+It writes the barcodes and the categorical columns of a synthetic obs table with string_encoding='vlen' and 'fixed',
+then reports the writing time, the reading time by diopy.input.h5_to_df and the file size.
+
+Usage:
+------
+$ python benchmarks/bench_string_encoding.py --rows 2000000 --compression gzip
+------
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import h5py
+import diopy
+
+
+def make_obs(n_rows, n_columns, cardinality, seed=0):
+    rng = np.random.default_rng(seed)
+    cols = {}
+    for j in range(n_columns):
+        cols['cate_%d' % j] = pd.Categorical(np.char.add('cluster_', rng.integers(0, cardinality, n_rows).astype(str)))
+    barcodes = np.char.add(np.char.add('AAACCTGAGCGTAGTG-', np.arange(n_rows).astype(str)), '_sample')
+    return pd.DataFrame(cols, index=pd.Index(barcodes.astype(object)))
+
+
+def timeit(fun, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='The benchmark of the string encodings of df_to_h5')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--columns', type=int, default=4)
+    parser.add_argument('--cardinality', type=int, default=50)
+    parser.add_argument('--compression', default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    df = make_obs(args.rows, args.columns, args.cardinality)
+    print('%d rows x %d columns, compression=%s' % (args.rows, args.columns, args.compression))
+    print('%-8s %10s %10s %10s' % ('encoding', 'write(s)', 'read(s)', 'size(MB)'))
+    with tempfile.TemporaryDirectory() as tmp:
+        for encoding in ['vlen', 'fixed']:
+            file = os.path.join(tmp, '%s.h5' % encoding)
+
+            def write():
+                with h5py.File(file, 'w') as h5:
+                    diopy.output.df_to_h5(df=df.copy(), h5=h5, gr_name='obs', string_encoding=encoding,
+                                          compression=args.compression)
+
+            def read():
+                with h5py.File(file, 'r') as h5:
+                    diopy.input.h5_to_df(h5['obs'])
+
+            t_write = timeit(write, args.repeat)
+            t_read = timeit(read, args.repeat)
+            size = os.path.getsize(file) / 2**20
+            print('%-8s %10.3f %10.3f %10.1f' % (encoding, t_write, t_read, size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+The benchmark suite of the read and write paths of diopy
+
+Every case runs in a new process on the synthetic AnnData of benchmarks/synthetic.py, and reports the wall time, 
+the throughput (MB of the h5 file, or of obs for h5_to_df, per second), the peak of tracemalloc, the peak RSS of the process 
+and the file size. 
+The results are saved as json, and compared with the stored baseline to catch the regressions. It runs offline and needs 
+only diopy and its dependencies.
+
+Cases:
+------
+write_h5     : diopy.output.write_h5 of the whole adata
+read_h5      : diopy.input.read_h5 of the whole file
+h5_to_df     : diopy.input.h5_to_df of obs
+matrix_to_h5 : diopy.output.matrix_to_h5 of X
+------
+
+Usage:
+------
+$ python benchmarks/suite.py --preset quick
+$ python benchmarks/suite.py --preset quick --compare benchmarks/baselines/quick.json
+$ python benchmarks/suite.py --preset medium --cells 300000 --layers 2 --save medium.json
+------
+The baselines are machine dependent, save a new baseline on the machine running the comparison.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+PRESETS = {
+    'quick': dict(cells=10000, genes=2000, density=0.05, obs_columns=8, cardinality=20, layers=1, spatial=True, image_size=1000),
+    'medium': dict(cells=100000, genes=2000, density=0.05, obs_columns=16, cardinality=50, layers=1, spatial=False, image_size=2000),
+    'large': dict(cells=1000000, genes=2000, density=0.02, obs_columns=16, cardinality=100, layers=0, spatial=False, image_size=2000),
+}
+CASES = ['write_h5', 'read_h5', 'h5_to_df', 'matrix_to_h5']
+
+
+def make_input(params, file):
+    from synthetic import make_adata
+    import diopy
+    adata = make_adata(n_cells=params['cells'], n_genes=params['genes'], density=params['density'],
+                       n_obs_columns=params['obs_columns'], cardinality=params['cardinality'],
+                       n_layers=params['layers'], spatial=params['spatial'], image_size=params['image_size'])
+    diopy.output.write_h5(adata=adata, file=file, assay_name=assay_name(params))
+
+
+def assay_name(params):
+    return 'spatial' if params['spatial'] else 'RNA'
+
+
+def prepare(case, params, file, out):
+    """ The input of the case is loaded before the timing, returns the timed function and the file, or the file and the group, it reads or writes"""
+    import diopy
+    if case == 'write_h5':
+        adata = diopy.input.read_h5(file=file, assay_name=assay_name(params))
+        return lambda: diopy.output.write_h5(adata=adata, file=out, assay_name=assay_name(params)), out
+    if case == 'read_h5':
+        return lambda: diopy.input.read_h5(file=file, assay_name=assay_name(params)), file
+    if case == 'h5_to_df':
+        def run():
+            with h5py.File(file, 'r') as h5:
+                diopy.input.h5_to_df(h5['obs'])
+        return run, (file, 'obs')
+    if case == 'matrix_to_h5':
+        with h5py.File(file, 'r') as h5:
+            X = diopy.input.h5_to_matrix(h5['data']['X'])
+
+        def run():
+            with h5py.File(out, 'w') as h5:
+                diopy.output.matrix_to_h5(mat=X, h5=h5, gr_name='X')
+        return run, out
+    raise ValueError('unknown case %s' % case)
+
+
+def storage_size(sized):
+    if isinstance(sized, str):
+        return os.path.getsize(sized)
+    file, group = sized
+    sizes = []
+    with h5py.File(file, 'r') as h5:
+        h5[group].visititems(lambda name, obj: sizes.append(obj.id.get_storage_size()) if isinstance(obj, h5py.Dataset) else None)
+    return sum(sizes)
+
+
+def run_case(case, params, file, out, repeat, queue):
+    fun, sized = prepare(case, params, file, out)
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - t0)
+    # the allocation peak is measured in a separate run, tracemalloc slows the timed runs
+    tracemalloc.start()
+    fun()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    file_mb = storage_size(sized) / 2**20
+    # ru_maxrss is KB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+    t = min(times)
+    queue.put(dict(time_s=t, mb_s=file_mb / t, tracemalloc_peak_mb=peak / 2**20, peak_rss_mb=rss, file_mb=file_mb))
+
+
+def run_suite(params, cases, repeat):
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        file = os.path.join(tmp, 'input.h5')
+        p = ctx.Process(target=make_input, args=(params, file))
+        p.start()
+        p.join()
+        if p.exitcode != 0:
+            raise RuntimeError('Failed to generate the synthetic data')
+        for case in cases:
+            queue = ctx.Queue()
+            p = ctx.Process(target=run_case, args=(case, params, file, os.path.join(tmp, 'out.h5'), repeat, queue))
+            p.start()
+            res = queue.get()
+            p.join()
+            results[case] = res
+            print('%-14s %9.3f s %9.1f MB/s %9.1f MB traced %9.1f MB rss %9.1f MB file' % (
+                case, res['time_s'], res['mb_s'], res['tracemalloc_peak_mb'], res['peak_rss_mb'], res['file_mb']))
+            sys.stdout.flush()
+    return results
+
+
+def environment():
+    import diopy
+    import scipy
+    import pandas
+    import anndata
+    return dict(python=platform.python_version(), machine=platform.machine(), cpus=os.cpu_count(), diopy=diopy.__version__,
+                numpy=np.__version__, scipy=scipy.__version__, pandas=pandas.__version__, anndata=anndata.__version__,
+                h5py=h5py.__version__, hdf5=h5py.version.hdf5_version)
+
+
+def compare(results, baseline, tolerance):
+    """ The cases slower or using more memory than tolerance times the baseline are the regressions"""
+    regressions = []
+    for case, res in results.items():
+        if case not in baseline['results']:
+            continue
+        base = baseline['results'][case]
+        for metric in ['time_s', 'tracemalloc_peak_mb', 'file_mb']:
+            ratio = res[metric] / base[metric] if base[metric] > 0 else 1.0
+            flag = 'REGRESSION' if ratio > tolerance else ''
+            print('%-14s %-20s %10.3f %10.3f %7.2fx %s' % (case, metric, base[metric], res[metric], ratio, flag))
+            if flag:
+                regressions.append((case, metric, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='The benchmark suite of the read and write paths of diopy')
+    parser.add_argument('--preset', choices=sorted(PRESETS.keys()), default='quick')
+    parser.add_argument('--cells', type=int)
+    parser.add_argument('--genes', type=int)
+    parser.add_argument('--density', type=float)
+    parser.add_argument('--obs-columns', dest='obs_columns', type=int)
+    parser.add_argument('--cardinality', type=int)
+    parser.add_argument('--layers', type=int)
+    parser.add_argument('--spatial', dest='spatial', action='store_true', default=None)
+    parser.add_argument('--no-spatial', dest='spatial', action='store_false')
+    parser.add_argument('--image-size', dest='image_size', type=int)
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=CASES)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='The json file of the results')
+    parser.add_argument('--compare', help='The json file of the baseline')
+    parser.add_argument('--tolerance', type=float, default=1.3, help='The ratio to the baseline flagged as the regression. Default is 1.3')
+    args = parser.parse_args()
+    params = dict(PRESETS[args.preset])
+    for k in params.keys():
+        if getattr(args, k) is not None:
+            params[k] = getattr(args, k)
+    print('preset %s: %s' % (args.preset, ', '.join('%s=%s' % kv for kv in params.items())))
+    results = run_suite(params, args.cases, args.repeat)
+    report = dict(preset=args.preset, params=params, environment=environment(), results=results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['params'] != params:
+            print('The parameters differ from the baseline, the comparison is not meaningful')
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+The synthetic AnnData generator of the benchmarks
+
+The count matrix, the obs table with the categorical, string, bool and number columns, the layers, 
+the dimension reductions and the spatial images are generated from the seed, so every run writes the same data.
+
+Usage:
+------
+>>> from synthetic import make_adata
+>>> adata = make_adata(n_cells=10000, n_genes=2000, density=0.05, n_obs_columns=8, cardinality=20, n_layers=1, spatial=True)
+------
+"""
+
+import numpy as np
+import pandas as pd
+import anndata
+from scipy import sparse
+
+
+def make_counts(n_cells, n_genes, density, rng):
+    rows = np.repeat(np.arange(n_cells, dtype=np.int32), rng.binomial(n_genes, density, size=n_cells))
+    cols = rng.integers(0, n_genes, size=rows.shape[0], dtype=np.int32)
+    X = sparse.csr_matrix((np.ones(rows.shape[0], dtype=np.float32), (rows, cols)), shape=(n_cells, n_genes))
+    X.sum_duplicates()
+    # the count-like values compress as the real data
+    X.data = rng.poisson(3, size=X.nnz).astype(np.float32) + 1
+    return X
+
+
+def make_obs(n_cells, n_obs_columns, cardinality, rng):
+    cols = {}
+    for j in range(n_obs_columns):
+        kind = j % 4
+        if kind == 0:
+            cols['cate_%d' % j] = pd.Categorical(np.char.add('cluster_', rng.integers(0, cardinality, n_cells).astype(str)))
+        elif kind == 1:
+            cols['str_%d' % j] = np.char.add('sample_', rng.integers(0, cardinality, n_cells).astype(str)).astype(object)
+        elif kind == 2:
+            cols['bool_%d' % j] = rng.random(n_cells) > 0.5
+        else:
+            cols['num_%d' % j] = rng.normal(size=n_cells)
+    index = np.char.add('AAACCTGAGCGTAGTG-', np.arange(n_cells).astype(str)).astype(object)
+    return pd.DataFrame(cols, index=pd.Index(index))
+
+
+def make_adata(n_cells=10000,
+               n_genes=2000,
+               density=0.05,
+               n_obs_columns=8,
+               cardinality=20,
+               n_layers=0,
+               spatial=False,
+               image_size=2000,
+               seed=0):
+    rng = np.random.default_rng(seed)
+    X = make_counts(n_cells, n_genes, density, rng)
+    obs = make_obs(n_cells, n_obs_columns, cardinality, rng)
+    var = pd.DataFrame({'highly_variable': rng.random(n_genes) > 0.8},
+                       index=pd.Index(np.char.add('gene_', np.arange(n_genes).astype(str)).astype(object)))
+    adata = anndata.AnnData(X=X, obs=obs, var=var)
+    for k in range(n_layers):
+        layer = X.copy()
+        layer.data = np.log1p(layer.data)
+        adata.layers['layer_%d' % k] = layer
+    adata.obsm['X_pca'] = rng.normal(size=(n_cells, 50)).astype(np.float32)
+    adata.obsm['X_umap'] = rng.normal(size=(n_cells, 2)).astype(np.float32)
+    if spatial:
+        side = int(np.ceil(np.sqrt(n_cells)))
+        adata.obs['in_tissue'] = 1
+        adata.obs['array_row'] = np.arange(n_cells) // side
+        adata.obs['array_col'] = np.arange(n_cells) % side
+        adata.obsm['spatial'] = np.stack([adata.obs['array_row'].values, adata.obs['array_col'].values], axis=1) * 10.0
+        adata.uns['spatial'] = {'slice1': {
+            'images': {'hires': rng.random((image_size, image_size, 3)).astype(np.float32),
+                       'lowres': rng.random((image_size // 3, image_size // 3, 3)).astype(np.float32)},
+            'scalefactors': {'tissue_hires_scalef': 0.17, 'tissue_lowres_scalef': 0.05,
+                             'fiducial_diameter_fullres': 144.0, 'spot_diameter_fullres': 89.0}}}
+    return adata
@@ -1,3 +1,9 @@
-__all__ = ['input', 'output']
+__version__ = '0.4.0'
+__all__ = ['input', 'output', 'rworker', 'cache', 'profiling', 'summary', 'stats']
 from . import input
-from . import output
\ No newline at end of file
+from . import output
+from . import rworker
+from . import cache
+from . import profiling
+from . import summary
+from .summary import stats
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Introduction: The conversions between the rds file and the h5 file are cached in a directory. The entry is keyed by the content hash of 
+the input file and the conversion parameters, so the repeated conversion of an unchanged file is served from the cache without R. 
+The least recently used entries are removed when the cache is over its size budget.
+"""
+
+###  import the packages
+import os
+import shutil
+import hashlib
+import tempfile
+from typing import Union
+
+_BLOCK = 2**22
+
+
+def diopy_version() -> str:
+    from . import __version__
+    return __version__
+
+
+class ConversionCache:
+    """
+    The cache directory of the converted files
+
+    Parameters:
+    ----------
+    cache_dir : The cache directory, created if it does not exist
+    max_bytes : The size budget of the cache. Default is None, the environment variable DIOPY_CACHE_MAX_BYTES, else 20GB
+    ----------
+
+    Usage:
+    -----
+    >>> cache = ConversionCache('~/.cache/diopy')
+    >>> key = cache.key('scdata.rds', command='rds_to_h5', object_type='seurat', assay_name='RNA')
+    >>> file = cache.get(key, suffix='.h5')
+    -----
+    """
+    def __init__(self,
+                 cache_dir: str,
+                 max_bytes: Union[int, None] = None):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('DIOPY_CACHE_MAX_BYTES', 20 * 2**30))
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, file: str, **params) -> str:
+        """
+        The key is the blake2b hash of the file content, the conversion parameters and the diopy version
+
+        Parameters:
+        ----------
+        file : The input file
+        params : The conversion parameters, such as command, object_type and assay_name
+        return str
+        ----------
+        """
+        h = hashlib.blake2b(digest_size=20)
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(_BLOCK), b''):
+                h.update(block)
+        params['diopy_version'] = diopy_version()
+        for k in sorted(params.keys()):
+            h.update(('\0%s=%s' % (k, params[k])).encode('utf-8'))
+        return h.hexdigest()
+
+    def path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def get(self, key: str, suffix: str) -> Union[str, None]:
+        """
+        The cached file of the key, None if it is not in the cache. The hit marks the entry as recently used
+
+        Parameters:
+        ----------
+        key : The key, see ConversionCache.key
+        suffix : The suffix of the cached file, such as '.h5' or '.rds'
+        return str or None
+        ----------
+        """
+        file = self.path(key, suffix)
+        try:
+            os.utime(file)
+        except FileNotFoundError:
+            return None
+        return file
+
+    def put(self, key: str, suffix: str, file: str) -> str:
+        """
+        The file is copied into the cache, then the least recently used entries are removed over the size budget
+
+        Parameters:
+        ----------
+        key : The key, see ConversionCache.key
+        suffix : The suffix of the cached file, such as '.h5' or '.rds'
+        file : The converted file
+        return str, the cached file
+        ----------
+        """
+        target = self.path(key, suffix)
+        # the copy is renamed into place, so the other processes never see the partial entry
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.part', dir=self.cache_dir)
+        os.close(fd)
+        try:
+            shutil.copyfile(file, tmp)
+            os.replace(tmp, target)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.evict(keep=target)
+        return target
+
+    def evict(self, keep: Union[str, None] = None) -> None:
+        """
+        The least recently used entries are removed until the cache is within max_bytes
+
+        Parameters:
+        ----------
+        keep : The entry which is never removed, such as the one just stored
+        ----------
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.startswith('.'):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(e[1] for e in entries)
+        for mtime, size, file in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if file == keep:
+                continue
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self) -> None:
+        """
+        All entries are removed
+        """
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.startswith('.'):
+                os.remove(entry.path)
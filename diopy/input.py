@@ -18,12 +18,27 @@ import anndata
 from pandas.api.types import is_string_dtype, is_categorical_dtype, is_bool_dtype, is_float_dtype, is_integer_dtype, is_object_dtype
 import h5py
 from typing import Union
-import re
 import os
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatch
+from . import rworker
+from . import cache
+from . import profiling
 
 ### adata read h5 file 
 def read_h5(file: Union[str, None] = None,
-            assay_name: str = 'RNA'
+            assay_name: str = 'RNA',
+            backed: bool = False,
+            obs_indices: Union[np.ndarray, list, None] = None,
+            obs_mask: Union[np.ndarray, list, None] = None,
+            var_names: Union[np.ndarray, list, None] = None,
+            dtype = None,
+            n_jobs: int = 1,
+            include: Union[list, None] = None,
+            exclude: Union[list, None] = None,
+            string_dtype: str = 'object',
+            mmap: bool = False,
+            stats = None
             ) -> anndata.AnnData:
     """
     
@@ -35,6 +50,31 @@ def read_h5(file: Union[str, None] = None,
     assy_name : Denotes which omics data to save. Default is 'RNA'. Available options are:
                 'RNA': means that this omics data is scRNA-seq data
                 'spatial': means that this omics data is spatial data generated by 10x Genomics Visium toolkits
+    backed : Default is False. True means that the sparse matrices of 'X', 'raw.X' and 'layers' stay in the h5 file and are loaded
+             as the H5CSRMatrix, whose rows are read on demand. The h5 file is kept open in the read mode while the adata is used,
+             and is closed by close_h5(adata). The other operations than slicing the rows and columns need the matrix in memory,
+             see H5CSRMatrix.to_memory.
+    obs_indices : The integer positions of the cells to read. Default is None, reading all cells. Only the rows of these cells are read
+                  from 'X', 'raw.X', 'layers', 'dimR' and 'graphs', and 'obs' is subset to match.
+    obs_mask : The boolean array of the cells to read, as an alternative to obs_indices.
+    var_names : The gene names to read. Default is None, reading all genes. 'X', 'layers', 'var' and 'varm' are subset to these genes,
+                and 'raw.X' is subset to the genes existing in 'raw.var'. The genes are read quickly from the file written with csc_index=True.
+    dtype : The dtype of 'X', 'raw.X', 'layers' and 'graphs'. Default is None, keeping the saved dtype, such as the integer counts written
+            with dtype='preserve'. numpy.float32 gives the float32 matrices of the earlier versions.
+    n_jobs : The number of processes reading the h5 groups and the matrices concurrently. Default is 1, reading them one by one.
+             -1 means using all CPUs. Each process opens its own file handle, and the results are assembled into the AnnData at the end.
+    include : The h5 groups and datasets to read, as the nested keys such as ['layers/counts', 'dimR', 'spatial/*/scalefactors']. 
+              Default is None, reading all. 'obs', 'var' and 'data/X' are always read.
+    exclude : The h5 groups and datasets not to read, such as ['graphs', 'layers', 'spatial/*/image']. The skipped groups are not touched at all.
+    string_dtype : The dtype of the obs_names, var_names and the category levels. Default is 'object'. 'pyarrow' means the pandas Arrow-backed
+                   strings(pyarrow is needed), and 'string' means the pandas StringDtype strings.
+    mmap : Default is False. True means that the dense 'dimR', 'varm' and the 'Array' form of 'X', 'raw.X' and 'layers', when saved 
+           contiguously without the compression, are the read-only numpy.memmap of the h5 file instead of the copies in memory. 
+           The processes reading the same file share the page cache. The datasets subset by obs_indices or var_names, converted 
+           by dtype, or written with compression or chunks are read into memory as before.
+    stats : Default is None, not profiling. diopy.profiling.Profile collects the elapsed seconds, the bytes read and the peak memory 
+            of each h5 group and matrix, and a callable is called with each record. The records are also logged by the logger 'diopy' 
+            at the DEBUG level.
                 
     return anndata.AnnData
     ----------
@@ -43,22 +83,546 @@ def read_h5(file: Union[str, None] = None,
     ------
     >>> import diopy
     >>> adata = diopy.input.read_h5(file='scdata.h5')
+    >>> adata = diopy.input.read_h5(file='scdata.h5', backed=True)
+    >>> sub = adata[adata.obs['cluster'] == '1'].X  # only the rows of cluster 1 are read
+    >>> diopy.input.close_h5(adata)
+    >>> adata = diopy.input.read_h5(file='scdata.h5', obs_indices=range(1000))
+    >>> adata = diopy.input.read_h5(file='scdata.h5', var_names=['CD3E', 'MS4A1', 'LYZ'])
+    >>> adata = diopy.input.read_h5(file='scdata.h5', assay_name='spatial', exclude=['layers', 'graphs', 'spatial/*/image'])
+    >>> adata = diopy.input.read_h5(file='scaled.h5', mmap=True)
+    >>> profile = diopy.profiling.Profile()
+    >>> adata = diopy.input.read_h5(file='scdata.h5', stats=profile)
+    >>> print(profile.report())
     -----
 
     """
     if file is None:
         raise OSError('No such file or directory')
+    profile = profiling.as_profile(stats)
     h5 = h5py.File(name=file, mode='r')
+    adata = None
     try:
-        adata = h5_to_adata(h5=h5, assay_name=assay_name)
+        with profiling.stage(profile, 'read_h5', file=file):
+            adata = h5_to_adata(h5=h5, assay_name=assay_name, backed=backed, obs_indices=obs_indices, obs_mask=obs_mask,
+                                var_names=var_names, dtype=dtype, n_jobs=n_jobs, include=include, exclude=exclude,
+                                string_dtype=string_dtype, mmap=mmap, profile=profile)
     except Exception as e:
         print('Error:', e)
-    finally:
         h5.close()
+    finally:
+        # the backed matrices still read from the h5 file
+        if not backed or adata is None or len(backed_matrices(adata)) == 0:
+            h5.close()
     return adata
 
+
+def backed_matrices(adata: anndata.AnnData) -> list:
+    """
+    The H5CSRMatrix of 'X', 'raw.X' and 'layers' of the adata read by read_h5(backed=True)
+    """
+    mats = [adata.X] + list(adata.layers.values())
+    if adata.raw is not None:
+        mats.append(adata.raw.X)
+    return [m for m in mats if isinstance(m, H5CSRMatrix)]
+
+
+def close_h5(adata: anndata.AnnData) -> None:
+    """
+    
+    The h5 file kept open by read_h5(backed=True) will be closed. The backed matrices can not be read after closing, 
+    the matrices needed later are read by H5CSRMatrix.to_memory before.
+
+    Parameters:
+    ----------
+    adata : anndata.AnnData read by read_h5(backed=True)
+    ----------
+
+    Usage:
+    ------
+    >>> import diopy
+    >>> adata = diopy.input.read_h5(file='scdata.h5', backed=True)
+    >>> adata.layers['counts'] = adata.layers['counts'].to_memory()
+    >>> diopy.input.close_h5(adata)
+    -----
+
+    """
+    for m in backed_matrices(adata):
+        m.close()
+    return
+
+def h5_selected(path: str,
+                include: Union[list, None] = None,
+                exclude: Union[list, None] = None,
+                **kwargs
+                ) -> bool:
+    """
+
+    Whether the h5 group or dataset denoted by the path is read under the include and exclude filters.
+    The patterns are the nested keys matched level by level, such as 'layers/counts', 'graphs' and 'spatial/*/image'.
+
+    Parameters:
+    ----------
+    path : The path of the h5 group or dataset, such as 'layers/counts'
+    include : The patterns to read. Default is None, reading all. The path is read when it matches the pattern, 
+              lies under the pattern, or lies above the pattern
+    exclude : The patterns not to read. Default is None. The path is skipped when it matches the pattern or lies under the pattern
+    kwargs : The other reading options, which are ignored
+    
+    return bool
+    ----------
+
+    Usage:
+    ------
+    >>> h5_selected('layers/counts', include=['obs', 'layers/counts'])
+    True
+    >>> h5_selected('spatial/slice1/image', exclude=['spatial/*/image'])
+    False
+    -----
+
+    """
+    parts = path.strip('/').split('/')
+    if exclude is not None:
+        for pat in exclude:
+            pat_parts = pat.strip('/').split('/')
+            if len(parts) >= len(pat_parts) and all(fnmatch(a, b) for a, b in zip(parts, pat_parts)):
+                return False
+    if include is None:
+        return True
+    for pat in include:
+        pat_parts = pat.strip('/').split('/')
+        if all(fnmatch(a, b) for a, b in zip(parts, pat_parts)):
+            return True
+    return False
+
+
+### the rows subset read from the h5 file
+def h5_read(h5dset: h5py.Dataset,
+            dtype = None
+            ) -> np.ndarray:
+    """
+
+    The h5 dataset will be read into numpy.ndarray. When dtype differs from the saved dtype, the values are converted
+    while reading, without the second copy.
+
+    Parameters:
+    ----------
+    h5dset : The h5py.Dataset
+    dtype : The dtype of the result. Default is None, keeping the saved dtype
+    
+    return numpy.ndarray
+    ----------
+
+    """
+    out = np.empty(h5dset.shape, dtype=h5dset.dtype if dtype is None else dtype)
+    if out.size > 0:
+        h5dset.read_direct(out)
+    return out
+
+
+def sparse_index_dtype(nnz: int,
+                       n_cols: int):
+    """
+
+    The dtype of 'indices' and 'indptr' of the CSR matrix in memory, numpy.int32 as scipy chooses when nnz and the columns fit, 
+    else numpy.int64. scipy needs the same signed type for both, so the narrow 'indices' saved by diopy.output.sparse_index_dtypes 
+    are widened while reading, and the matrix with more than 2^31 - 1 non-zeros keeps the int64 'indptr'.
+
+    """
+    if max(nnz, n_cols) <= np.iinfo(np.int32).max:
+        return np.dtype(np.int32)
+    return np.dtype(np.int64)
+
+
+def csr_from_buffers(x: np.ndarray,
+                     indices: np.ndarray,
+                     indptr: np.ndarray,
+                     shape: tuple
+                     ) -> scipy.sparse.csr.csr_matrix:
+    """
+
+    The scipy.sparse.csr.csr_matrix will be built on the buffers without copying or validating them. 
+    'indices' and 'indptr' must share the same integer dtype, see sparse_index_dtype.
+
+    Parameters:
+    ----------
+    x : The values
+    indices : The column positions of the values
+    indptr : The offsets of the rows in the values
+    shape : The shape of the matrix
+    
+    return scipy.sparse.csr.csr_matrix
+    ----------
+
+    """
+    mat = sparse.csr_matrix(tuple(int(i) for i in shape), dtype=x.dtype)
+    mat.data = x
+    mat.indices = indices
+    mat.indptr = indptr
+    return mat
+
+
+def obs_to_indices(n_obs: int,
+                   obs_indices: Union[np.ndarray, list, None] = None,
+                   obs_mask: Union[np.ndarray, list, None] = None
+                   ) -> Union[np.ndarray, None]:
+    """
+
+    The obs_indices or the obs_mask will be converted to the integer positions of the cells
+
+    Parameters:
+    ----------
+    n_obs : The number of the cells
+    obs_indices : The integer positions of the cells. The boolean array is also accepted
+    obs_mask : The boolean array denoting the cells
+    
+    return numpy.ndarray or None when no cells are selected
+    ----------
+
+    """
+    if obs_indices is not None and obs_mask is not None:
+        raise ValueError("Please provide only one of obs_indices and obs_mask")
+    if obs_mask is not None:
+        obs_indices = obs_mask
+    if obs_indices is None:
+        return None
+    obs_indices = np.asarray(obs_indices)
+    if obs_indices.dtype == bool:
+        if len(obs_indices) != n_obs:
+            raise IndexError("The length of obs_mask %d is not equal to the number of cells %d" % (len(obs_indices), n_obs))
+        return np.flatnonzero(obs_indices)
+    obs_indices = obs_indices.astype(np.int64).ravel()
+    obs_indices[obs_indices < 0] += n_obs
+    if len(obs_indices) > 0 and (obs_indices.min() < 0 or obs_indices.max() >= n_obs):
+        raise IndexError("obs_indices is out of the range of %d cells" % n_obs)
+    return obs_indices
+
+
+def var_to_indices(h5df: h5py.Group,
+                   var_names: Union[np.ndarray, list],
+                   strict: bool = True
+                   ) -> np.ndarray:
+    """
+
+    The gene names will be converted to the integer positions in the 'index' of the h5 group saving the var dataframe
+
+    Parameters:
+    ----------
+    h5df : The h5py.Group saving the var dataframe
+    var_names : The gene names
+    strict : Default is True, raising KeyError when some gene names are missing. False means that the missing gene names are dropped
+    
+    return numpy.ndarray
+    ----------
+
+    """
+    index = pd.Index(h5df['index'][()].astype(str))
+    var_names = pd.Index(np.asarray(var_names).astype(str))
+    pos = index.get_indexer(var_names)
+    if strict and np.any(pos < 0):
+        raise KeyError("The genes are not found: %s" % ', '.join(var_names[pos < 0][:10]))
+    return pos[pos >= 0]
+
+
+def row_runs(rows: np.ndarray):
+    """
+
+    The sorted unique rows will be split into the runs of continuous rows
+
+    Parameters:
+    ----------
+    rows : The sorted unique integer positions of the rows
+    
+    return the starts and the stops(exclusive) of the runs
+    ----------
+
+    """
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    brk = np.flatnonzero(np.diff(rows) != 1) + 1
+    starts = rows[np.r_[0, brk]]
+    stops = rows[np.r_[brk - 1, len(rows) - 1]] + 1
+    return starts, stops
+
+
+def h5_take_rows(h5dset: h5py.Dataset,
+                 rows: np.ndarray
+                 ) -> np.ndarray:
+    """
+
+    The rows of the dense h5 dataset will be read, each run of continuous rows by one hyperslab
+
+    Parameters:
+    ----------
+    h5dset : The h5py.Dataset saving the dense matrix
+    rows : The integer positions of the rows, which can be unsorted or duplicated
+    
+    return numpy.ndarray
+    ----------
+
+    """
+    uniq, inverse = np.unique(rows, return_inverse=True)
+    starts, stops = row_runs(uniq)
+    out = np.empty((len(uniq),) + h5dset.shape[1:], dtype=h5dset.dtype)
+    pos = 0
+    for b, e in zip(starts, stops):
+        out[pos:pos + e - b] = h5dset[b:e]
+        pos += e - b
+    if len(uniq) == len(rows) and np.all(uniq == rows):
+        return out
+    return out[inverse]
+
+
+def h5_mmap(h5dset: h5py.Dataset,
+            dtype = None
+            ) -> Union[np.memmap, None]:
+    """
+
+    The contiguous and unfiltered h5 dataset will be mapped into memory as the read-only numpy.memmap, 
+    so the processes reading the same file share the page cache instead of copying the data.
+
+    Parameters:
+    ----------
+    h5dset : The h5py.Dataset saving the dense numeric array
+    dtype : The dtype of the result. Default is None, keeping the saved dtype
+    
+    return numpy.memmap, or None when the dataset is chunked, compressed, not numeric, not allocated in the file 
+           or the dtype differs from the saved dtype
+    ----------
+
+    """
+    if h5dset.chunks is not None or h5dset.dtype.kind not in 'biufc' or h5dset.size == 0:
+        return None
+    if dtype is not None and np.dtype(dtype) != h5dset.dtype:
+        return None
+    if h5dset.file.driver not in ['sec2', 'stdio']:
+        return None
+    offset = h5dset.id.get_offset()
+    if offset is None:
+        return None
+    return np.memmap(h5dset.file.filename, mode='r', dtype=h5dset.dtype, shape=h5dset.shape, offset=offset)
+
+
+def h5_csr_rows(h5mat: h5py.Group,
+                rows: np.ndarray,
+                indptr: Union[np.ndarray, None] = None,
+                dtype = None,
+                n_cols: Union[int, None] = None
+                ) -> scipy.sparse.csr.csr_matrix:
+    """
+
+    The rows of the sparse matrix in the h5 group will be read. Only the 'indptr' ranges of the rows are read at first,
+    then the 'values' and 'indices' spans of the rows are read, the adjacent spans being coalesced into one hyperslab.
+
+    Parameters:
+    ----------
+    h5mat : The h5py.Group saving the sparse matrix
+    rows : The integer positions of the rows, which can be unsorted or duplicated
+    indptr : The 'indptr' already in memory. Default is None, reading the 'indptr' ranges from the h5 file
+    dtype : The dtype of the values. Default is None, keeping the saved dtype
+    n_cols : The number of the columns. Default is None, reading from 'dims'. The column-major matrix gives the number of its rows,
+             its columns being read as the rows
+    
+    return scipy.sparse.csr.csr_matrix
+    ----------
+
+    """
+    if n_cols is None:
+        n_cols = int(h5mat["dims"][1])
+    values = h5mat["values"]
+    indices = h5mat["indices"]
+    dtype = values.dtype if dtype is None else np.dtype(dtype)
+    uniq, inverse = np.unique(rows, return_inverse=True)
+    if len(uniq) == 0:
+        return sparse.csr_matrix((0, n_cols), dtype=dtype)
+    starts, stops = row_runs(uniq)
+    if indptr is None:
+        # only the indptr from the first row to the last row is read
+        offset = uniq[0]
+        indptr = h5mat["indptr"][offset:uniq[-1] + 2]
+    else:
+        offset = 0
+    start = indptr[uniq - offset]
+    stop = indptr[uniq - offset + 1]
+    idx_dtype = sparse_index_dtype(nnz=int((stop - start).sum()), n_cols=n_cols)
+    sub_indptr = np.zeros(len(uniq) + 1, dtype=idx_dtype)
+    np.cumsum(stop - start, out=sub_indptr[1:])
+    # the spans of the continuous rows, merged again when only the empty rows lie between them
+    span_b = indptr[starts - offset]
+    span_e = indptr[stops - offset]
+    brk = np.flatnonzero(span_b[1:] != span_e[:-1]) + 1
+    span_b = span_b[np.r_[0, brk]]
+    span_e = span_e[np.r_[brk - 1, len(span_e) - 1]]
+    x = np.empty(sub_indptr[-1], dtype=dtype)
+    ind = np.empty(sub_indptr[-1], dtype=idx_dtype)
+    pos = 0
+    for b, e in zip(span_b, span_e):
+        if e > b:
+            # the spans are converted to the dtype of the buffers while reading
+            values.read_direct(x, np.s_[b:e], np.s_[pos:pos + e - b])
+            indices.read_direct(ind, np.s_[b:e], np.s_[pos:pos + e - b])
+            pos += e - b
+    mat = csr_from_buffers(x=x, indices=ind, indptr=sub_indptr, shape=(len(uniq), n_cols))
+    if len(uniq) == len(rows) and np.all(uniq == rows):
+        return mat
+    return mat[inverse]
+
+
+### the sparse matrix kept in the h5 file
+# the row and column slicing of scipy.sparse dispatches to these private methods since scipy 1.3, H5CSRMatrix overrides them
+_SCIPY_INDEX_METHODS = ['_get_intXint', '_get_intXslice', '_get_sliceXint', '_get_sliceXslice', '_get_arrayXint', '_get_arrayXslice',
+                        '_get_intXarray', '_get_sliceXarray', '_get_arrayXarray', '_get_columnXarray']
+
+
+class H5CSRMatrix(sparse.csr_matrix):
+    """
+
+    The scipy.sparse.csr.csr_matrix whose 'values' and 'indices' stay in the h5 file. Only 'indptr' is loaded into memory,
+    and the rows are read from the h5 file on demand when the matrix is sliced. Only the slicing of the rows and columns is supported,
+    the arithmetic, the reductions, tocsc and tocoo raise TypeError, and to_memory() reads the whole matrix for them.
+    The h5 file stays open while the matrix is used, and is closed by close() or at the end of the with block. The matrices
+    read from the same file share the file handle, closing one closes all of them.
+
+    Parameters:
+    ----------
+    h5mat : The h5py.Group saving the sparse matrix
+    dtype : The dtype of the values read. Default is None, keeping the saved dtype
+    ----------
+
+    Usage:
+    ------
+    >>> import diopy
+    >>> import h5py
+    >>> h5 = h5py.File('scdata.h5', 'r')
+    >>> mtx = diopy.input.H5CSRMatrix(h5mat=h5['data/X'])
+    >>> sub = mtx[0:100]  # the rows from 0 to 99 are read
+    >>> total = mtx.to_memory().sum(axis=1)  # the whole matrix is read
+    >>> mtx.close()
+    >>> with diopy.input.H5CSRMatrix(h5mat=h5py.File('scdata.h5', 'r')['data/X']) as mtx:
+    ...     sub = mtx[[0, 5, 6]]
+    -----
+
+    """
+    def __init__(self, h5mat: h5py.Group, dtype = None):
+        missing = [m for m in _SCIPY_INDEX_METHODS if not hasattr(sparse.csr_matrix, m)]
+        if len(missing) > 0:
+            raise NotImplementedError("The slicing of H5CSRMatrix needs the scipy.sparse indexing of scipy >= 1.3, %s is not found in "
+                                      "scipy %s. Read the matrix with backed=False" % (', '.join(missing), scipy.__version__))
+        shapes = tuple(h5mat["dims"][()])
+        self._dtype = h5mat["values"].dtype if dtype is None else np.dtype(dtype)
+        super().__init__(shapes, dtype=self._dtype)
+        self.h5mat = h5mat
+        self.data = h5mat["values"]
+        self.indices = h5mat["indices"]
+        self.indptr = h5mat["indptr"][()]
+        self.file = h5mat.file
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    def close(self) -> None:
+        """
+
+        The h5 file of the matrix is closed, the matrix can not be read after closing
+
+        """
+        if self.file.id.valid:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def to_memory(self) -> scipy.sparse.csr.csr_matrix:
+        """
+
+        All rows of the matrix are read into the scipy.sparse.csr.csr_matrix
+
+        """
+        idx_dtype = sparse_index_dtype(nnz=self.data.shape[0], n_cols=self.shape[1])
+        x = h5_read(h5dset=self.data, dtype=self._dtype)
+        indices = h5_read(h5dset=self.indices, dtype=idx_dtype)
+        return csr_from_buffers(x=x, indices=indices, indptr=self.indptr.astype(idx_dtype), shape=self.shape)
+
+    def copy(self) -> scipy.sparse.csr.csr_matrix:
+        return self.to_memory()
+
+    def get_rows(self, rows: Union[slice, np.ndarray]) -> scipy.sparse.csr.csr_matrix:
+        """
+
+        The rows of the matrix are read into the scipy.sparse.csr.csr_matrix
+
+        Parameters:
+        ----------
+        rows : The slice, the integer array or the boolean mask of the rows
+        ----------
+
+        """
+        if isinstance(rows, slice):
+            rows = np.arange(*rows.indices(self.shape[0]))
+        rows = obs_to_indices(n_obs=self.shape[0], obs_indices=rows)
+        return h5_csr_rows(h5mat=self.h5mat, rows=rows, indptr=self.indptr, dtype=self._dtype)
+
+    def _get_intXint(self, row, col):
+        return self.get_rows(np.array([row]))[0, col]
+
+    def _get_sliceXint(self, row, col):
+        return self.get_rows(row)[:, col]
+
+    def _get_arrayXint(self, row, col):
+        return self.get_rows(row)[:, col]
+
+    def _get_intXslice(self, row, col):
+        return self.get_rows(np.array([row]))[:, col]
+
+    def _get_sliceXslice(self, row, col):
+        return self.get_rows(row)[:, col]
+
+    def _get_arrayXslice(self, row, col):
+        return self.get_rows(row)[:, col]
+
+    def _get_intXarray(self, row, col):
+        return self.get_rows(np.array([row]))[:, col]
+
+    def _get_sliceXarray(self, row, col):
+        return self.get_rows(row)[:, col]
+
+    def _get_arrayXarray(self, row, col):
+        return self.get_rows(np.unique(row))[np.searchsorted(np.unique(row), row), col]
+
+    def _get_columnXarray(self, row, col):
+        rows = np.asarray(row).ravel()
+        return self.get_rows(rows)[np.arange(len(rows))[:, None], col]
+
+    def toarray(self, order=None, out=None):
+        return self.to_memory().toarray(order=order, out=out)
+
+
+def in_memory_only(name: str):
+    """
+    The method of H5CSRMatrix raising TypeError instead of loading the whole matrix from the h5 file quietly
+    """
+    def method(self, *args, **kwargs):
+        raise TypeError("H5CSRMatrix.%s is not supported, the matrix stays in the h5 file. Call to_memory() first" % name)
+    method.__name__ = name
+    return method
+
+
+for _name in ['__add__', '__radd__', '__sub__', '__rsub__', '__mul__', '__rmul__', '__matmul__', '__rmatmul__', '__truediv__',
+              '__neg__', 'multiply', 'dot', 'power', 'maximum', 'minimum', 'sum', 'mean', 'transpose', 'tocsc', 'tocoo']:
+    setattr(H5CSRMatrix, _name, in_memory_only(_name))
+
+
 ### h5 file convert to the matrix 
-def h5_to_matrix(h5mat: [h5py.Group, h5py.File]
+def h5_to_matrix(h5mat: [h5py.Group, h5py.File],
+                 backed: bool = False,
+                 obs_indices: Union[np.ndarray, list, None] = None,
+                 obs_mask: Union[np.ndarray, list, None] = None,
+                 var_indices: Union[np.ndarray, list, None] = None,
+                 dtype = None,
+                 mmap: bool = False
                  ) -> Union[scipy.sparse.csr.csr_matrix, np.ndarray]:
     """
 
@@ -67,8 +631,20 @@ def h5_to_matrix(h5mat: [h5py.Group, h5py.File]
     Parameters:
     ----------
     h5mat : The h5py.Group saving the matrix
+    backed : Default is False. True means that the sparse matrix is returned as the H5CSRMatrix reading rows from the h5 file on demand.
+             The 'Array' matrix and the column-major sparse matrix(layout='csc') are always read into memory.
+    obs_indices : The integer positions of the rows(cells) to read. Default is None, reading all rows.
+                  Only the 'values' and 'indices' spans of these rows are read from the h5 file, and the result is in memory even if backed is True.
+    obs_mask : The boolean array of the rows(cells) to read, as an alternative to obs_indices.
+    var_indices : The integer positions of the columns(genes) to read. Default is None, reading all columns.
+                  The columns are read from the column-major copy 'csc' when the matrix is written with csc_index=True,
+                  otherwise the columns are subset after the rows are read.
+    dtype : The dtype of the matrix. Default is None, returning the saved dtype without the extra copy.
+            numpy.float32 gives the float32 matrix of the earlier versions.
+    mmap : Default is False. True means that the whole 'Array' matrix saved contiguously without the compression is returned 
+           as the read-only numpy.memmap, see h5_mmap. The sparse matrix is not affected.
     
-    return scipy.sparse.csr.csr_matrix or numpy.ndarray
+    return scipy.sparse.csr.csr_matrix, scipy.sparse.csc.csc_matrix for the column-major matrix, numpy.ndarray or numpy.memmap
     ----------
 
     Usage:
@@ -77,42 +653,160 @@ def h5_to_matrix(h5mat: [h5py.Group, h5py.File]
     >>> import h5py
     >>> h5 = h5py.File('scdata.h5', 'r')
     >>> mtx = diopy.input.h5_to_matrix(h5mat=h5['data/X'])
+    >>> sub = diopy.input.h5_to_matrix(h5mat=h5['data/X'], obs_indices=[0, 5, 6, 7])
+    >>> panel = diopy.input.h5_to_matrix(h5mat=h5['data/X'], var_indices=[10, 25, 3])
     >>> h5.close()
     >>>
     -----
 
     """
-    if isinstance(h5mat.attrs['datatype'], str):
-        if h5mat.attrs['datatype'] == 'SparseMatrix':
-            x = h5mat["values"][()].astype(np.float32)
-            indices = h5mat["indices"][()]
-            indptr = h5mat["indptr"][()]
-            shapes = h5mat["dims"][()]
-            mat = sparse.csr_matrix((x, indices, indptr), shape=shapes, dtype=np.float32)
-        elif h5mat.attrs['datatype'] == 'Array':
-            mat = h5mat['matrix'][()].astype(np.float32)
-    elif isinstance(h5mat.attrs['datatype'], np.ndarray):
-        if h5mat.attrs['datatype'].astype('str').item() == 'SparseMatrix':
-            x = h5mat["values"][()].astype(np.float32)
-            indices = h5mat["indices"][()]
-            indptr = h5mat["indptr"][()]
+    datatype = h5mat.attrs['datatype']
+    if isinstance(datatype, np.ndarray):
+        datatype = datatype.astype('str').item()
+    if var_indices is not None:
+        var_indices = np.asarray(var_indices, dtype=np.int64)
+    if datatype == 'SparseMatrix':
+        rows = obs_to_indices(n_obs=int(h5mat["dims"][0]), obs_indices=obs_indices, obs_mask=obs_mask)
+        if h5_attr_str(h5mat.attrs.get('layout', 'csr')) == 'csc':
+            return h5_to_csc(h5mat=h5mat, rows=rows, var_indices=var_indices, dtype=dtype)
+        if var_indices is not None and 'csc' in h5mat.keys():
+            # the columns are the rows of the column-major copy
+            mat = h5_csr_rows(h5mat=h5mat['csc'], rows=var_indices, dtype=dtype).T.tocsr()
+            if rows is not None:
+                mat = mat[rows]
+            return mat
+        if rows is not None:
+            mat = h5_csr_rows(h5mat=h5mat, rows=rows, dtype=dtype)
+        elif backed and var_indices is None:
+            return H5CSRMatrix(h5mat=h5mat, dtype=dtype)
+        else:
+            # each dataset is read once into the buffer of its final dtype, and the matrix is built on the buffers
             shapes = h5mat["dims"][()]
-            mat = sparse.csr_matrix((x, indices, indptr), shape=shapes, dtype=np.float32)
-        elif h5mat.attrs['datatype'].astype('str').item() == 'Array':
-            mat = h5mat['matrix'][()].astype(np.float32)
+            idx_dtype = sparse_index_dtype(nnz=h5mat["values"].shape[0], n_cols=int(shapes[1]))
+            x = h5_read(h5dset=h5mat["values"], dtype=dtype)
+            indices = h5_read(h5dset=h5mat["indices"], dtype=idx_dtype)
+            indptr = h5_read(h5dset=h5mat["indptr"], dtype=idx_dtype)
+            mat = csr_from_buffers(x=x, indices=indices, indptr=indptr, shape=shapes)
+        if var_indices is not None:
+            mat = mat[:, var_indices]
+    elif datatype == 'Array':
+        rows = obs_to_indices(n_obs=h5mat['matrix'].shape[0], obs_indices=obs_indices, obs_mask=obs_mask)
+        if var_indices is not None:
+            # h5py reads the columns in the increasing order
+            uniq, inverse = np.unique(var_indices, return_inverse=True)
+            mat = h5mat['matrix'][:, uniq][:, inverse]
+            if rows is not None:
+                mat = mat[rows]
+        elif rows is not None:
+            mat = h5_take_rows(h5dset=h5mat['matrix'], rows=rows)
+        else:
+            mat = h5_mmap(h5dset=h5mat['matrix'], dtype=dtype) if mmap else None
+            if mat is None:
+                mat = h5_read(h5dset=h5mat['matrix'], dtype=dtype)
+        if dtype is not None:
+            mat = mat.astype(dtype, copy=False)
+    return mat
+
+
+def h5_to_csc(h5mat: h5py.Group,
+              rows: Union[np.ndarray, None] = None,
+              var_indices: Union[np.ndarray, None] = None,
+              dtype = None
+              ) -> scipy.sparse.csc.csc_matrix:
+    """
+
+    The column-major sparse matrix saved by diopy.output.matrix_to_h5(layout='csc') will be read as the scipy.sparse.csc.csc_matrix 
+    without the conversion. The columns of var_indices are read as the rows of its transpose, then the rows are subset.
+
+    Parameters:
+    ----------
+    h5mat : The h5py.Group saving the column-major sparse matrix, 'indptr' pointing to the columns and 'indices' being the rows
+    rows : The integer positions of the rows(cells). Default is None, reading all rows
+    var_indices : The integer positions of the columns(genes). Default is None, reading all columns
+    dtype : The dtype of the values. Default is None, keeping the saved dtype
+    
+    return scipy.sparse.csc.csc_matrix
+    ----------
+
+    """
+    shapes = h5mat["dims"][()]
+    n_rows = int(shapes[0])
+    if var_indices is not None:
+        mat = h5_csr_rows(h5mat=h5mat, rows=var_indices, dtype=dtype, n_cols=n_rows).T
+    else:
+        idx_dtype = sparse_index_dtype(nnz=h5mat["values"].shape[0], n_cols=n_rows)
+        x = h5_read(h5dset=h5mat["values"], dtype=dtype)
+        indices = h5_read(h5dset=h5mat["indices"], dtype=idx_dtype)
+        indptr = h5_read(h5dset=h5mat["indptr"], dtype=idx_dtype)
+        # the csc matrix is the transpose of the csr matrix built on the same buffers
+        mat = csr_from_buffers(x=x, indices=indices, indptr=indptr, shape=(int(shapes[1]), n_rows)).T
+    if rows is not None:
+        mat = mat[rows]
     return mat
 
 
 ### h5 file to the pandas dataframe
-def h5_to_df(h5df: [h5py.Group,h5py.File]
+def h5_attr_str(value) -> str:
+    """
+
+    The h5 attribute saved by Python(str) or R(numpy.ndarray of bytes) will be converted to str
+
+    """
+    if isinstance(value, np.ndarray):
+        value = value.ravel()[0]
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return str(value)
+
+
+def h5_to_str(h5dset: h5py.Dataset,
+              string_dtype: str = 'object'
+              ) -> Union[np.ndarray, pd.api.extensions.ExtensionArray]:
+    """
+
+    The strings of the h5 dataset will be decoded in bulk. The variable-length strings are decoded by h5py asstr(), 
+    and the fixed-width bytes are decoded by numpy.char.decode.
+
+    Parameters:
+    ----------
+    h5dset : The h5py.Dataset saving the strings
+    string_dtype : Default is 'object', returning numpy.ndarray of str. 'pyarrow' returns the pandas Arrow-backed strings,
+                   which need the package pyarrow. 'string' returns the pandas StringDtype strings
+    
+    return numpy.ndarray or pandas.api.extensions.ExtensionArray
+    ----------
+
+    """
+    if h5dset.dtype.kind == 'S':
+        values = h5dset[()]
+        try:
+            values = values.astype('U').astype(object)
+        except UnicodeDecodeError:
+            values = np.char.decode(values, 'utf-8').astype(object)
+    elif h5dset.dtype.kind == 'O' and hasattr(h5dset, 'asstr'):
+        values = h5dset.asstr()[()]
+    else:
+        values = h5dset[()].astype(str).astype(object)
+    if string_dtype == 'pyarrow':
+        return pd.array(values, dtype='string[pyarrow]')
+    if string_dtype == 'string':
+        return pd.array(values, dtype='string')
+    return values
+
+
+def h5_to_df(h5df: [h5py.Group,h5py.File],
+             string_dtype: str = 'object'
              ) -> pd.DataFrame:
     """
 
-    The h5 group will be converted to the pandas.dataframe
+    The h5 group will be converted to the pandas.dataframe. The attributes of each column are read once, 
+    the category codes are kept at the saved width and the strings are decoded in bulk.
 
     Parameters:
     ----------
     h5df: The h5py.Group saving the dataframe 
+    string_dtype : The dtype of the index and the category levels. Default is 'object'. 'pyarrow' means the pandas Arrow-backed strings,
+                   and 'string' means the pandas StringDtype strings
     
     return pandas.core.frame.DataFrame
     ----------
@@ -129,40 +823,34 @@ def h5_to_df(h5df: [h5py.Group,h5py.File]
 
     """
     to_dict = {}
-    to_dict['index'] = h5df['index'][()].astype(str).astype(np.object)
     for i in h5df.keys():
-        if(len(h5df[i].attrs.keys())>0):
-            if np.array(h5df[i].attrs['origin_dtype']).astype(str).astype(np.object) == 'category':
-                e0 = h5df[i][()].astype(int)
-                if np.min(e0) == -2147483648:
-                    e0[e0==-2147483648] = -1
-                lvl = h5df['category'][i][()].astype(str).astype(np.object)
-                # to_dict[i] = pd.Categorical(values=lvl[e0],categories=lvl)
-                lvl =  pd.CategoricalDtype(lvl)
-                to_dict[i] = pd.Categorical.from_codes(codes=e0, dtype=lvl)
-            if np.array(h5df[i].attrs['origin_dtype']).astype(str).astype(np.object) == 'string':
-                e0 = h5df[i][()].astype(int)
-                if np.min(e0) == -2147483648:
-                    e0[e0==-2147483648] = -1
-                lvl = h5df['category'][i][()].astype(str).astype(np.object)
-                # to_dict[i] = pd.Categorical(values=lvl[e0],categories=lvl).astype(np.object)
-                lvl =  pd.CategoricalDtype(lvl)
-                to_dict[i] = pd.Categorical.from_codes(codes=e0, dtype=lvl)
-            if np.array(h5df[i].attrs['origin_dtype']).astype(str).astype(np.object) == 'bool':
-                e0 = h5df[i][()].astype(int)
-                to_dict[i] = e0.astype(np.bool)
-            if np.array(h5df[i].attrs['origin_dtype']).astype(str).astype(np.object) == 'number':
-                e0 = h5df[i][()]
-                to_dict[i] = e0
-    df= pd.DataFrame(to_dict)
-    df.set_index('index', inplace=True)
+        dset = h5df[i]
+        if not isinstance(dset, h5py.Dataset) or 'origin_dtype' not in dset.attrs:
+            continue
+        origin_dtype = h5_attr_str(dset.attrs['origin_dtype'])
+        if origin_dtype in ['category', 'string']:
+            e0 = dset[()]
+            if e0.dtype.kind not in 'iu':
+                e0 = e0.astype(np.int32)
+            elif e0.dtype == np.int32 or e0.dtype == np.int64:
+                # NA of R integer
+                e0[e0 == -2147483648] = -1
+            lvl = pd.CategoricalDtype(h5_to_str(h5df['category'][i], string_dtype=string_dtype))
+            to_dict[i] = pd.Categorical.from_codes(codes=e0, dtype=lvl)
+        elif origin_dtype == 'bool':
+            to_dict[i] = dset[()].astype(bool)
+        elif origin_dtype == 'number':
+            to_dict[i] = dset[()]
+    index = pd.Index(h5_to_str(h5df['index'], string_dtype=string_dtype))
+    index.name = 'index'
+    df = pd.DataFrame(to_dict, index=index)
     if 'colnames' in h5df.keys():
-        cnames = h5df['colnames'][()].astype(str).astype(np.object)
+        cnames = h5_to_str(h5df['colnames'])
         df = df[cnames]
     return df
 
 
-def h5_to_spatial(h5spa):
+def h5_to_spatial(h5spa, **kwargs):
     """
 
     The h5 group will be converted to the spatial messages including image, scalefactor and coordinate.
@@ -170,6 +858,7 @@ def h5_to_spatial(h5spa):
     Parameters:
     ----------
     h5df: The h5py.Group saving the spatial messages 
+    kwargs: The include and exclude filters of h5_selected, such as exclude=['spatial/*/image'], and the string_dtype of h5_to_df
     
     return the dict including the spatial messages
     ----------
@@ -190,10 +879,13 @@ def h5_to_spatial(h5spa):
         spatial_sid_dict = {}
         sid_h5 = h5spa[sid]
         for me in sid_h5.keys():
+            if not h5_selected('%s/%s/%s' % (h5spa.name, sid, me), **kwargs):
+                continue
             if ('image' in me) or ('images' in me):
                 im_dict = {}
                 for im in sid_h5[me]:
-                    im_dict[im] = sid_h5[me][im][()]
+                    if h5_selected('%s/%s/%s/%s' % (h5spa.name, sid, me, im), **kwargs):
+                        im_dict[im] = sid_h5[me][im][()]
                 spatial_sid_dict['images'] = im_dict
             if 'scalefactors' in me:
                 sf_dict = {}
@@ -205,12 +897,12 @@ def h5_to_spatial(h5spa):
                         sf_dict[sf] = sf_v
                 spatial_sid_dict[me] = sf_dict
             if 'coor' in me:
-                spatial_sid_dict['coor'] = h5_to_df(sid_h5[me])
+                spatial_sid_dict['coor'] = h5_to_df(sid_h5[me], string_dtype=kwargs.get('string_dtype', 'object'))
         spatial_dict[sid] = spatial_sid_dict
     return spatial_dict
 
 
-def to_obs_(h5):
+def to_obs_(h5, **kwargs):
     """
 
     The h5 group 'obs' will be converted pandas.core.frame.DataFrame
@@ -218,15 +910,18 @@ def to_obs_(h5):
     Parameters:
     ----------
     h5: The h5py.File
+    kwargs: The reading options passed from read_h5, such as 'backed', 'obs_indices', 'var_indices', 'include' and 'exclude'
     
     return The pandas.core.frame.DataFrame representing 'obs'
     ----------
 
     """
-    to_obs = h5_to_df(h5df = h5['obs'])
+    to_obs = h5_to_df(h5df = h5['obs'], string_dtype=kwargs.get('string_dtype', 'object'))
+    if kwargs.get('obs_indices') is not None:
+        to_obs = to_obs.iloc[kwargs['obs_indices']]
     return(to_obs)
 
-def to_dimr_(h5):
+def to_dimr_(h5, **kwargs):
     """
 
     The h5 group 'dimR' will be converted dictionary-like object
@@ -234,22 +929,33 @@ def to_dimr_(h5):
     Parameters:
     ----------
     h5: The h5py.File
+    kwargs: The reading options passed from read_h5, such as 'backed', 'obs_indices', 'var_indices', 'include' and 'exclude'
     
     return The dict repesenting 'dimension reduction'
     ----------
 
     """
     dimR=h5['dimR']
+    obs_indices = kwargs.get('obs_indices')
     to_dimr = {}
     for k in dimR.keys():
+        if not h5_selected('dimR/' + k, **kwargs):
+            continue
+        with profiling.stage(kwargs.get('profile'), 'read/dimR/' + k, dimR, k):
+            if obs_indices is not None:
+                dr = h5_take_rows(h5dset=dimR[k], rows=obs_indices)
+            else:
+                dr = h5_mmap(h5dset=dimR[k]) if kwargs.get('mmap', False) else None
+                if dr is None:
+                    dr = dimR[k][()]
         if k == 'SPATIAL':
-            to_dimr['spatial'] = dimR[k][()]
+            to_dimr['spatial'] = dr
         else:
             X_k = "X_" + k.lower()
-            to_dimr[X_k] = dimR[k][()]
+            to_dimr[X_k] = dr
     return(to_dimr)
 
-def to_spatial_(h5):
+def to_spatial_(h5, **kwargs):
     """
 
     The h5 group 'spaitial' will be converted dictionary-like object
@@ -257,15 +963,21 @@ def to_spatial_(h5):
     Parameters:
     ----------
     h5: The h5py.File
+    kwargs: The reading options passed from read_h5, such as 'backed', 'obs_indices', 'var_indices', 'include' and 'exclude'
     
     return The dict repesenting 'spatial'
     ----------
 
     """
-    to_spatial = h5_to_spatial(h5spa=h5['spatial'])
+    to_spatial = h5_to_spatial(h5spa=h5['spatial'], include=kwargs.get('include'), exclude=kwargs.get('exclude'),
+                               string_dtype=kwargs.get('string_dtype', 'object'))
+    if kwargs.get('obs_indices') is not None:
+        for sid in to_spatial.keys():
+            if 'coor' in to_spatial[sid].keys():
+                to_spatial[sid]['coor'] = to_spatial[sid]['coor'].iloc[kwargs['obs_indices']]
     return(to_spatial)
 
-def to_data_(h5):
+def to_data_(h5, **kwargs):
     """
 
     The h5 group 'data' will be converted dictionary-like object
@@ -273,6 +985,7 @@ def to_data_(h5):
     Parameters:
     ----------
     h5: The h5py.File
+    kwargs: The reading options passed from read_h5, such as 'backed', 'obs_indices', 'var_indices', 'include', 'exclude' and 'subkeys'
     
     return The dict repesenting 'X' and 'raw.X'
     ----------
@@ -281,10 +994,17 @@ def to_data_(h5):
     data = h5['data']
     to_data = {}
     for d in data.keys():
-        to_data[d] = h5_to_matrix(h5mat=data[d])
+        if kwargs.get('subkeys') is not None and d not in kwargs['subkeys']:
+            continue
+        if d != 'X' and not h5_selected('data/' + d, **kwargs):
+            continue
+        with profiling.stage(kwargs.get('profile'), 'read/data/' + d, data, d):
+            to_data[d] = h5_to_matrix(h5mat=data[d], backed=kwargs.get('backed', False), obs_indices=kwargs.get('obs_indices'),
+                                      var_indices=(kwargs.get('var_indices') or {}).get(d), dtype=kwargs.get('dtype'),
+                                      mmap=kwargs.get('mmap', False))
     return(to_data)
 
-def to_var_(h5):
+def to_var_(h5, **kwargs):
     """
 
     The h5 group 'var' will be converted pandas.core.frame.DataFrame
@@ -292,6 +1012,7 @@ def to_var_(h5):
     Parameters:
     ----------
     h5: The h5py.File
+    kwargs: The reading options passed from read_h5, such as 'backed', 'obs_indices', 'var_indices', 'include' and 'exclude'
     
     return The dict repesenting 'var'
     ----------
@@ -299,11 +1020,14 @@ def to_var_(h5):
     """
     to_var = {}
     var=h5['var']
+    var_indices = kwargs.get('var_indices') or {}
     for v in var.keys():
-        to_var[v] = h5_to_df(h5df=var[v])
+        to_var[v] = h5_to_df(h5df=var[v], string_dtype=kwargs.get('string_dtype', 'object'))
+        if var_indices.get(v) is not None:
+            to_var[v] = to_var[v].iloc[var_indices[v]]
     return(to_var)
 
-def to_graphs_(h5):
+def to_graphs_(h5, **kwargs):
     """
 
     The h5 group 'graphs' will be converted dictionary-like object
@@ -311,6 +1035,7 @@ def to_graphs_(h5):
     Parameters:
     ----------
     h5: The h5py.File
+    kwargs: The reading options passed from read_h5, such as 'backed', 'obs_indices', 'var_indices', 'include' and 'exclude'
     
     return The dict repesenting 'graphs'
     ----------
@@ -319,11 +1044,17 @@ def to_graphs_(h5):
     to_graphs = {}
     graphs = h5['graphs']
     neig = {"knn": "distances", "snn": "connectivities"}
+    obs_indices = kwargs.get('obs_indices')
     for g in neig.keys():
-        to_graphs[neig[g]] = h5_to_matrix(h5mat=graphs[g])
+        if not h5_selected('graphs/' + g, **kwargs):
+            continue
+        with profiling.stage(kwargs.get('profile'), 'read/graphs/' + g, graphs, g):
+            to_graphs[neig[g]] = h5_to_matrix(h5mat=graphs[g], obs_indices=obs_indices, dtype=kwargs.get('dtype'))
+            if obs_indices is not None:
+                to_graphs[neig[g]] = to_graphs[neig[g]][:, obs_indices]
     return(to_graphs)
 
-def to_layers_(h5):
+def to_layers_(h5, **kwargs):
     """
 
     The h5 group 'layers' will be converted dictionary-like object
@@ -331,6 +1062,7 @@ def to_layers_(h5):
     Parameters:
     ----------
     h5: The h5py.File
+    kwargs: The reading options passed from read_h5, such as 'backed', 'obs_indices', 'var_indices', 'include', 'exclude' and 'subkeys'
     
     return The dict repesenting 'layers'
     ----------
@@ -339,10 +1071,17 @@ def to_layers_(h5):
     to_layers = {}
     layers = h5['layers']
     for l in layers.keys():
-        to_layers[l] = h5_to_matrix(h5mat=layers[l])
+        if kwargs.get('subkeys') is not None and l not in kwargs['subkeys']:
+            continue
+        if not h5_selected('layers/' + l, **kwargs):
+            continue
+        with profiling.stage(kwargs.get('profile'), 'read/layers/' + l, layers, l):
+            to_layers[l] = h5_to_matrix(h5mat=layers[l], backed=kwargs.get('backed', False), obs_indices=kwargs.get('obs_indices'),
+                                         var_indices=(kwargs.get('var_indices') or {}).get('X'), dtype=kwargs.get('dtype'),
+                                         mmap=kwargs.get('mmap', False))
     return(to_layers)
 
-def to_varm_(h5):
+def to_varm_(h5, **kwargs):
     """
 
     The h5 group 'varm' will be converted dictionary-like object
@@ -350,6 +1089,7 @@ def to_varm_(h5):
     Parameters:
     ----------
     h5: The h5py.File
+    kwargs: The reading options passed from read_h5, such as 'backed', 'obs_indices', 'var_indices', 'include' and 'exclude'
     
     return The dict repesenting 'varm'
     ----------
@@ -357,11 +1097,19 @@ def to_varm_(h5):
     """
     to_varm = {}
     varm = h5['varm']
+    var_indices = (kwargs.get('var_indices') or {}).get('X')
     for v in varm.keys():
-        to_varm[v] = varm[v][()]
+        if not h5_selected('varm/' + v, **kwargs):
+            continue
+        if var_indices is not None:
+            to_varm[v] = h5_take_rows(h5dset=varm[v], rows=var_indices)
+        else:
+            to_varm[v] = h5_mmap(h5dset=varm[v]) if kwargs.get('mmap', False) else None
+            if to_varm[v] is None:
+                to_varm[v] = varm[v][()]
     return(to_varm)
 
-def to_uns_(h5):
+def to_uns_(h5, **kwargs):
     """
 
     The h5 group 'uns' will be converted dictionary-like object
@@ -369,6 +1117,7 @@ def to_uns_(h5):
     Parameters:
     ----------
     h5: The h5py.File
+    kwargs: The reading options passed from read_h5, such as 'backed', 'obs_indices', 'var_indices', 'include' and 'exclude'
     
     return The dict repesenting 'uns'
     ----------
@@ -377,10 +1126,11 @@ def to_uns_(h5):
     to_uns = {}
     uns = h5['uns']
     for u in uns.keys():
-        to_uns[u] = uns[u][()]
+        if h5_selected('uns/' + u, **kwargs):
+            to_uns[u] = uns[u][()]
     return(to_uns)
 
-def switch(h5key, h5):
+def switch(h5key, h5, **kwargs):
     """
 
     The switch function
@@ -389,6 +1139,7 @@ def switch(h5key, h5):
     ----------
     h5: The h5py.File
     h5keys: The keys of h5py.File
+    kwargs: The reading options passed from read_h5, such as 'backed', 'obs_indices', 'var_indices', 'include', 'exclude' and 'profile'
     
     return all object of existing h5 group
     ----------
@@ -404,7 +1155,93 @@ def switch(h5key, h5):
            'uns':to_uns_,
            'varm':to_varm_}
     method = swi.get(h5key)
-    return(method(h5))
+    with profiling.stage(kwargs.get('profile'), 'read/' + h5key, h5, h5key):
+        return(method(h5, **kwargs))
+
+
+def read_h5_group(file: str,
+                  h5key: str,
+                  **kwargs):
+    """
+
+    The h5 group is read with the separate file handle, which is used by the workers of h5_to_adata(n_jobs=...)
+    
+    Parameters:
+    ----------
+    file: The h5 file
+    h5key: The key of the h5 group
+    kwargs: The reading options passed to switch, such as 'subkeys' denoting the matrices read from 'data' and 'layers'
+    
+    return the object of the h5 group, and the records of the worker when 'profile' is given
+    ----------
+
+    """
+    with h5py.File(name=file, mode='r') as h5:
+        res = switch(h5key, h5, **kwargs)
+    if kwargs.get('profile') is not None:
+        # the profile of the worker is a copy, its records are sent back
+        return res, kwargs['profile'].records
+    return res
+
+
+def switch_parallel(h5, n_jobs, **kwargs):
+    """
+
+    The h5 groups are read concurrently by n_jobs processes, each process opening its own file handle. 
+    The matrices of 'data' and 'layers' are read as the separate tasks.
+    
+    Parameters:
+    ----------
+    h5: The h5py.File
+    n_jobs: The number of processes
+    kwargs: The reading options passed from read_h5, such as 'backed', 'obs_indices', 'var_indices', 'include' and 'exclude'
+    
+    return the dict of all objects of existing h5 group
+    ----------
+
+    """
+    adata_dict = {}
+    tasks = []
+    mmap = kwargs.get('mmap', False)
+    for h5key in h5.keys():
+        if h5key not in ['obs', 'var', 'data'] and not h5_selected(h5key, **kwargs):
+            continue
+        if h5key in ['data', 'layers']:
+            adata_dict[h5key] = {}
+            if kwargs.get('backed', False):
+                # the backed matrices read from the file handle of the main process
+                adata_dict[h5key] = switch(h5key, h5, **kwargs)
+            else:
+                for k in h5[h5key].keys():
+                    if (h5key, k) != ('data', 'X') and not h5_selected(h5key + '/' + k, **kwargs):
+                        continue
+                    if mmap and h5_attr_str(h5[h5key][k].attrs['datatype']) == 'Array':
+                        # the memmap is mapped by the main process, the worker would send back the full copy
+                        adata_dict[h5key].update(switch(h5key, h5, **dict(kwargs, subkeys=[k])))
+                    else:
+                        tasks.append((h5key, k))
+        elif mmap and h5key in ['dimR', 'varm']:
+            adata_dict[h5key] = switch(h5key, h5, **kwargs)
+        else:
+            tasks.append((h5key, None))
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = []
+        for h5key, subkey in tasks:
+            if subkey is None:
+                futures.append(pool.submit(read_h5_group, h5.filename, h5key, **kwargs))
+            else:
+                futures.append(pool.submit(read_h5_group, h5.filename, h5key, subkeys=[subkey], **kwargs))
+        for (h5key, subkey), fu in zip(tasks, futures):
+            res = fu.result()
+            if kwargs.get('profile') is not None:
+                res, records = res
+                kwargs['profile'].extend(records)
+            if subkey is None:
+                adata_dict[h5key] = res
+            else:
+                adata_dict[h5key].update(res)
+    return adata_dict
+
 
 
 
@@ -462,7 +1299,18 @@ def switch(h5key, h5):
 
 ### h5 file convert to the h5 file 
 def h5_to_adata(h5: h5py.File = None,
-                assay_name: Union[str, None] = None
+                assay_name: Union[str, None] = None,
+                backed: bool = False,
+                obs_indices: Union[np.ndarray, list, None] = None,
+                obs_mask: Union[np.ndarray, list, None] = None,
+                var_names: Union[np.ndarray, list, None] = None,
+                dtype = None,
+                n_jobs: int = 1,
+                include: Union[list, None] = None,
+                exclude: Union[list, None] = None,
+                string_dtype: str = 'object',
+                mmap: bool = False,
+                profile = None
                 ) -> anndata.AnnData:
     """
 
@@ -474,6 +1322,18 @@ def h5_to_adata(h5: h5py.File = None,
     assy_name : Denotes which omics data to save. Default is 'RNA'. Available options are:
         'RNA': means that this omics data is scRNA-seq data
         'spatial': means that this omics data is spatial data generated by 10x Genomics Visium toolkits
+    backed : Default is False. True means that the sparse 'X', 'raw.X' and 'layers' are the H5CSRMatrix reading from the h5 file.
+             The h5 file should be kept open while the adata is used.
+    obs_indices : The integer positions of the cells to read. Default is None, reading all cells.
+    obs_mask : The boolean array of the cells to read, as an alternative to obs_indices.
+    var_names : The gene names to read. Default is None, reading all genes.
+    dtype : The dtype of the matrices. Default is None, keeping the saved dtype.
+    n_jobs : The number of processes reading the h5 groups concurrently. Default is 1. -1 means using all CPUs.
+    include : The nested keys of the h5 groups and datasets to read. Default is None, reading all. 'obs', 'var' and 'data/X' are always read.
+    exclude : The nested keys of the h5 groups and datasets not to read. Default is None.
+    string_dtype : The dtype of the obs_names, var_names and the category levels. Default is 'object'.
+    mmap : Default is False. True means that the contiguous uncompressed 'dimR', 'varm' and the 'Array' matrices are numpy.memmap.
+    profile : The diopy.profiling.Profile recording each h5 group and matrix. Default is None, not profiling.
     
     return anndata.AnnData
     ----------
@@ -495,13 +1355,26 @@ def h5_to_adata(h5: h5py.File = None,
     #--- obs,var,rawData,nomData, dimR read into the python
     if assayname == np.array([assay_name]):
         adata_dict = {}
-        for h5key in h5.keys():
-            adata_dict[h5key] = switch(h5key, h5)
+        obs_indices = obs_to_indices(n_obs=h5['obs']['index'].shape[0], obs_indices=obs_indices, obs_mask=obs_mask)
+        var_indices = None
+        if var_names is not None:
+            var_indices = {v: var_to_indices(h5df=h5['var'][v], var_names=var_names, strict=(v == 'X')) for v in h5['var'].keys()}
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+        if n_jobs > 1:
+            adata_dict = switch_parallel(h5, n_jobs, backed=backed, obs_indices=obs_indices, var_indices=var_indices, dtype=dtype,
+                                         include=include, exclude=exclude, string_dtype=string_dtype, mmap=mmap, profile=profile)
+        else:
+            for h5key in h5.keys():
+                if h5key not in ['obs', 'var', 'data'] and not h5_selected(h5key, include=include, exclude=exclude):
+                    continue
+                adata_dict[h5key] = switch(h5key, h5, backed=backed, obs_indices=obs_indices, var_indices=var_indices, dtype=dtype,
+                                           include=include, exclude=exclude, string_dtype=string_dtype, mmap=mmap, profile=profile)
         # adata_dict = h5_to_dict(h5=h5)
         if (np.isin(['X','rawX'],list(adata_dict['data'].keys()))).all():
             adata = anndata.AnnData(X=adata_dict['data']['X'], obs=adata_dict['obs'], var=adata_dict['var']['X'])
-            adata_raw = anndata.AnnData(X=adata_dict['data']['rawX'], obs=adata_dict['obs'], var=adata_dict['var']['rawX'])
-            adata.raw = adata_raw
+            # the Raw is built on the matrix directly, setting adata.raw copies the matrix, which reads the backed matrix into memory
+            adata._raw = anndata.Raw(adata, X=adata_dict['data']['rawX'], var=adata_dict['var']['rawX'])
         else:
             adata = anndata.AnnData(X=adata_dict['data']['X'], obs=adata_dict['obs'], var=adata_dict['var']['X'])
         if 'dimR' in adata_dict.keys():
@@ -516,9 +1389,12 @@ def h5_to_adata(h5: h5py.File = None,
             adata.varm = adata_dict['varm']
         if 'uns' in adata_dict.keys():
             adata.uns = adata_dict['uns']
-        if assay_name == 'spatial':
+        if assay_name == 'spatial' and assay_name in adata_dict.keys():
             v1 = ['in_tissue','array_row','array_col']
             for spk in adata_dict[assay_name].keys():
+                if 'coor' not in adata_dict[assay_name][spk].keys():
+                    adata.uns[assay_name] = adata_dict[assay_name]
+                    continue
                 obs_sp = pd.concat([adata_dict[assay_name][spk]['coor'][v1], adata.obs[adata.obs.columns[~adata.obs.columns.isin(v1)]]], axis=1)
                 adata.obs = obs_sp
                 adata.obsm[assay_name] = adata_dict[assay_name][spk]['coor'][['image_1','image_2']].values
@@ -532,7 +1408,10 @@ def h5_to_adata(h5: h5py.File = None,
 # read the R rds file 
 def read_rds(file: Union[str, None] = None,
              object_type:str = 'seurat',
-             assay_name: str = 'RNA'
+             assay_name: str = 'RNA',
+             tmp_dir: Union[str, None] = None,
+             cache_dir: Union[str, None] = None,
+             stats = None
             ) -> anndata.AnnData:
     """
 
@@ -547,6 +1426,12 @@ def read_rds(file: Union[str, None] = None,
     assy_name : Denotes which omics data to save. Default is 'RNA'. Available options are:
         'RNA': means that this omics data is scRNA-seq data
         'spatial': means that this omics data is spatial data generated by 10x Genomics Visium toolkits
+    tmp_dir : The scratch directory of the intermediate h5 file, which is removed after reading. Default is None, the environment 
+              variable DIOPY_TMPDIR, else the RAM-backed /dev/shm when it has the space, else the temporary directory of the system, 
+              see diopy.rworker.scratch_dir
+    cache_dir : Default is None, not caching. The cache directory keeps the h5 file converted by R, keyed by the content hash of the rds file, 
+                object_type, assay_name and the diopy version, so reading the unchanged rds file again skips R. See diopy.cache.ConversionCache
+    stats : Default is None, not profiling. diopy.profiling.Profile or a callable records the R conversion and the stages of read_h5
     
     return anndata.AnnData
     ----------
@@ -555,17 +1440,31 @@ def read_rds(file: Union[str, None] = None,
     ------
     >>> import diopy
     >>> adata = diopy.input.read_rds(file='scdata.rds', assay_name='RNA', object_type='seurat')
-    >>>
+    >>> adata = diopy.input.read_rds(file='scdata.rds', cache_dir='~/.cache/diopy')
 
     -----
 
+    Note: The R worker is started at the first call and reused by the following calls. The error of R is raised as diopy.rworker.RWorkerError.
+    The number of the R workers running at the same time is set by diopy.rworker.get_pool(size=...).
+
     """
-    # osr = os.path.join(os.path.dirname(__file__), '/R/diopyR.R')
-    current_path = os.path.abspath(__file__)
-    diopyr_file= os.path.abspath(os.path.dirname(current_path) + os.path.sep + ".") + '/R/diopyR.R'
-    os.system('Rscript ' + diopyr_file +' -r '+ file +' -t '+ object_type+' -a '+assay_name)
-    tmp = re.sub('.rds', '_tmp.h5', file)
-    adata = read_h5(file =tmp, assay_name = assay_name)
+    # the rds file is converted by the persistent R worker, see diopy.rworker.get_pool for the number of workers
+    file = os.path.abspath(file)
+    profile = profiling.as_profile(stats)
+    if cache_dir is not None:
+        conv_cache = cache.ConversionCache(cache_dir)
+        with profiling.stage(profile, 'cache/hash', file=file):
+            key = conv_cache.key(file, command='rds_to_h5', object_type=object_type, assay_name=assay_name)
+        hit = conv_cache.get(key, suffix='.h5')
+        if hit is not None:
+            return read_h5(file=hit, assay_name=assay_name, stats=profile)
+    # the rds file is compressed, the h5 file written by R is expected to be a few times larger
+    with rworker.tmp_h5(tmp_dir=tmp_dir, size=4 * os.path.getsize(file)) as tmp:
+        with profiling.stage(profile, 'R/rds_to_h5', file=tmp):
+            rworker.get_pool().run('rds_to_h5', file, tmp, object_type, assay_name)
+        if cache_dir is not None:
+            conv_cache.put(key, suffix='.h5', file=tmp)
+        adata = read_h5(file =tmp, assay_name = assay_name, stats=profile)
     return adata
 
 #--- To be continues
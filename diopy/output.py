@@ -20,8 +20,18 @@ import anndata
 from pandas.api.types import is_string_dtype, is_categorical_dtype, is_bool_dtype, is_float_dtype, is_integer_dtype, is_object_dtype
 import h5py
 from typing import Union
+from collections.abc import Mapping
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import zlib
+import warnings
 import re
 import os
+import shutil
+from . import rworker
+from . import cache
+from . import profiling
+from .input import h5_attr_str, h5_to_df, h5_to_matrix, h5_csr_rows
 
 from scipy.sparse.sputils import matrix
 
@@ -30,7 +40,19 @@ def write_h5(adata: anndata.AnnData,
              file: Union[str, None] = None,
              assay_name: str = 'RNA',
              save_X:bool = True,
-             save_graph:bool = True
+             save_graph:bool = True,
+             csc_index:bool = False,
+             block_rows:int = 10000,
+             compression = None,
+             compression_opts = None,
+             chunks:Union[bool, int, None] = None,
+             shuffle:bool = False,
+             dtype = np.float32,
+             n_jobs:int = 1,
+             string_encoding:str = 'vlen',
+             layout:Union[str, None] = 'csr',
+             resizable:bool = False,
+             stats = None
              ) -> None:
     """
     The adata object is converted to H5 file that R can read
@@ -48,12 +70,48 @@ def write_h5(adata: anndata.AnnData,
              save_X will be unvalid and adata.X will be saved by defualt when adata.raw is None.
     save_graph : Default is True, determing whether to save the graph(cell-cell similarity network). scanpy graph is different from seruat graph. Their relationship are 
                  set {"distances": "knn", "connectivities": "snn"} roughly.
+    csc_index : Default is False. True means that a column-major copy of the sparse 'X' and 'rawX' is also saved in the group 'csc' 
+                next to 'values', 'indices' and 'indptr', so that diopy.input.read_h5(var_names=...) reads a few genes quickly. 
+                The copy doubles the space of the sparse matrices.
+    block_rows : The number of rows converted and written at a time for each matrix. Default is 10000. The smaller block_rows, the lower peak memory 
+                 during writing.
+    compression : Default is None, saving the uncompressed data. Available options are 'gzip', 'lzf', the gzip level 0-9 and the filters 
+                  of hdf5plugin, such as hdf5plugin.Blosc(). It is applied to all datasets of obs, var, data, layers, dimR, graphs, varm, uns and spatial.
+                  The R package dior reads 'gzip' by default; 'lzf' and the hdf5plugin filters need the plugins in the R hdf5 library.
+    compression_opts : The compression options, such as the gzip level 4
+    chunks : Default is None, chunking only the compressed datasets by the chunk of about 1MB holding the whole rows. True means chunking all
+             datasets, and the integer means the target bytes of a chunk.
+    shuffle : Default is False, determing whether to use the shuffle filter, which helps the compression of the integer indices
+    dtype : The dtype of the matrices, 'dimR' and 'varm'. Default is numpy.float32. 'preserve' means keeping the original dtype, and the 
+            integer-valued data such as the raw counts is saved as the narrowest integer type(int8, uint8, int16, uint16 or int32), which is 
+            much smaller and faster to load.
+    n_jobs : The number of processes compressing the chunks of 'X', 'rawX', 'layers' and 'graphs' in parallel when compression is 'gzip'.
+             Default is 1. -1 means using all CPUs. The compressed chunks are written by the main process as the standard gzip chunks, 
+             so the file is the same as the one written with n_jobs=1 for the R package dior.
+    string_encoding : The encoding of the obs_names, var_names, colnames and category levels. Default is 'vlen', the variable-length strings. 
+                      'fixed' means the fixed-width UTF-8 strings, which are much faster to write and read for millions of barcodes 
+                      and are read by R as the character vector as well.
+    layout : The layout of the sparse matrices. Default is 'csr', the row-major cells x genes that R reads as the column-major dgCMatrix 
+             of genes x cells without transposing, the csc matrix being converted once. None means keeping the layout of each matrix
+             without the conversion, the csc matrix being saved column-major with the attribute layout='csc'. The R package dior ignores
+             the attribute, so the file with the column-major matrices can be read by diopy only.
+    resizable : Default is False. True means that the datasets are chunked with the unlimited first dimension, so that append_h5 
+                extends them in place. Otherwise the first append_h5 rebuilds each dataset once as the resizable one.
+    stats : Default is None, not profiling. diopy.profiling.Profile collects the elapsed seconds, the bytes written and the peak memory 
+            of each h5 group and matrix, and a callable is called with each record. The records are also logged by the logger 'diopy' 
+            at the DEBUG level.
     ----------
 
     Usage:
     -----
     >>> import diopy
     >>> diopy.output.write_h5(adata = adata, file='scdata.h5',save_raw=True,save_graph=True)
+    >>> diopy.output.write_h5(adata = adata, file='scdata.h5', csc_index=True)
+    >>> diopy.output.write_h5(adata = adata, file='scdata.h5', compression='gzip', compression_opts=4, shuffle=True)
+    >>> diopy.output.write_h5(adata = adata, file='scdata.h5', dtype='preserve')
+    >>> diopy.output.write_h5(adata = adata, file='scdata.h5', compression='gzip', n_jobs=8)
+    >>> diopy.output.write_h5(adata = adata, file='scdata.h5', stats=diopy.profiling.Profile(callback=print))
+    >>> diopy.output.write_h5(adata = adata, file='atlas.h5', compression='gzip', resizable=True)
     -----
     """
     # glabol function
@@ -63,10 +121,16 @@ def write_h5(adata: anndata.AnnData,
         raise OSError("No such file or directory")
     if not isinstance(adata, anndata.AnnData):
         raise TypeError("object '%s' class is not anndata.AnnData object" % namestr(adata, globals())[0])
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    profile = profiling.as_profile(stats)
     # w Create file, truncate if exists
     h5 = h5py.File(name=file, mode="w")
     try:
-        adata_to_h5(adata=adata, h5=h5,assay_name=assay_name,save_X=save_X,save_graph=save_graph)
+        with profiling.stage(profile, 'write_h5', h5, '/'):
+            adata_to_h5(adata=adata, h5=h5,assay_name=assay_name,save_X=save_X,save_graph=save_graph,csc_index=csc_index,
+                        block_rows=block_rows, dtype=dtype, n_jobs=n_jobs, string_encoding=string_encoding, layout=layout, profile=profile,
+                        compression=compression, compression_opts=compression_opts, chunks=chunks, shuffle=shuffle, resizable=resizable)
         h5.attrs['assay_name'] = np.array([assay_name], dtype=h5py.special_dtype(vlen=str))
     except Exception as e:
         print('Error:', e)
@@ -80,7 +144,15 @@ def adata_to_h5(adata: anndata.AnnData,
                 h5: h5py.File,
                 assay_name: Union[str, None] = 'RNA',
                 save_graph:bool = False,
-                save_X:bool = False
+                save_X:bool = False,
+                csc_index:bool = False,
+                block_rows:int = 10000,
+                dtype = np.float32,
+                n_jobs:int = 1,
+                string_encoding:str = 'vlen',
+                layout: Union[str, None] = 'csr',
+                profile = None,
+                **kwargs
                 ) -> None:
     """
     The adata object is converted to H5 file that R can read
@@ -122,6 +194,16 @@ def adata_to_h5(adata: anndata.AnnData,
                when adata.X.shape == adata.raw.X.shape. True: save adata.raw.X in any case. Fasle: save adata.X in any case.
     save_graph : Default is False , determing whether to save the graph(cell-cell similarity network). scanpy graph is different from seruat graph. Their relationship are 
                  set {"distances": "knn", "connectivities": "snn"} roughly.
+    csc_index : Default is False, determing whether to save the column-major copy of the sparse 'X' and 'rawX'
+    block_rows : The number of rows converted and written at a time for each matrix. Default is 10000
+    dtype : The dtype of the matrices, 'dimR' and 'varm'. Default is numpy.float32. 'preserve' means keeping the original dtype and 
+            saving the integer-valued data as the narrowest integer type
+    n_jobs : The number of processes compressing the gzip chunks of the matrices in parallel. Default is 1
+    string_encoding : The encoding of the index, colnames and category levels of obs and var. Default is 'vlen'
+    layout : The layout of the sparse matrices, see matrix_to_h5. Default is 'csr', which R reads without transposing. The file with 
+             the column-major matrices(None or 'csc') can be read by diopy only
+    profile : The diopy.profiling.Profile recording each h5 group and matrix. Default is None, not profiling.
+    kwargs : The dataset options passed to create_dataset, such as compression, compression_opts, chunks, shuffle and resizable
     ----------
 
     Usage:
@@ -135,28 +217,38 @@ def adata_to_h5(adata: anndata.AnnData,
     data = h5.create_group('data')
     var = h5.create_group('var')
     # --- save the data if adata.raw exists
-    df_to_h5(df=adata.obs, h5=h5, gr_name='obs') # save the obs
+    with profiling.stage(profile, 'write/obs', h5, 'obs'):
+        df_to_h5(df=adata.obs, h5=h5, gr_name='obs', string_encoding=string_encoding, **kwargs) # save the obs
     if not adata_raw is None:    
         if save_X:
             # save as X (scale)
-            matrix_to_h5(mat=adata.X, h5=data, gr_name='X')
-            df_to_h5(df=adata.var, h5=var, gr_name='X')
+            with profiling.stage(profile, 'write/data/X', data, 'X'):
+                matrix_to_h5(mat=adata.X, h5=data, gr_name='X', csc_index=csc_index, block_rows=block_rows, dtype=dtype, n_jobs=n_jobs, layout=layout, **kwargs)
+            with profiling.stage(profile, 'write/var/X', var, 'X'):
+                df_to_h5(df=adata.var, h5=var, gr_name='X', string_encoding=string_encoding, **kwargs)
             # save as rawX (data)
-            matrix_to_h5(mat=adata_raw.X, h5=data, gr_name='rawX')
-            df_to_h5(df=adata_raw.var, h5=var, gr_name='rawX')
+            with profiling.stage(profile, 'write/data/rawX', data, 'rawX'):
+                matrix_to_h5(mat=adata_raw.X, h5=data, gr_name='rawX', csc_index=csc_index, block_rows=block_rows, dtype=dtype, n_jobs=n_jobs, layout=layout, **kwargs)
+            with profiling.stage(profile, 'write/var/rawX', var, 'rawX'):
+                df_to_h5(df=adata_raw.var, h5=var, gr_name='rawX', string_encoding=string_encoding, **kwargs)
         else:
             # save as X (data)
-            matrix_to_h5(mat=adata_raw.X, h5=data, gr_name='X')
-            df_to_h5(df=adata_raw.var, h5=var, gr_name='X')
+            with profiling.stage(profile, 'write/data/X', data, 'X'):
+                matrix_to_h5(mat=adata_raw.X, h5=data, gr_name='X', csc_index=csc_index, block_rows=block_rows, dtype=dtype, n_jobs=n_jobs, layout=layout, **kwargs)
+            with profiling.stage(profile, 'write/var/X', var, 'X'):
+                df_to_h5(df=adata_raw.var, h5=var, gr_name='X', string_encoding=string_encoding, **kwargs)
     else:
-        matrix_to_h5(mat=adata.X, h5=data, gr_name='X')
-        df_to_h5(df=adata.var,h5=var, gr_name='X')
+        with profiling.stage(profile, 'write/data/X', data, 'X'):
+            matrix_to_h5(mat=adata.X, h5=data, gr_name='X', csc_index=csc_index, block_rows=block_rows, dtype=dtype, n_jobs=n_jobs, layout=layout, **kwargs)
+        with profiling.stage(profile, 'write/var/X', var, 'X'):
+            df_to_h5(df=adata.var,h5=var, gr_name='X', string_encoding=string_encoding, **kwargs)
     #--- save the dimension reduction
     if len(adata.obsm.keys())>0:
         dimR = h5.create_group('dimR')
         for k in [k for k in adata.obsm.keys()]:
             K = re.sub("^.*_", "", k).upper()
-            dimR.create_dataset(K, data=adata.obsm[k], dtype=np.float32)
+            with profiling.stage(profile, 'write/dimR/' + K, dimR, K):
+                create_dataset(h5=dimR, name=K, data=adata.obsm[k], dtype=storage_dtype(data=adata.obsm[k], dtype=dtype), **kwargs)
     if save_graph:
         
         gr = adata.obsp
@@ -165,34 +257,459 @@ def adata_to_h5(adata: anndata.AnnData,
             gra_dict = {"distances": "knn", "connectivities": "snn"}
         #--- save the neighbor graphs
             for g in gra_dict.keys():
-                matrix_to_h5(mat=gr[g], h5=graphs, gr_name=gra_dict[g])
+                with profiling.stage(profile, 'write/graphs/' + gra_dict[g], graphs, gra_dict[g]):
+                    matrix_to_h5(mat=gr[g], h5=graphs, gr_name=gra_dict[g], block_rows=block_rows, dtype=dtype, n_jobs=n_jobs, layout=layout, **kwargs)
     if assay_name == 'spatial':
-        spatial_to_h5(adata=adata, h5=h5, gr_name=assay_name)
+        with profiling.stage(profile, 'write/spatial', h5, 'spatial'):
+            spatial_to_h5(adata=adata, h5=h5, gr_name=assay_name, string_encoding=string_encoding, **kwargs)
     # only save the uns color
-    uns = h5.create_group('uns')
-    for c in adata.uns_keys():
-        if 'colors' in c:
-            # uns.create_dataset(c, data=adata.uns[c])
-            uns.create_dataset(c,data=np.array(adata.uns[c]).astype(np.object))
+    with profiling.stage(profile, 'write/uns', h5, 'uns'):
+        uns = h5.create_group('uns')
+        for c in adata.uns_keys():
+            if 'colors' in c:
+                # uns.create_dataset(c, data=adata.uns[c])
+                create_dataset(h5=uns, name=c, data=np.array(adata.uns[c]).astype(np.object), **kwargs)
     # save the layers for the some data type, this dim is same as the X, and the varm gene same as the X
     if save_X:
         if len(adata.layers.keys())>0: 
             layers = h5.create_group('layers')
             for l in adata.layers.keys():
-                matrix_to_h5(mat=adata.layers[l], h5=layers, gr_name=l)
+                with profiling.stage(profile, 'write/layers/' + l, layers, l):
+                    matrix_to_h5(mat=adata.layers[l], h5=layers, gr_name=l, block_rows=block_rows, dtype=dtype, n_jobs=n_jobs, layout=layout, **kwargs)
         if len(adata.varm.keys())>0:
-            varm = h5.create_group('varm')
-            for j in adata.varm.keys():
-                varm.create_dataset(j, data=adata.varm[j], dtype=np.float32)
+            with profiling.stage(profile, 'write/varm', h5, 'varm'):
+                varm = h5.create_group('varm')
+                for j in adata.varm.keys():
+                    create_dataset(h5=varm, name=j, data=adata.varm[j], dtype=storage_dtype(data=adata.varm[j], dtype=dtype), **kwargs)
     return
 #--- To be continued
 
 
+def append_h5(adata: anndata.AnnData,
+              file: Union[str, None] = None,
+              stats = None,
+              **kwargs
+              ) -> None:
+    """
+    The cells of the adata object are appended to the h5 file written by write_h5, without rewriting the cells saved before. 
+    'obs', the matrices of 'data', 'dimR' and 'layers' are extended in place, and the levels of the category columns of 'obs' are merged. 
+    The time is proportional to the appended cells when the file is written with resizable=True. Otherwise the first append_h5 
+    rebuilds each dataset once as the resizable one.
+
+    Parameters:
+    ----------
+    adata : anndata.AnnData, whose genes are the genes of the file in any order, and whose obs columns, obsm and layers 
+            are the ones saved in the file. When the file has 'rawX', adata.raw is needed and is appended to 'rawX'.
+    file : The h5 file
+    stats : Default is None, not profiling. diopy.profiling.Profile or a callable records each appended h5 group and matrix
+    kwargs : The compression options, such as compression, compression_opts and shuffle, of the datasets rebuilt as resizable which 
+             are not compressed, such as the small obs columns. Default is the compression of 'data/X'
+    ----------
+
+    Note:
+    -----
+    The cell-cell graphs 'graphs' and the column-major copies 'csc' of the matrices can not be extended in place, they are removed.
+    The spatial data and the column-major matrices(layout='csc') are not supported. All checks are done before the file is changed.
+
+    Usage:
+    -----
+    >>> import diopy
+    >>> diopy.output.write_h5(adata = sample1, file='atlas.h5', compression='gzip', resizable=True)
+    >>> diopy.output.append_h5(adata = sample2, file='atlas.h5')
+    -----
+    """
+    if file is None:
+        raise OSError("No such file or directory")
+    if not isinstance(adata, anndata.AnnData):
+        raise TypeError("adata is not anndata.AnnData object")
+    profile = profiling.as_profile(stats)
+    with h5py.File(name=file, mode='r+') as h5:
+        #--- check the file and the adata before changing the file
+        if 'spatial' in h5.keys():
+            raise ValueError("Appending the spatial data is not supported")
+        mats = {'X': (adata.X, adata.var_names)}
+        if 'rawX' in h5['data'].keys():
+            if adata.raw is None:
+                raise ValueError("The file has 'rawX', adata.raw is needed")
+            mats['rawX'] = (adata.raw.X, adata.raw.var_names)
+        # the positions of the genes of the file in the adata, None when the genes are in the same order
+        cols = {}
+        for d, (mat, var_names) in mats.items():
+            if h5_attr_str(h5['data'][d].attrs.get('layout', 'csr')) == 'csc':
+                raise ValueError("The column-major matrix 'data/%s' can not be appended, write it with layout='csr'" % d)
+            genes = pd.Index(h5_str_values(h5['var'][d]['index']))
+            var_names = pd.Index(np.asarray(var_names).astype(str))
+            if genes.equals(var_names):
+                cols[d] = None
+            elif len(genes) == len(var_names) and genes.isin(var_names).all():
+                cols[d] = var_names.get_indexer(genes)
+            else:
+                raise ValueError("The genes of adata are not the genes of 'var/%s' in the file" % d)
+        obs_cols = set(h5_str_values(h5['obs']['colnames'])) if 'colnames' in h5['obs'].keys() else set()
+        if obs_cols != set(adata.obs.columns.astype(str)):
+            raise ValueError("The obs columns of adata are not the columns of 'obs' in the file: %s" 
+                             % ', '.join(sorted(obs_cols.symmetric_difference(adata.obs.columns.astype(str)))[:10]))
+        obsm = {re.sub("^.*_", "", k).upper(): k for k in adata.obsm.keys()}
+        dimr_keys = list(h5['dimR'].keys()) if 'dimR' in h5.keys() else []
+        layer_keys = list(h5['layers'].keys()) if 'layers' in h5.keys() else []
+        missing = [k for k in dimr_keys if k not in obsm] + [l for l in layer_keys if l not in adata.layers.keys()]
+        if len(missing) > 0:
+            raise ValueError("The obsm or layers of adata are missing: %s" % ', '.join(missing))
+        for k in dimr_keys:
+            if tuple(adata.obsm[obsm[k]].shape[1:]) != h5['dimR'][k].shape[1:]:
+                raise ValueError("The shape of adata.obsm['%s'] does not match 'dimR/%s'" % (obsm[k], k))
+        for l in layer_keys:
+            if h5_attr_str(h5['layers'][l].attrs.get('layout', 'csr')) == 'csc':
+                raise ValueError("The column-major matrix 'layers/%s' can not be appended, write it with layout='csr'" % l)
+        obs = adata.obs.copy()
+        obs.columns = obs.columns.astype(str)
+        staged = stage_df(df=obs, h5df=h5['obs'])
+        # the small datasets are written uncompressed, they take the compression of the matrix when they are rebuilt as resizable
+        h5x = h5['data']['X']
+        opts = dict(dataset_filters(h5x['values'] if 'values' in h5x.keys() else h5x['matrix']), **kwargs)
+        #--- append the cells, the obs last, whose index is the number of the cells
+        for d, (mat, var_names) in mats.items():
+            with profiling.stage(profile, 'append/data/' + d, h5['data'], d):
+                append_matrix(mat=mat if cols[d] is None else take_columns(mat, cols[d]), h5mat=h5['data'][d], **opts)
+        for k in dimr_keys:
+            with profiling.stage(profile, 'append/dimR/' + k, h5['dimR'], k):
+                data = adata.obsm[obsm[k]]
+                append_dataset(h5=h5['dimR'], name=k, data=data, dtype=append_dtype(h5['dimR'][k], data), **opts)
+        for l in layer_keys:
+            with profiling.stage(profile, 'append/layers/' + l, h5['layers'], l):
+                mat = adata.layers[l]
+                append_matrix(mat=mat if cols['X'] is None else take_columns(mat, cols['X']), h5mat=h5['layers'][l], **opts)
+        with profiling.stage(profile, 'append/obs', h5, 'obs'):
+            commit_df(index=obs.index.astype(str).values, staged=staged, h5df=h5['obs'], **opts)
+        if 'graphs' in h5.keys():
+            del h5['graphs']
+            warnings.warn("The graphs of the cells are removed, which can not be extended in place")
+    return
+
+
+def update_h5(file: Union[str, None] = None,
+              obs: Union[pd.DataFrame, None] = None,
+              obsm: Union[dict, None] = None,
+              uns: Union[dict, None] = None,
+              layers: Union[dict, None] = None,
+              dtype = np.float32,
+              string_encoding: str = 'vlen',
+              layout: str = 'csr',
+              repack: bool = False,
+              **kwargs
+              ) -> None:
+    """
+    The components of the h5 file written by write_h5 are added or replaced in place, the other groups and datasets are not touched. 
+    The file is opened in the 'r+' mode, so updating one obs column or one embedding does not rewrite the matrices.
+
+    Parameters:
+    ----------
+    file : The h5 file
+    obs : The dataframe of the obs columns to add or replace, whose index is the cells of the file. Default is None
+    obsm : The dict of the embeddings to add or replace, such as {'X_umap': umap}, saved in 'dimR' as adata_to_h5 does. Default is None
+    uns : The dict of the uns entries to add or replace, such as {'leiden_colors': colors}. Default is None
+    layers : The dict of the matrices to add or replace in 'layers', with the same shape as 'data/X'. Default is None
+    dtype : The dtype of obsm and layers, see storage_dtype. Default is numpy.float32
+    string_encoding : The encoding of the strings, see str_to_h5. Default is 'vlen'
+    layout : The layout of the sparse layers, see matrix_to_h5. Default is 'csr', the layout read by the R package dior
+    repack : Default is False. HDF5 does not reclaim the space of the replaced datasets, True means that the file is compacted 
+             by repack_h5 after updating, which copies the whole file once
+    kwargs : The dataset options passed to create_dataset, such as compression, compression_opts, chunks and shuffle
+    ----------
+
+    Usage:
+    -----
+    >>> import diopy
+    >>> diopy.output.update_h5(file='scdata.h5', obs=adata.obs[['leiden']], obsm={'X_umap': adata.obsm['X_umap']})
+    >>> diopy.output.update_h5(file='scdata.h5', layers={'counts': adata.layers['counts']}, compression='gzip', repack=True)
+    -----
+    """
+    if file is None:
+        raise OSError("No such file or directory")
+    with h5py.File(name=file, mode='r+') as h5:
+        n_obs, n_vars = int(h5['data']['X']['dims'][0]), int(h5['data']['X']['dims'][1])
+        #--- check the components before changing the file
+        if obs is not None:
+            index = pd.Index(h5_str_values(h5['obs']['index']))
+            if not index.equals(pd.Index(obs.index.astype(str))):
+                raise ValueError("The index of obs is not the cells of the file")
+        for k, v in (obsm or {}).items():
+            if np.shape(v)[0] != n_obs:
+                raise ValueError("obsm['%s'] has %d rows, the file has %d cells" % (k, np.shape(v)[0], n_obs))
+        for l, v in (layers or {}).items():
+            if tuple(v.shape) != (n_obs, n_vars):
+                raise ValueError("layers['%s'] has the shape %s, the file has the shape %s" % (l, tuple(v.shape), (n_obs, n_vars)))
+        #--- replace the datasets
+        if obs is not None:
+            obs = obs.copy()
+            obs.columns = obs.columns.astype(str)
+            h5df = h5['obs']
+            colnames = list(h5_str_values(h5df['colnames'])) if 'colnames' in h5df.keys() else []
+            for k in obs.columns:
+                if k in h5df.keys():
+                    del h5df[k]
+                if 'category' in h5df.keys() and k in h5df['category'].keys():
+                    del h5df['category'][k]
+                col_to_h5(col=obs[k], h5df=h5df, name=k, string_encoding=string_encoding, **kwargs)
+                if k not in colnames:
+                    colnames.append(k)
+            if 'colnames' in h5df.keys():
+                encoding = 'fixed' if h5df['colnames'].dtype.kind == 'S' else 'vlen'
+                del h5df['colnames']
+            else:
+                encoding = string_encoding
+            str_to_h5(h5=h5df, name='colnames', values=np.array(colnames, dtype=str), string_encoding=encoding)
+        if obsm is not None:
+            dimR = h5.require_group('dimR')
+            for k, v in obsm.items():
+                K = re.sub("^.*_", "", k).upper()
+                if K in dimR.keys():
+                    del dimR[K]
+                create_dataset(h5=dimR, name=K, data=v, dtype=storage_dtype(data=v, dtype=dtype), **kwargs)
+        if uns is not None:
+            h5uns = h5.require_group('uns')
+            for u, v in uns.items():
+                if u in h5uns.keys():
+                    del h5uns[u]
+                v = np.array(v)
+                create_dataset(h5=h5uns, name=u, data=v.astype(object) if v.dtype.kind in 'UO' else v, **kwargs)
+        if layers is not None:
+            h5layers = h5.require_group('layers')
+            for l, v in layers.items():
+                if l in h5layers.keys():
+                    del h5layers[l]
+                matrix_to_h5(mat=v, h5=h5layers, gr_name=l, dtype=dtype, layout=layout, **kwargs)
+    if repack:
+        repack_h5(file=file)
+    return
+
+
+def concat_h5(files: list,
+              out_file: Union[str, None] = None,
+              join: str = 'inner',
+              batch_key: Union[str, None] = None,
+              block_rows: int = 10000,
+              string_encoding: str = 'vlen',
+              stats = None,
+              **kwargs
+              ) -> None:
+    """
+    The h5 files written by write_h5 are concatenated by the cells into one h5 file without loading them into memory. The rows of 
+    the matrices of each file are streamed block by block into the output, their gene indices remapped to the merged genes, and 
+    the codes of the category columns of 'obs' are remapped to the merged levels. The memory is bounded by one input file.
+
+    Parameters:
+    ----------
+    files : The list of the h5 files, with the same assay_name
+    out_file : The output h5 file
+    join : Default is 'inner', keeping the genes shared by all files. 'outer' means keeping the genes of any file, 
+           the missing genes being zeros
+    batch_key : The obs column denoting the file of each cell, whose levels are the file names. Default is None, not adding the column
+    block_rows : The number of rows read and written at a time. Default is 10000
+    string_encoding : The encoding of the strings, see str_to_h5. Default is 'vlen'
+    stats : Default is None, not profiling. diopy.profiling.Profile or a callable records each input file
+    kwargs : The dataset options passed to create_dataset, such as compression, compression_opts, chunks and shuffle
+    ----------
+
+    Note:
+    -----
+    'obs' keeps the columns shared by all files, and 'var' keeps the gene names only, as anndata.concat does by default. 
+    'data', 'layers' and 'dimR' keep the matrices and the embeddings shared by all files. 'graphs', 'uns' and 'varm' are not 
+    concatenated, and the spatial data is not supported. The output datasets are resizable, so append_h5 extends it in place.
+
+    Usage:
+    -----
+    >>> import diopy
+    >>> diopy.output.concat_h5(files=['s1.h5', 's2.h5', 's3.h5'], out_file='atlas.h5', join='outer', batch_key='sample', compression='gzip')
+    -----
+    """
+    if out_file is None:
+        raise OSError("No such file or directory")
+    if join not in ['inner', 'outer']:
+        raise ValueError("join should be 'inner' or 'outer', not %s" % join)
+    if len(files) == 0:
+        raise ValueError("No h5 files to concatenate")
+    profile = profiling.as_profile(stats)
+    #--- the genes, the obs columns, the matrices and the embeddings shared by the files
+    assays, genes, obs_cols, data_keys, layer_keys, dimr_shapes = set(), {}, None, None, None, None
+    for f in files:
+        with h5py.File(name=f, mode='r') as h5:
+            if 'spatial' in h5.keys():
+                raise ValueError("Concatenating the spatial data is not supported: %s" % f)
+            assays.add(h5_attr_str(h5.attrs['assay_name']))
+            keys = list(h5['data'].keys())
+            data_keys = keys if data_keys is None else [d for d in data_keys if d in keys]
+            for d in h5['var'].keys():
+                genes.setdefault(d, []).append(pd.Index(h5_str_values(h5['var'][d]['index'])))
+            cols = list(h5_str_values(h5['obs']['colnames'])) if 'colnames' in h5['obs'].keys() else []
+            obs_cols = cols if obs_cols is None else [c for c in obs_cols if c in cols]
+            keys = list(h5['layers'].keys()) if 'layers' in h5.keys() else []
+            layer_keys = keys if layer_keys is None else [l for l in layer_keys if l in keys]
+            shapes = {k: h5['dimR'][k].shape[1:] for k in h5['dimR'].keys()} if 'dimR' in h5.keys() else {}
+            dimr_shapes = shapes if dimr_shapes is None else {k: v for k, v in dimr_shapes.items() if shapes.get(k) == v}
+    if len(assays) > 1:
+        raise ValueError("The files have the different assay_name: %s" % ', '.join(sorted(assays)))
+    if batch_key is not None and batch_key in obs_cols:
+        raise ValueError("batch_key '%s' is the obs column of the files" % batch_key)
+    merged = {}
+    for d in data_keys:
+        merged[d] = genes[d][0]
+        for g in genes[d][1:]:
+            merged[d] = merged[d][merged[d].isin(g)] if join == 'inner' else merged[d].append(g[~g.isin(merged[d])])
+    opts = dict(kwargs, resizable=True)
+    #--- stream the files into the output
+    with h5py.File(name=out_file, mode='w') as out:
+        data = out.create_group('data')
+        var = out.create_group('var')
+        for d in data_keys:
+            df_to_h5(df=pd.DataFrame(index=merged[d]), h5=var, gr_name=d, string_encoding=string_encoding, **kwargs)
+        for i, f in enumerate(files):
+            with h5py.File(name=f, mode='r') as h5, profiling.stage(profile, 'concat/' + os.path.basename(f), file=f):
+                obs = h5_to_df(h5df=h5['obs'])[obs_cols]
+                for c in obs_cols:
+                    # the string columns are read as the category, they are saved as the strings again
+                    if h5_attr_str(h5['obs'][c].attrs['origin_dtype']) == 'string':
+                        obs[c] = obs[c].astype(str)
+                if batch_key is not None:
+                    name = os.path.splitext(os.path.basename(f))[0]
+                    obs[batch_key] = pd.Categorical([name] * obs.shape[0], categories=[name])
+                if i == 0:
+                    df_to_h5(df=obs, h5=out, gr_name='obs', string_encoding=string_encoding, **opts)
+                else:
+                    append_df(df=obs, h5df=out['obs'], **kwargs)
+                del obs
+                gene_map = {d: merged[d].get_indexer(genes[d][i]) for d in data_keys}
+                for d in data_keys:
+                    concat_matrix(h5mat=h5['data'][d], h5=data, gr_name=d, gene_map=gene_map[d], n_cols=len(merged[d]),
+                                  block_rows=block_rows, **opts)
+                for l in layer_keys:
+                    concat_matrix(h5mat=h5['layers'][l], h5=out.require_group('layers'), gr_name=l, gene_map=gene_map['X'], 
+                                  n_cols=len(merged['X']), block_rows=block_rows, **opts)
+                for k in dimr_shapes.keys():
+                    dimR = out.require_group('dimR')
+                    dset = h5['dimR'][k]
+                    if k not in dimR.keys():
+                        # the chunks of the resizable dataset are sized by the target bytes, not by the empty initial shape
+                        create_dataset(h5=dimR, name=k, shape=(0,) + dset.shape[1:], dtype=dset.dtype, **opts)
+                    for b in range(0, dset.shape[0], block_rows):
+                        block = dset[b:b + block_rows]
+                        append_dataset(h5=dimR, name=k, data=block, dtype=append_dtype(dimR[k], block), **kwargs)
+        out.create_group('uns')
+        out.attrs['assay_name'] = np.array([assays.pop()], dtype=h5py.special_dtype(vlen=str))
+    return
+
+
+def concat_matrix(h5mat: h5py.Group,
+                  h5: h5py.Group,
+                  gr_name: str,
+                  gene_map: np.ndarray,
+                  n_cols: int,
+                  block_rows: int = 10000,
+                  **kwargs
+                  ) -> None:
+    """
+    The rows of the matrix saved in the h5 group are appended to the matrix h5[gr_name] block by block, which is created by 
+    matrix_to_h5 at the first block. The columns are moved to gene_map, and the columns mapped to -1 are dropped.
+
+    Parameters:
+    ----------
+    h5mat : The h5py.Group saving the input matrix
+    h5 : The h5py.Group of the output matrix
+    gr_name : The name of the output matrix
+    gene_map : The positions of the input columns in the output, -1 meaning dropped
+    n_cols : The number of the output columns
+    block_rows : The number of rows read and written at a time. Default is 10000
+    kwargs : The dataset options passed to create_dataset
+    ----------
+    """
+    datatype = h5_attr_str(h5mat.attrs['datatype'])
+    n_rows = int(h5mat['dims'][0])
+    identity = len(gene_map) == n_cols and np.array_equal(gene_map, np.arange(n_cols))
+    if datatype == 'SparseMatrix' and h5_attr_str(h5mat.attrs.get('layout', 'csr')) == 'csr':
+        indptr = h5mat['indptr'][()]
+        whole = None
+    else:
+        # the column-major and the dense matrices are read by h5_to_matrix, the dense rows being sliced lazily
+        indptr = None
+        whole = h5_to_matrix(h5mat=h5mat).tocsr() if datatype == 'SparseMatrix' else h5mat['matrix']
+    for b in range(0, n_rows, block_rows):
+        e = min(b + block_rows, n_rows)
+        if indptr is not None:
+            block = h5_csr_rows(h5mat=h5mat, rows=np.arange(b, e), indptr=indptr)
+        else:
+            block = whole[b:e]
+        if not identity:
+            block = remap_columns(mat=block, gene_map=gene_map, n_cols=n_cols)
+        if gr_name not in h5.keys():
+            matrix_to_h5(mat=block, h5=h5, gr_name=gr_name, block_rows=block_rows, dtype=block.dtype, layout='csr', **kwargs)
+        else:
+            append_matrix(mat=block, h5mat=h5[gr_name], **kwargs)
+    return
+
+
+def remap_columns(mat,
+                  gene_map: np.ndarray,
+                  n_cols: int):
+    """
+    The columns of the csr matrix or the dense matrix are moved to the positions of gene_map, -1 meaning dropped. 
+    The column indices of each row of the csr matrix are sorted again, as the dgCMatrix of R needs.
+    """
+    if sparse.issparse(mat):
+        new_ind = gene_map[mat.indices]
+        keep = new_ind >= 0
+        kept = np.zeros(len(keep) + 1, dtype=np.int64)
+        np.cumsum(keep, out=kept[1:])
+        mat = sparse.csr_matrix((mat.data[keep], new_ind[keep], kept[mat.indptr]), shape=(mat.shape[0], n_cols))
+        mat.sort_indices()
+        return mat
+    out = np.zeros((mat.shape[0], n_cols), dtype=mat.dtype)
+    src = np.flatnonzero(gene_map >= 0)
+    out[:, gene_map[src]] = np.asarray(mat)[:, src]
+    return out
+
+
+def take_columns(mat,
+                 cols: np.ndarray):
+    """
+    The columns cols of the matrix are taken in their order by remap_columns, so the column indices of each row of the sparse matrix
+    stay sorted, which slicing the columns of scipy.sparse does not keep.
+    """
+    gene_map = np.full(mat.shape[1], -1, dtype=np.int64)
+    gene_map[cols] = np.arange(len(cols))
+    return remap_columns(mat=sparse.csr_matrix(mat) if sparse.issparse(mat) else mat, gene_map=gene_map, n_cols=len(cols))
+
+
+def repack_h5(file: str) -> None:
+    """
+    The h5 file is compacted by copying all groups, datasets and attributes into the new file, which replaces it. 
+    The space left by the deleted or replaced datasets is reclaimed, as h5repack does, without the command line tools of HDF5.
+
+    Parameters:
+    ----------
+    file : The h5 file
+    ----------
+    """
+    tmp = file + '.repack'
+    try:
+        with h5py.File(name=file, mode='r') as src, h5py.File(name=tmp, mode='w') as dst:
+            for k, v in src.attrs.items():
+                dst.attrs[k] = v
+            for k in src.keys():
+                src.copy(src[k], dst, name=k)
+        os.replace(tmp, file)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return
+
+
 
 ### pandas dataframe save to the h5 file
 def df_to_h5(df: pd.DataFrame,
              h5: Union[h5py.File,h5py.Group],
-             gr_name: Union[str, None] = None
+             gr_name: Union[str, None] = None,
+             string_encoding: str = 'vlen',
+             **kwargs
              ) -> None:
     """
     pandas.core.frame.DataFrame be converted the h5 format that R can read in
@@ -202,6 +719,9 @@ def df_to_h5(df: pd.DataFrame,
     df : pandas.core.frame.Data.Frame
     h5 : h5py.File
     gr_name : the group name in the h5py.File 
+    string_encoding : The encoding of the index, colnames and category levels, see str_to_h5. Default is 'vlen'. 
+                      'fixed' means the fixed-width UTF-8 strings
+    kwargs : The dataset options passed to create_dataset, such as compression, compression_opts, chunks and shuffle
     ----------
 
     Usage:
@@ -217,41 +737,66 @@ def df_to_h5(df: pd.DataFrame,
         h5df = h5.create_group(gr_name)
     else:
         h5df = h5[gr_name]
-    cate_dict = {}
     df.index = df.index.astype(str)
-    h5df.create_dataset(name='index', data=df.index.values.astype(h5py.special_dtype(vlen=str))) # rownames to str
+    str_to_h5(h5=h5df, name='index', values=df.index.values, string_encoding=string_encoding, **kwargs) # rownames to str
     if len(df.columns)>0:
         dfcol = df.columns.copy()
         dfcol = dfcol.astype(str)
-        h5df.create_dataset(name='colnames', data=dfcol.values.astype(h5py.special_dtype(vlen=str))) # colnames to str
+        str_to_h5(h5=h5df, name='colnames', values=dfcol.values, string_encoding=string_encoding, **kwargs) # colnames to str
     for k in df.keys():
-        if is_categorical_dtype(df[k]):
-            h5df.create_dataset(name=k, data=df[k].cat.codes.values)
-            h5df[k].attrs['origin_dtype'] = 'category'
-            cate_dtype = df[k].cat.categories.values.dtype
-            if np.issubdtype(cate_dtype, np.integer):
-                cate_dict[k] = df[k].cat.categories.values
-            if np.issubdtype(cate_dtype, np.floating):
-                cate_dict[k] = df[k].cat.categories.values
-            if np.issubdtype(cate_dtype, np.object):
-                cate_dict[k] = df[k].cat.categories.values.astype(h5py.special_dtype(vlen=str))
-        if is_object_dtype(df[k]):
-            str_to_cate = pd.Categorical(df[k].astype('str'))
-            h5df.create_dataset(name=k, data=str_to_cate.codes)
-            h5df[k].attrs['origin_dtype'] = 'string'
-            cate_dict[k] = str_to_cate.categories.values.astype(h5py.special_dtype(vlen=str))
-        if is_bool_dtype(df[k]):
-            bool_to_int = df[k].astype(int)
-            h5df.create_dataset(name=k, data=bool_to_int.values)
-            h5df[k].attrs['origin_dtype'] = 'bool'
-        if is_float_dtype(df[k]) or is_integer_dtype(df[k]):
-            h5df.create_dataset(name=k, data=df[k].values)
-            h5df[k].attrs['origin_dtype'] = 'number'
-    if len(cate_dict.keys())>0:
-        h5df_cate = h5df.create_group('category')
-        for ca in cate_dict.keys():
-            h5df_cate.create_dataset(names=ca, data=cate_dict[ca])
+        col_to_h5(col=df[k], h5df=h5df, name=k, string_encoding=string_encoding, **kwargs)
     return 
+
+
+def col_to_h5(col: pd.Series,
+              h5df: h5py.Group,
+              name: str,
+              string_encoding: str = 'vlen',
+              **kwargs
+              ) -> None:
+    """
+    The column of the dataframe is saved into the h5 group of the dataframe with the attribute 'origin_dtype'. The codes of the 
+    category and the string column are saved as the dataset, and their levels are saved in the subgroup 'category'.
+
+    Parameters:
+    ----------
+    col : pandas.core.series.Series
+    h5df : The h5py.Group saving the dataframe
+    name : The column name
+    string_encoding : The encoding of the category levels, see str_to_h5. Default is 'vlen'
+    kwargs : The dataset options passed to create_dataset
+    ----------
+    """
+    levels = None
+    if is_categorical_dtype(col):
+        create_dataset(h5=h5df, name=name, data=col.cat.codes.values, **kwargs)
+        h5df[name].attrs['origin_dtype'] = 'category'
+        cate_dtype = col.cat.categories.values.dtype
+        if np.issubdtype(cate_dtype, np.integer):
+            levels = col.cat.categories.values
+        if np.issubdtype(cate_dtype, np.floating):
+            levels = col.cat.categories.values
+        if np.issubdtype(cate_dtype, np.object_):
+            levels = col.cat.categories.values.astype(str)
+    if is_object_dtype(col):
+        str_to_cate = pd.Categorical(col.astype('str'))
+        create_dataset(h5=h5df, name=name, data=str_to_cate.codes, **kwargs)
+        h5df[name].attrs['origin_dtype'] = 'string'
+        levels = str_to_cate.categories.values.astype(str)
+    if is_bool_dtype(col):
+        bool_to_int = col.astype(int)
+        create_dataset(h5=h5df, name=name, data=bool_to_int.values, **kwargs)
+        h5df[name].attrs['origin_dtype'] = 'bool'
+    if is_float_dtype(col) or is_integer_dtype(col):
+        create_dataset(h5=h5df, name=name, data=col.values, **kwargs)
+        h5df[name].attrs['origin_dtype'] = 'number'
+    if levels is not None:
+        h5df_cate = h5df.require_group('category')
+        if levels.dtype.kind == 'U':
+            str_to_h5(h5=h5df_cate, name=name, values=levels, string_encoding=string_encoding, **kwargs)
+        else:
+            create_dataset(h5=h5df_cate, name=name, data=levels, **kwargs)
+    return
 #     if gr_name not in h5.keys():
 #         h5df = h5.create_group(gr_name)
 #     else:
@@ -290,16 +835,34 @@ def df_to_h5(df: pd.DataFrame,
 ### matrix save to the h5 file
 def matrix_to_h5(mat,
                  h5: Union[h5py.Group, h5py.File],
-                 gr_name: Union[str, None] = None
+                 gr_name: Union[str, None] = None,
+                 csc_index: bool = False,
+                 block_rows: int = 10000,
+                 dtype = np.float32,
+                 n_jobs: int = 1,
+                 layout: Union[str, None] = 'csr',
+                 **kwargs
                  ) -> None:
     """
-    The matrix(scipy.sparse.csr.csr_matrix or np.ndarray) is converted to the matrix in h5 format or is stored into the h5 file that R can read.
+    The matrix(scipy.sparse.csr_matrix, csc_matrix, coo_matrix or np.ndarray) is converted to the matrix in h5 format or is stored into the h5 file that R can read.
 
     Parameters:
     ----------
     mat : scipy.sparse.csr.csr_matrix or numpy.ndarray
     h5 : h5py.File
     gr_name : the group name in the h5py.File 
+    csc_index : Default is False. True means that the column-major copy of the sparse matrix is also saved in the subgroup 'csc',
+                whose 'indptr' points to the columns and whose 'indices' are the rows.
+    block_rows : The number of rows converted to the saved dtype and written at a time, which bounds the extra memory during writing. Default is 10000
+    dtype : The dtype of the saved values. Default is numpy.float32. 'preserve' means keeping the dtype of mat, and the integer-valued matrix
+            is saved as the narrowest integer type, see storage_dtype
+    n_jobs : The number of processes compressing the gzip chunks in parallel. Default is 1
+    layout : The layout of the sparse matrix, saved as the attribute 'layout' of the group. Default is 'csr', row-major, 'indptr' pointing 
+             to the rows, which the R package dior reads as the column-major dgCMatrix of genes x cells without transposing. 'csc' means 
+             column-major, 'indptr' pointing to the columns. None means keeping the layout of mat without the conversion: the csc matrix
+             is saved column-major and the csr or coo matrix row-major. The R package dior ignores the attribute 'layout', so the 
+             column-major matrix can be read by diopy only, and a warning is raised when it is written.
+    kwargs : The dataset options passed to create_dataset, such as compression, compression_opts, chunks and shuffle
     ----------
 
     Usage:
@@ -320,55 +883,198 @@ def matrix_to_h5(mat,
         h5mat = h5.create_group(gr_name)
     else:
         h5mat = h5[gr_name]
-    if isinstance(mat, scipy.sparse.csr.csr_matrix):
-        h5mat_i = h5mat.create_dataset("indices", data=mat.indices)
-        h5mat_p = h5mat.create_dataset("indptr", data=mat.indptr)
-        h5mat_x = h5mat.create_dataset("values", data=mat.data, dtype=np.float32)
-        h5mat_dims = h5mat.create_dataset("dims", data=mat.shape)
-        h5mat.attrs["datatype"] = "SparseMatrix"
+    if scipy.sparse.issparse(mat):
+        if layout is None:
+            layout = 'csc' if mat.format == 'csc' else 'csr'
+        if layout not in ['csr', 'csc']:
+            raise ValueError("layout should be None, 'csr' or 'csc', not %s" % layout)
+        if layout == 'csc':
+            warnings.warn("The column-major matrix '%s' is saved with layout='csc', which can be read by diopy only, not by the "
+                          "R package dior" % h5mat.name)
+        # the matrix already in the layout is not copied
+        mat = mat.tocsr() if layout == 'csr' else mat.tocsc()
+        # the dtype is checked once for both the matrix and its column-major copy
+        dtype = storage_dtype(data=mat.data if len(mat.data) == mat.indptr[-1] else mat.data[:mat.indptr[-1]], dtype=dtype)
+        if layout == 'csr':
+            csr_to_h5(mat=mat, h5mat=h5mat, block_rows=block_rows, dtype=dtype, n_jobs=n_jobs, **kwargs)
+            if csc_index:
+                # the transpose of the csc matrix is the csr matrix of the column-major copy
+                csc = mat.tocsc()
+                csr_to_h5(mat=csc.T, h5mat=h5mat.create_group("csc"), block_rows=block_rows, dtype=dtype, n_jobs=n_jobs, **kwargs)
+                del csc
+        else:
+            # the transpose of the csc matrix is the csr matrix sharing its arrays. csc_index is not needed, 
+            # the column-major matrix is read by the columns already
+            csr_to_h5(mat=mat.T, h5mat=h5mat, block_rows=block_rows, dtype=dtype, n_jobs=n_jobs, layout='csc', **kwargs)
     elif isinstance(mat, np.ndarray):
-        h5mat_mat = h5mat.create_dataset("matrix", data=mat, dtype=np.float32)
-        h5mat_dims = h5mat.create_dataset("dims", data=mat.shape)
-        h5mat.attrs['datatype'] = 'Array'
-    elif 'core' in dir(anndata):
-        if isinstance(mat, anndata.core.views.SparseCSRView):
-            h5mat_i = h5mat.create_dataset("indices", data=mat.indices)
-            h5mat_p = h5mat.create_dataset("indptr", data=mat.indptr)
-            h5mat_x = h5mat.create_dataset("values", data=mat.data, dtype=np.float32)
-            h5mat_dims = h5mat.create_dataset("dims", data=mat.shape)
-            h5mat.attrs["datatype"] = "SparseMatrix"
-        elif isinstance(mat, anndata.core.views.ArrayView):
-            h5mat_mat = h5mat.create_dataset("matrix", data=mat, dtype=np.float32)
-            h5mat_dims = h5mat.create_dataset("dims", data=mat.shape)
-            h5mat.attrs['datatype'] = 'Array'
+        array_to_h5(mat=mat, h5mat=h5mat, block_rows=block_rows, dtype=dtype, n_jobs=n_jobs, **kwargs)
     elif 'base' in dir(anndata):
         if isinstance(mat, anndata.base.ArrayView):
-            h5mat_mat = h5mat.create_dataset("matrix", data=mat, dtype=np.float32)
-            h5mat_dims = h5mat.create_dataset("dims", data=mat.shape)
-            h5mat.attrs['datatype'] = 'Array'
+            array_to_h5(mat=mat, h5mat=h5mat, block_rows=block_rows, dtype=dtype, n_jobs=n_jobs, **kwargs)
         elif isinstance(mat, anndata.base.SparseCSRView):
-            h5mat_i = h5mat.create_dataset("indices", data=mat.indices)
-            h5mat_p = h5mat.create_dataset("indptr", data=mat.indptr)
-            h5mat_x = h5mat.create_dataset("values", data=mat.data, dtype=np.float32)
-            h5mat_dims = h5mat.create_dataset("dims", data=mat.shape)
-            h5mat.attrs["datatype"] = "SparseMatrix"
+            csr_to_h5(mat=mat, h5mat=h5mat, block_rows=block_rows, dtype=dtype, n_jobs=n_jobs, **kwargs)
+        else:
+            raise TypeError("The matrix of %s is not supported" % type(mat).__name__)
     elif '_core' in dir(anndata):
         if isinstance(mat, anndata._core.views.ArrayView):
-            h5mat_mat = h5mat.create_dataset("matrix", data=mat, dtype=np.float32)
-            h5mat_dims = h5mat.create_dataset("dims", data=mat.shape)
-            h5mat.attrs['datatype'] = 'Array'
+            array_to_h5(mat=mat, h5mat=h5mat, block_rows=block_rows, dtype=dtype, n_jobs=n_jobs, **kwargs)
         elif isinstance(mat, anndata._core.views.SparseCSRView):
-            h5mat_i = h5mat.create_dataset("indices", data=mat.indices)
-            h5mat_p = h5mat.create_dataset("indptr", data=mat.indptr)
-            h5mat_x = h5mat.create_dataset("values", data=mat.data, dtype=np.float32)
-            h5mat_dims = h5mat.create_dataset("dims", data=mat.shape)
-            h5mat.attrs["datatype"] = "SparseMatrix"
+            csr_to_h5(mat=mat, h5mat=h5mat, block_rows=block_rows, dtype=dtype, n_jobs=n_jobs, **kwargs)
+        else:
+            raise TypeError("The matrix of %s is not supported" % type(mat).__name__)
     else:
         raise TypeError("The adata.X version is not supported")
     return
 
 
-def spatial_to_h5(adata,h5,gr_name = 'spatial'):
+def csr_to_h5(mat: scipy.sparse.csr.csr_matrix,
+              h5mat: h5py.Group,
+              block_rows: int = 10000,
+              dtype = np.float32,
+              n_jobs: int = 1,
+              layout: str = 'csr',
+              **kwargs
+              ) -> None:
+    """
+    The csr matrix is written into the h5 group block by block. The datasets are preallocated, then the 'values' of each block of rows
+    are converted to the saved dtype and written, so that only one block is copied at a time. 'indices' and 'indptr' are saved 
+    with the widths of sparse_index_dtypes.
+
+    Parameters:
+    ----------
+    mat : scipy.sparse.csr.csr_matrix
+    h5mat : The h5py.Group saving the matrix
+    block_rows : The number of rows converted and written at a time. Default is 10000
+    dtype : The dtype of 'values'. Default is numpy.float32. 'preserve' means keeping the dtype of mat, see storage_dtype
+    n_jobs : The number of processes compressing the gzip chunks of 'values' and 'indices', see chunks_to_h5. Default is 1
+    layout : Default is 'csr'. 'csc' means that mat is the transpose of the csc matrix to save, 'dims' being the shape of the csc matrix
+    kwargs : The dataset options passed to create_dataset
+    ----------
+    """
+    n_rows = mat.shape[0]
+    nnz = int(mat.indptr[-1])
+    indices_dtype, indptr_dtype = sparse_index_dtypes(nnz=nnz, n_cols=mat.shape[1])
+    h5mat_i = create_dataset(h5=h5mat, name="indices", shape=(nnz,), dtype=indices_dtype, **kwargs)
+    create_dataset(h5=h5mat, name="indptr", data=mat.indptr, dtype=indptr_dtype, **kwargs)
+    dtype = storage_dtype(data=mat.data if len(mat.data) == nnz else mat.data[:nnz], dtype=dtype)
+    h5mat_x = create_dataset(h5=h5mat, name="values", shape=(nnz,), dtype=dtype, **kwargs)
+    if n_jobs > 1 and parallel_compressible(h5mat_x):
+        chunks_to_h5(h5dset=h5mat_x, data=mat.data, n_jobs=n_jobs)
+        chunks_to_h5(h5dset=h5mat_i, data=mat.indices, n_jobs=n_jobs)
+    else:
+        for b in range(0, n_rows, block_rows):
+            e = min(b + block_rows, n_rows)
+            sb, se = int(mat.indptr[b]), int(mat.indptr[e])
+            if se > sb:
+                h5mat_x[sb:se] = np.asarray(mat.data[sb:se], dtype=dtype)
+                h5mat_i[sb:se] = np.asarray(mat.indices[sb:se], dtype=indices_dtype)
+    h5mat.create_dataset("dims", data=mat.shape if layout == 'csr' else mat.shape[::-1])
+    h5mat.attrs["datatype"] = "SparseMatrix"
+    h5mat.attrs["layout"] = layout
+    return
+
+
+def array_to_h5(mat: np.ndarray,
+                h5mat: h5py.Group,
+                block_rows: int = 10000,
+                dtype = np.float32,
+                n_jobs: int = 1,
+                **kwargs
+                ) -> None:
+    """
+    The dense matrix is written into the h5 group block by block, converting only one block of rows to the saved dtype at a time.
+
+    Parameters:
+    ----------
+    mat : numpy.ndarray
+    h5mat : The h5py.Group saving the matrix
+    block_rows : The number of rows converted and written at a time. Default is 10000
+    dtype : The dtype of 'matrix'. Default is numpy.float32. 'preserve' means keeping the dtype of mat, see storage_dtype
+    n_jobs : The number of processes compressing the gzip chunks of 'matrix', see chunks_to_h5. Default is 1
+    kwargs : The dataset options passed to create_dataset
+    ----------
+    """
+    n_rows = mat.shape[0]
+    dtype = storage_dtype(data=mat, dtype=dtype)
+    h5mat_mat = create_dataset(h5=h5mat, name="matrix", shape=mat.shape, dtype=dtype, **kwargs)
+    if n_jobs > 1 and parallel_compressible(h5mat_mat):
+        chunks_to_h5(h5dset=h5mat_mat, data=mat, n_jobs=n_jobs)
+    else:
+        for b in range(0, n_rows, block_rows):
+            e = min(b + block_rows, n_rows)
+            h5mat_mat[b:e] = np.asarray(mat[b:e], dtype=dtype)
+    h5mat.create_dataset("dims", data=mat.shape)
+    h5mat.attrs['datatype'] = 'Array'
+    return
+
+
+def parallel_compressible(h5dset: h5py.Dataset) -> bool:
+    """
+    Whether the chunks of the dataset can be compressed by chunks_to_h5, which supports the gzip filter with the optional shuffle filter
+    """
+    return (h5dset.chunks is not None and h5dset.compression == 'gzip' and not h5dset.fletcher32 
+            and h5dset.scaleoffset is None and h5dset.size > 0)
+
+
+def encode_chunk(block: np.ndarray,
+                 dtype,
+                 chunk_shape: tuple,
+                 shuffle: bool,
+                 level: int
+                 ) -> bytes:
+    """
+    The block is converted to one gzip chunk of HDF5 in the worker process. The edge block is padded with zeros to the full chunk,
+    the bytes are shuffled as the HDF5 shuffle filter and compressed as the HDF5 deflate filter.
+    """
+    arr = np.zeros(chunk_shape, dtype=dtype)
+    arr[tuple(slice(0, n) for n in block.shape)] = block
+    buf = arr.tobytes()
+    if shuffle and arr.itemsize > 1:
+        buf = np.frombuffer(buf, dtype=np.uint8).reshape(-1, arr.itemsize).T.tobytes()
+    return zlib.compress(buf, level)
+
+
+def chunks_to_h5(h5dset: h5py.Dataset,
+                 data,
+                 n_jobs: int = 2
+                 ) -> None:
+    """
+    The data is written into the gzip dataset by chunks. The worker processes convert and compress the chunks in parallel, 
+    and the main process writes the compressed chunks in order by write_direct_chunk. Only 2 * n_jobs chunks are in flight at a time.
+
+    Parameters:
+    ----------
+    h5dset : The h5py.Dataset created by create_dataset with compression='gzip'
+    data : The numpy.ndarray or the array-like object with the same shape as h5dset
+    n_jobs : The number of processes. Default is 2
+    ----------
+
+    Usage:
+    -----
+    >>> dset = create_dataset(h5=h5, name='values', shape=mat.data.shape, dtype=np.float32, compression='gzip')
+    >>> chunks_to_h5(h5dset=dset, data=mat.data, n_jobs=8)
+    -----
+    """
+    chunk_shape = h5dset.chunks
+    rows = chunk_shape[0]
+    n_rows = h5dset.shape[0]
+    level = h5dset.compression_opts if h5dset.compression_opts is not None else 4
+    tail = (0,) * (len(chunk_shape) - 1)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        for b in range(0, n_rows, rows):
+            block = np.asarray(data[b:min(b + rows, n_rows)])
+            pending.append((b, pool.submit(encode_chunk, block, h5dset.dtype, chunk_shape, h5dset.shuffle, level)))
+            if len(pending) >= 2 * n_jobs:
+                b0, fu = pending.popleft()
+                h5dset.id.write_direct_chunk((b0,) + tail, fu.result())
+        while len(pending) > 0:
+            b0, fu = pending.popleft()
+            h5dset.id.write_direct_chunk((b0,) + tail, fu.result())
+    return
+
+
+def spatial_to_h5(adata,h5,gr_name = 'spatial', string_encoding = 'vlen', **kwargs):
     """
     The spatial messages are converted to the into the h5 file that R can read.
 
@@ -377,6 +1083,8 @@ def spatial_to_h5(adata,h5,gr_name = 'spatial'):
     adata: anndata.AnnData
     h5 : h5py.File
     gr_name : The group name in the h5py.File. Default is 'spatial'
+    string_encoding : The encoding of the strings of the coordinate dataframe, see str_to_h5. Default is 'vlen'
+    kwargs : The dataset options passed to create_dataset, such as compression, compression_opts, chunks and shuffle
     ----------
 
     Usage:
@@ -392,12 +1100,12 @@ def spatial_to_h5(adata,h5,gr_name = 'spatial'):
         sid_image_h5 = sid_h5.create_group('image')
         simage = adata.uns[gr_name][sampleid]['images']
         for im in simage.keys():
-            sid_image_h5.create_dataset(im, data=simage[im])
+            create_dataset(h5=sid_image_h5, name=im, data=simage[im], **kwargs)
         #--- save tissue coordinate
         v1 = ['in_tissue','array_row','array_col']
         df = adata.obs[v1]
         coor_df = pd.concat([df,pd.DataFrame(adata.obsm['spatial'],index = df.index, columns=['image_1', 'image_2'])],axis=1)
-        df_to_h5(df = coor_df, h5 = sid_h5, gr_name = 'coor')
+        df_to_h5(df = coor_df, h5 = sid_h5, gr_name = 'coor', string_encoding=string_encoding, **kwargs)
         #--- save the scalefactor
         sid_scalefactor_h5 = sid_h5.create_group('scalefactors')
         sf = adata.uns[gr_name][sampleid]['scalefactors']
@@ -405,16 +1113,544 @@ def spatial_to_h5(adata,h5,gr_name = 'spatial'):
             sid_scalefactor_h5.create_dataset(k, data=sf[k])
     return   
 
+def str_to_h5(h5: Union[h5py.Group, h5py.File],
+              name: str,
+              values,
+              string_encoding: str = 'vlen',
+              **kwargs
+              ) -> h5py.Dataset:
+    """
+    The strings are saved into the h5 group. The variable-length strings need the heap lookup of each element, while the fixed-width 
+    UTF-8 strings are one continuous buffer, which is written and read in bulk and compressed well. R reads both as the character vector.
+
+    Parameters:
+    ----------
+    h5 : h5py.Group
+    name : The dataset name
+    values : The array of strings
+    string_encoding : Default is 'vlen', the variable-length strings. 'fixed' means the fixed-width UTF-8 strings padded to the longest one
+    kwargs : The dataset options passed to create_dataset
+    ----------
+
+    Usage:
+    -----
+    >>> str_to_h5(h5=h5, name='index', values=adata.obs_names.values, string_encoding='fixed')
+    -----
+    """
+    if string_encoding == 'vlen':
+        return create_dataset(h5=h5, name=name, data=np.asarray(values).astype(h5py.special_dtype(vlen=str)), **kwargs)
+    elif string_encoding == 'fixed':
+        values = np.asarray(values).astype(str)
+        try:
+            data = values.astype('S')
+        except UnicodeEncodeError:
+            data = np.char.encode(values, 'utf-8')
+        # the bytes are tagged as UTF-8, hdf5 does not convert the ASCII strings to the UTF-8 strings
+        data = data.view(h5py.string_dtype('utf-8', max(1, data.dtype.itemsize)))
+        return create_dataset(h5=h5, name=name, data=data, dtype=data.dtype, **kwargs)
+    else:
+        raise ValueError("string_encoding should be 'vlen' or 'fixed', not '%s'" % string_encoding)
+
+
+def storage_dtype(data,
+                  dtype = np.float32,
+                  block_size: int = 2**22
+                  ) -> np.dtype:
+    """
+    The dtype to save the data. When dtype is 'preserve', the dtype of data is kept, except that the integer-valued data is saved as 
+    the narrowest integer type of int8, uint8, int16, uint16 and int32, which R reads as the integer. The data is checked block by block.
+
+    Parameters:
+    ----------
+    data : numpy.ndarray, h5py.Dataset or the array-like object
+    dtype : The dtype to save. Default is numpy.float32. 'preserve' means keeping the dtype of data
+    block_size : The number of elements checked at a time. Default is 2**22
+    ----------
+
+    Usage:
+    -----
+    >>> storage_dtype(data=np.array([0., 3., 250.]), dtype='preserve')
+    dtype('uint8')
+    -----
+    """
+    if not (isinstance(dtype, str) and dtype == 'preserve'):
+        return np.dtype(dtype)
+    if not hasattr(data, 'dtype') or not hasattr(data, 'shape'):
+        data = np.asarray(data)
+    data_dtype = np.dtype(data.dtype)
+    if data_dtype.kind not in 'fiu' or len(data.shape) == 0 or data.shape[0] == 0:
+        return data_dtype
+    rows = max(1, block_size // max(1, int(np.prod(data.shape[1:]))))
+    mn, mx = 0, 0
+    for b in range(0, data.shape[0], rows):
+        blk = np.asarray(data[b:b + rows])
+        if data_dtype.kind == 'f' and not np.all(np.mod(blk, 1) == 0):
+            return data_dtype
+        if blk.size > 0:
+            mn, mx = min(mn, blk.min()), max(mx, blk.max())
+    for it in [np.uint8, np.int8, np.uint16, np.int16, np.int32]:
+        if np.iinfo(it).min <= mn and mx <= np.iinfo(it).max:
+            return np.dtype(it)
+    return data_dtype
+
+
+def sparse_index_dtypes(nnz: int,
+                        n_cols: int
+                        ) -> tuple:
+    """
+    The dtypes to save 'indices' and 'indptr' of the sparse matrix. 'indices' is saved as the narrowest type of uint8, uint16, int32 
+    and int64 holding the largest column position, which R reads as the integer. 'indptr' is int32, and int64 only when the matrix 
+    has more than 2^31 - 1 non-zeros.
+
+    Parameters:
+    ----------
+    nnz : The number of the non-zeros
+    n_cols : The number of the columns
+    ----------
+
+    Usage:
+    -----
+    >>> sparse_index_dtypes(nnz=2**31 - 1, n_cols=30000)
+    (dtype('uint16'), dtype('int32'))
+    >>> sparse_index_dtypes(nnz=2**31, n_cols=30000)
+    (dtype('uint16'), dtype('int64'))
+    -----
+    """
+    indices_dtype = np.dtype(np.int64)
+    for it in [np.uint8, np.uint16, np.int32]:
+        if n_cols - 1 <= np.iinfo(it).max:
+            indices_dtype = np.dtype(it)
+            break
+    indptr_dtype = np.dtype(np.int32) if nnz <= np.iinfo(np.int32).max else np.dtype(np.int64)
+    return indices_dtype, indptr_dtype
+
+
+def create_dataset(h5: Union[h5py.Group, h5py.File],
+                   name: str,
+                   data=None,
+                   shape=None,
+                   dtype=None,
+                   compression=None,
+                   compression_opts=None,
+                   chunks: Union[bool, int, None] = None,
+                   shuffle: bool = False,
+                   resizable: bool = False
+                   ) -> h5py.Dataset:
+    """
+    The dataset is created in the h5 group with the compression and the chunk layout. The dataset with less than 1024 elements
+    is kept contiguous and uncompressed, unless it is resizable. The resizable dataset is always compressed as requested, and its 
+    chunk is sized by the target bytes alone, not by the rows written first, as the rows appended later fill the same chunks.
+
+    Parameters:
+    ----------
+    h5 : h5py.Group
+    name : The dataset name
+    data : The data to save. Default is None, creating the empty dataset by shape and dtype
+    shape : The shape of the empty dataset
+    dtype : The dtype of the dataset
+    compression : The compression filter. Default is None. Available options are 'gzip', 'lzf', the gzip level 0-9
+                  and the filters of hdf5plugin, such as hdf5plugin.Blosc() or hdf5plugin.Zstd().
+                  Note: the R package dior reads 'gzip' by the hdf5 library, the other filters need the plugins installed for R.
+    compression_opts : The compression options, such as the gzip level
+    chunks : Default is None, chunking only the compressed dataset. True means chunking the dataset in any case, 
+             and the integer means the target bytes of a chunk. The default chunk is about 1MB and holds the whole rows.
+    shuffle : Default is False, determing whether to use the shuffle filter before the compression
+    resizable : Default is False. True means that the dataset is chunked with the unlimited first dimension, even if it is small, 
+                so that the rows can be appended by append_dataset
+    ----------
+
+    Usage:
+    -----
+    >>> create_dataset(h5=h5, name='values', data=mat.data, dtype=np.float32, compression='gzip', compression_opts=4)
+    -----
+    """
+    if data is not None:
+        arr = np.asarray(data) if not isinstance(data, np.ndarray) else data
+        shape = arr.shape if shape is None else shape
+        itemsize = (np.dtype(dtype) if dtype is not None else arr.dtype).itemsize
+    else:
+        itemsize = np.dtype(dtype).itemsize if dtype is not None else 4
+    shape = tuple(shape)
+    size = int(np.prod(shape)) if len(shape) > 0 else 1
+    opts = {}
+    if len(shape) > 0 and (size >= 1024 or resizable):
+        if compression is not None:
+            if isinstance(compression, Mapping):
+                # the filters of hdf5plugin are the mapping of compression and compression_opts
+                opts.update(dict(compression))
+            else:
+                opts['compression'] = compression
+                if compression_opts is not None:
+                    opts['compression_opts'] = compression_opts
+            if shuffle:
+                opts['shuffle'] = True
+    chunked = len(opts) > 0 or chunks is True or isinstance(chunks, int) and not isinstance(chunks, bool)
+    if len(shape) > 0 and (resizable or size >= 1024 and chunked):
+        target = chunks if isinstance(chunks, int) and not isinstance(chunks, bool) else 2**20
+        # the chunk holds the whole rows, except the first dimension
+        row_bytes = max(1, itemsize * int(np.prod(shape[1:])))
+        rows = int(max(1, target // row_bytes if resizable else min(shape[0], target // row_bytes)))
+        opts['chunks'] = (rows,) + shape[1:]
+        if resizable:
+            opts['maxshape'] = (None,) + shape[1:]
+    return h5.create_dataset(name, data=data, shape=shape if data is None else None, dtype=dtype, **opts)
+
+
+def h5_str_values(h5dset: h5py.Dataset) -> np.ndarray:
+    """
+    The strings of the h5 dataset, the variable-length or the fixed-width UTF-8 strings, as numpy.ndarray of str
+    """
+    if h5dset.dtype.kind == 'S':
+        return np.char.decode(h5dset[()], 'utf-8')
+    if hasattr(h5dset, 'asstr'):
+        return h5dset.asstr()[()].astype(str)
+    return h5dset[()].astype(str)
+
+
+def append_dtype(h5dset: h5py.Dataset,
+                 data) -> np.dtype:
+    """
+    The dtype holding both the saved values and the appended data. The float dataset keeps its dtype, the integer dataset written 
+    with dtype='preserve' is widened when the data needs the wider integer or the float, see storage_dtype
+    """
+    if h5dset.dtype.kind in 'iu':
+        return np.promote_types(h5dset.dtype, storage_dtype(data=data, dtype='preserve'))
+    return h5dset.dtype
+
+
+def dataset_filters(h5dset: h5py.Dataset) -> dict:
+    """
+    The compression options of the dataset, which create_dataset takes. The compression filter of hdf5plugin is given by its filter 
+    id and options, which needs hdf5plugin imported as for reading. The empty dict means that the dataset is not compressed.
+    """
+    compression, compression_opts = h5dset.compression, h5dset.compression_opts
+    if compression is None:
+        # h5py only names the builtin filters, the filters of hdf5plugin are listed by their filter id
+        plugins = [(int(k), v) for k, v in h5dset._filters.items() if str(k).isdigit()]
+        if len(plugins) == 0:
+            return {}
+        compression, compression_opts = plugins[0][0], tuple(plugins[0][1] or ())
+    return {'compression': compression, 'compression_opts': compression_opts, 'shuffle': h5dset.shuffle}
+
+
+def rebuild_dataset(h5: Union[h5py.Group, h5py.File],
+                    name: str,
+                    dtype = None,
+                    block_size: int = 2**22,
+                    **kwargs
+                    ) -> h5py.Dataset:
+    """
+    The dataset is copied block by block into the resizable chunked dataset with the same compression and attributes, which replaces it. 
+    It is needed once for the dataset written without resizable=True or whose dtype can not hold the appended data. 
+    HDF5 does not reclaim the space of the replaced dataset, h5repack does. The compression filter of hdf5plugin is kept, 
+    see dataset_filters. The fletcher32 and scaleoffset filters are not kept.
+
+    Parameters:
+    ----------
+    h5 : The h5py.Group holding the dataset
+    name : The dataset name
+    dtype : The dtype of the new dataset. Default is None, keeping the saved dtype
+    block_size : The number of elements copied at a time. Default is 2**22
+    kwargs : The compression options of the rebuilt dataset when the dataset is not compressed, such as the small dataset written 
+             uncompressed by create_dataset, see dataset_filters
+    ----------
+    """
+    old = h5[name]
+    dtype = old.dtype if dtype is None else np.dtype(dtype)
+    opts = dataset_filters(old)
+    if len(opts) == 0:
+        opts = {k: v for k, v in kwargs.items() if k in ['compression', 'compression_opts', 'shuffle']}
+    new = create_dataset(h5=h5, name=name + '__resizable', shape=old.shape, dtype=dtype, resizable=True, **opts)
+    rows = max(1, block_size // max(1, int(np.prod(old.shape[1:]))))
+    for b in range(0, old.shape[0], rows):
+        new[b:b + rows] = old[b:b + rows]
+    for k, v in old.attrs.items():
+        new.attrs[k] = v
+    del h5[name]
+    h5.move(name + '__resizable', name)
+    return h5[name]
+
+
+def append_dataset(h5: Union[h5py.Group, h5py.File],
+                   name: str,
+                   data,
+                   dtype = None,
+                   **kwargs
+                   ) -> h5py.Dataset:
+    """
+    The rows of data are appended to the dataset in place. The dataset which is not resizable or whose dtype differs from dtype 
+    is rebuilt at first, see rebuild_dataset. The fixed-width strings are widened to the longest string.
+
+    Parameters:
+    ----------
+    h5 : The h5py.Group holding the dataset
+    name : The dataset name
+    data : The rows to append, with the same shape as the dataset except the first dimension
+    dtype : The dtype of the dataset after appending. Default is None, keeping the saved dtype
+    kwargs : The compression options of the uncompressed dataset when it is rebuilt, see rebuild_dataset
+    ----------
+
+    Usage:
+    -----
+    >>> append_dataset(h5=h5['dimR'], name='PCA', data=adata.obsm['X_pca'])
+    -----
+    """
+    h5dset = h5[name]
+    data = np.asarray(data)
+    dtype = h5dset.dtype if dtype is None else np.dtype(dtype)
+    if h5dset.dtype.kind == 'S' and data.dtype.kind == 'S' and data.dtype.itemsize > h5dset.dtype.itemsize:
+        dtype = h5py.string_dtype('utf-8', data.dtype.itemsize)
+    if h5dset.maxshape[0] is not None or dtype != h5dset.dtype:
+        h5dset = rebuild_dataset(h5=h5, name=name, dtype=dtype, **kwargs)
+    n = h5dset.shape[0]
+    if data.shape[0] > 0:
+        h5dset.resize(n + data.shape[0], axis=0)
+        h5dset[n:] = data
+    return h5dset
+
+
+def append_str(h5: Union[h5py.Group, h5py.File],
+               name: str,
+               values,
+               **kwargs
+               ) -> h5py.Dataset:
+    """
+    The strings are appended to the dataset written by str_to_h5, keeping its encoding. kwargs are passed to append_dataset
+    """
+    values = np.asarray(values).astype(str)
+    if h5[name].dtype.kind == 'S':
+        try:
+            data = values.astype('S')
+        except UnicodeEncodeError:
+            data = np.char.encode(values, 'utf-8')
+        return append_dataset(h5=h5, name=name, data=data, **kwargs)
+    return append_dataset(h5=h5, name=name, data=values.astype(object), **kwargs)
+
+
+def stage_df(df: pd.DataFrame,
+             h5df: h5py.Group
+             ) -> list:
+    """
+    The rows of the dataframe are checked against the dataframe saved by df_to_h5 and converted to the data appended to each column,
+    without changing the file. The codes of the 'category' and 'string' columns are computed on the levels extended by the new levels, 
+    keeping the codes saved before.
+
+    Parameters:
+    ----------
+    df : pandas.core.frame.DataFrame with the same columns as the saved dataframe
+    h5df : The h5py.Group saving the dataframe
+
+    return the list of (name, data, dtype, levels), levels is None when the levels of the column are not extended
+    ----------
+    """
+    colnames = h5_str_values(h5df['colnames']) if 'colnames' in h5df.keys() else np.array([], dtype=str)
+    staged = []
+    for k in colnames:
+        origin = h5_attr_str(h5df[k].attrs.get('origin_dtype', 'number'))
+        col = df[k]
+        if origin in ['category', 'string']:
+            levels = h5df['category'][k]
+            if origin == 'category' and not is_categorical_dtype(col):
+                raise TypeError("The column '%s' is saved as 'category', not %s" % (k, col.dtype))
+            if origin == 'string' and (is_categorical_dtype(col) or not (is_object_dtype(col) or is_string_dtype(col))):
+                raise TypeError("The column '%s' is saved as 'string', not %s" % (k, col.dtype))
+            if origin == 'string':
+                # the strings are saved as the levels of pandas.Categorical, see df_to_h5
+                values = col.astype(str)
+            elif levels.dtype.kind in 'SO':
+                values = col.map(lambda v: None if pd.isna(v) else str(v))
+            elif col.cat.categories.dtype.kind in 'biuf':
+                values = col.astype(object)
+            else:
+                raise TypeError("The categories of the column '%s' are not numbers as the saved levels" % k)
+            old_levels = pd.Index(h5_str_values(levels) if levels.dtype.kind in 'SO' else levels[()])
+            new_levels = pd.Index(pd.unique(values.dropna()))
+            merged = old_levels.append(new_levels[~new_levels.isin(old_levels)])
+            codes = pd.Categorical(values, categories=merged).codes
+            staged.append((k, codes, np.promote_types(h5df[k].dtype, codes.dtype), merged if len(merged) > len(old_levels) else None))
+        elif origin == 'bool':
+            if not is_bool_dtype(col):
+                raise TypeError("The column '%s' is saved as 'bool', not %s" % (k, col.dtype))
+            data = col.astype(int).values
+            staged.append((k, data, np.promote_types(h5df[k].dtype, data.dtype), None))
+        else:
+            if is_bool_dtype(col) or not (is_integer_dtype(col) or is_float_dtype(col)):
+                raise TypeError("The column '%s' is saved as a number, not %s" % (k, col.dtype))
+            data = col.values
+            staged.append((k, data, np.promote_types(h5df[k].dtype, data.dtype), None))
+    return staged
+
+
+def commit_df(index: np.ndarray,
+              staged: list,
+              h5df: h5py.Group,
+              **kwargs
+              ) -> None:
+    """
+    The data staged by stage_df are appended to the columns of the saved dataframe, and the index is appended last, so the number of
+    the saved rows only changes after all columns are extended.
+
+    Parameters:
+    ----------
+    index : The row names appended
+    staged : The list returned by stage_df
+    h5df : The h5py.Group saving the dataframe
+    kwargs : The compression options of the uncompressed datasets when they are rebuilt, see rebuild_dataset
+    ----------
+    """
+    for k, data, dtype, merged in staged:
+        append_dataset(h5=h5df, name=k, data=data, dtype=dtype, **kwargs)
+        if merged is not None:
+            levels = h5df['category'][k]
+            if levels.dtype.kind in 'SO':
+                encoding = 'fixed' if levels.dtype.kind == 'S' else 'vlen'
+                del h5df['category'][k]
+                str_to_h5(h5=h5df['category'], name=k, values=merged.values.astype(str), string_encoding=encoding)
+            else:
+                del h5df['category'][k]
+                create_dataset(h5=h5df['category'], name=k, data=np.asarray(merged))
+    append_str(h5=h5df, name='index', values=index, **kwargs)
+    return
+
+
+def append_df(df: pd.DataFrame,
+              h5df: h5py.Group,
+              **kwargs
+              ) -> None:
+    """
+    The rows of the dataframe are appended to the dataframe saved by df_to_h5. All columns are checked and converted by stage_df 
+    before the file is changed, then appended by commit_df.
+
+    Parameters:
+    ----------
+    df : pandas.core.frame.DataFrame with the same columns as the saved dataframe
+    h5df : The h5py.Group saving the dataframe
+    kwargs : The compression options of the uncompressed datasets when they are rebuilt, see rebuild_dataset
+    ----------
+    """
+    staged = stage_df(df=df, h5df=h5df)
+    commit_df(index=df.index.astype(str).values, staged=staged, h5df=h5df, **kwargs)
+    return
+
+
+def append_matrix(mat,
+                  h5mat: h5py.Group,
+                  **kwargs
+                  ) -> None:
+    """
+    The rows of the matrix are appended to the matrix saved by matrix_to_h5. The row-major sparse matrix is extended by its 'values',
+    'indices' and 'indptr', the dense matrix by its rows, and 'dims' is updated. The column-major copy 'csc' of the sparse matrix can not 
+    be extended in place, it is removed.
+
+    Parameters:
+    ----------
+    mat : scipy.sparse matrix or numpy.ndarray with the same columns as the saved matrix
+    h5mat : The h5py.Group saving the matrix
+    kwargs : The compression options of the uncompressed datasets when they are rebuilt, see rebuild_dataset
+    ----------
+    """
+    datatype = h5mat.attrs['datatype']
+    if isinstance(datatype, np.ndarray):
+        datatype = datatype.astype('str').item()
+    n_rows, n_cols = int(h5mat['dims'][0]), int(h5mat['dims'][1])
+    if mat.shape[1] != n_cols:
+        raise ValueError("The matrix has %d columns, the saved matrix has %d columns" % (mat.shape[1], n_cols))
+    if datatype == 'SparseMatrix':
+        mat = sparse.csr_matrix(mat)
+        if not mat.has_sorted_indices:
+            # the dgCMatrix of R needs the sorted indices, the matrix of the caller is not changed
+            mat = mat.sorted_indices()
+        nnz_old = int(h5mat['indptr'][-1])
+        nnz = int(mat.indptr[-1])
+        indices_dtype, indptr_dtype = sparse_index_dtypes(nnz=nnz_old + nnz, n_cols=n_cols)
+        append_dataset(h5=h5mat, name='values', data=mat.data[:nnz], dtype=append_dtype(h5mat['values'], mat.data[:nnz]), **kwargs)
+        append_dataset(h5=h5mat, name='indices', data=mat.indices[:nnz], dtype=np.promote_types(h5mat['indices'].dtype, indices_dtype), **kwargs)
+        append_dataset(h5=h5mat, name='indptr', data=mat.indptr[1:].astype(np.int64) + nnz_old, 
+                       dtype=np.promote_types(h5mat['indptr'].dtype, indptr_dtype), **kwargs)
+        if 'csc' in h5mat.keys():
+            del h5mat['csc']
+            warnings.warn("The column-major copy 'csc' of %s is removed, which can not be extended in place" % h5mat.name)
+    else:
+        mat = mat.toarray() if sparse.issparse(mat) else np.asarray(mat)
+        append_dataset(h5=h5mat, name='matrix', data=mat, dtype=append_dtype(h5mat['matrix'], mat), **kwargs)
+    h5mat['dims'][0] = n_rows + mat.shape[0]
+    return
+
+
+def adata_nbytes(adata: anndata.AnnData) -> int:
+    """
+    The bytes of the matrices of the adata, which is about the size of the uncompressed h5 file written by adata_to_h5
+    """
+    mats = [adata.X] + list(adata.layers.values()) + list(adata.obsm.values()) + list(adata.obsp.values())
+    if adata.raw is not None:
+        mats.append(adata.raw.X)
+    nbytes = 0
+    for m in mats:
+        if sparse.issparse(m):
+            # the values and the int64 positions of the non-zeros at most
+            nbytes += m.nnz * (m.dtype.itemsize + 8)
+        else:
+            nbytes += getattr(m, 'nbytes', 0)
+    return int(nbytes)
+
+
 def write_rds(adata: Union[str, None] = None,
 	          file: Union[str, None] = None,
              object_type:str = 'seurat',
-             assay_name: str = 'RNA'
+             assay_name: str = 'RNA',
+             tmp_dir: Union[str, None] = None,
+             cache_dir: Union[str, None] = None,
+             stats = None
             ) -> None:
-    rfile = re.sub('.rds','_tmp.h5',file)
-    write_h5(adata=adata, file=rfile, assay_name=assay_name)
-    current_path = os.path.abspath(__file__)
-    diorc_file= os.path.abspath(os.path.dirname(current_path) + os.path.sep + ".") + '/R/diorC.R'
-    os.system('Rscript ' + diorc_file +' -r '+ rfile +' -t '+ object_type + ' -a '+assay_name)
+    """
+    The anndata.AnnData is converted to the rds file by the persistent R worker
+
+    Parameters:
+    ----------
+    adata : anndata.AnnData
+    file : The rds file
+    object_type: Denotes which object to save into the rds file. Default is 'seurat'. Available options are 'seurat' and 'singlecellexperiment'
+    assay_name : Denotes which omics data to save. Default is 'RNA'
+    tmp_dir : The scratch directory of the intermediate h5 file, which is removed after writing. Default is None, the environment 
+              variable DIOPY_TMPDIR, else the RAM-backed /dev/shm when it has the space, else the temporary directory of the system, 
+              see diopy.rworker.scratch_dir
+    cache_dir : Default is None, not caching. The cache directory keeps the rds file converted by R, keyed by the content hash of the 
+                intermediate h5 file, object_type, assay_name and the diopy version, so writing the unchanged adata again skips R. 
+                See diopy.cache.ConversionCache
+    stats : Default is None, not profiling. diopy.profiling.Profile or a callable records the stages of writing the h5 file and the R conversion
+    ----------
+
+    Usage:
+    ------
+    >>> import diopy
+    >>> diopy.output.write_rds(adata=adata, file='scdata.rds', object_type='seurat', assay_name='RNA')
+    ------
+
+    Note: The R worker is started at the first call and reused by the following calls. The error of R is raised as diopy.rworker.RWorkerError.
+    The number of the R workers running at the same time is set by diopy.rworker.get_pool(size=...).
+    """
+    file = os.path.abspath(file)
+    profile = profiling.as_profile(stats)
+    with rworker.tmp_h5(tmp_dir=tmp_dir, size=adata_nbytes(adata)) as rfile:
+        # the intermediate is read once by R, it is written without the compression, and the error is raised before R starts
+        with h5py.File(name=rfile, mode='w') as h5:
+            with profiling.stage(profile, 'write_h5', h5, '/'):
+                adata_to_h5(adata=adata, h5=h5, assay_name=assay_name, save_X=True, save_graph=True, profile=profile)
+            h5.attrs['assay_name'] = np.array([assay_name], dtype=h5py.special_dtype(vlen=str))
+        if cache_dir is not None:
+            # the h5 file written by diopy is the same for the same adata, its hash is the key of the adata
+            conv_cache = cache.ConversionCache(cache_dir)
+            with profiling.stage(profile, 'cache/hash', file=rfile):
+                key = conv_cache.key(rfile, command='h5_to_rds', object_type=object_type, assay_name=assay_name)
+            hit = conv_cache.get(key, suffix='.rds')
+            if hit is not None:
+                with profiling.stage(profile, 'cache/copy', file=hit):
+                    shutil.copyfile(hit, file)
+                return
+        with profiling.stage(profile, 'R/h5_to_rds', file=file):
+            rworker.get_pool().run('h5_to_rds', file, rfile, object_type, assay_name)
+        if cache_dir is not None:
+            conv_cache.put(key, suffix='.rds', file=file)
     return 
 
 ## to be continue
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Introduction: The stages of read_h5, write_h5, read_rds and write_rds are timed, such as reading 'obs', the matrix 'data/X' 
+or running R. Each stage records the elapsed seconds, the bytes of the h5 group or dataset it read or wrote, and the peak memory. 
+The records are collected by the Profile object, passed to the callback and logged at the DEBUG level by the logger 'diopy'.
+"""
+
+###  import the packages
+import os
+import sys
+import time
+import logging
+import resource
+import tracemalloc
+import contextlib
+from typing import Union, Callable
+
+import h5py
+
+logger = logging.getLogger('diopy')
+
+
+def h5_nbytes(h5obj) -> int:
+    """
+    The bytes of the h5 dataset, or of all datasets in the h5 group, as stored in the file
+
+    Parameters:
+    ----------
+    h5obj : h5py.Dataset or h5py.Group
+    return int
+    ----------
+    """
+    if isinstance(h5obj, h5py.Dataset):
+        return h5obj.id.get_storage_size()
+    sizes = [0]
+    h5obj.visititems(lambda name, obj: sizes.append(obj.id.get_storage_size()) if isinstance(obj, h5py.Dataset) else None)
+    return sum(sizes)
+
+
+def max_rss_mb() -> float:
+    # ru_maxrss is KB on Linux and bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+class Profile:
+    """
+    The records of the stages
+
+    Parameters:
+    ----------
+    callback : The function called with each record, the dict of 'stage', 'seconds', 'bytes', 'peak_mb' and 'pid'. Default is None
+    trace_memory : Default is False, 'peak_mb' being the peak RSS of the process so far. True means that 'peak_mb' is the peak 
+                   of the memory allocated during the stage, traced by tracemalloc, which slows down the reading and writing.
+    ----------
+
+    Usage:
+    -----
+    >>> profile = diopy.profiling.Profile()
+    >>> adata = diopy.input.read_h5(file='scdata.h5', stats=profile)
+    >>> print(profile.report())
+    -----
+    """
+    def __init__(self,
+                 callback: Union[Callable, None] = None,
+                 trace_memory: bool = False):
+        self.callback = callback
+        self.trace_memory = trace_memory
+        self.records = []
+        self._peaks = []
+        self._started = False
+
+    def __getstate__(self):
+        # the profile sent to the worker processes collects the records only
+        return {'callback': None, 'trace_memory': self.trace_memory, 'records': [], '_peaks': [], '_started': False}
+
+    def add(self, record: dict) -> None:
+        self.records.append(record)
+        logger.debug('%s: %.3f s, %.1f MB, peak %.1f MB', record['stage'], record['seconds'],
+                     record['bytes'] / 2**20, record['peak_mb'])
+        if self.callback is not None:
+            self.callback(record)
+
+    def extend(self, records: list) -> None:
+        for record in records:
+            self.add(record)
+
+    @contextlib.contextmanager
+    def stage(self,
+              name: str,
+              h5: Union[h5py.Group, None] = None,
+              path: Union[str, None] = None,
+              file: Union[str, None] = None):
+        """
+        The stage is timed, the bytes are of h5[path] or of the file when the stage ends, the peak memory is of the stage
+
+        Parameters:
+        ----------
+        name : The stage name, such as 'read/obs'
+        h5 : The h5 group holding the data of the stage
+        path : The path of the data in h5
+        file : The file read or written by the stage, such as the rds file
+        ----------
+        """
+        if self.trace_memory:
+            if len(self._peaks) == 0:
+                self._started = not tracemalloc.is_tracing()
+                if self._started:
+                    tracemalloc.start()
+            else:
+                # the outer stage keeps its peak before the inner stage resets the peak
+                self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+            self._peaks.append(0)
+            tracemalloc.reset_peak()
+        t0 = time.perf_counter()
+        try:
+            yield self
+        finally:
+            seconds = time.perf_counter() - t0
+            if self.trace_memory:
+                peak = max(self._peaks.pop(), tracemalloc.get_traced_memory()[1])
+                if len(self._peaks) > 0:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+                    tracemalloc.reset_peak()
+                elif self._started:
+                    tracemalloc.stop()
+                peak_mb = peak / 2**20
+            else:
+                peak_mb = max_rss_mb()
+            nbytes = 0
+            if h5 is not None and path is not None and path in h5:
+                nbytes = h5_nbytes(h5[path])
+            elif file is not None and os.path.exists(file):
+                nbytes = os.path.getsize(file)
+            self.add({'stage': name, 'seconds': seconds, 'bytes': nbytes, 'peak_mb': peak_mb, 'pid': os.getpid()})
+
+    def report(self) -> str:
+        """
+        The table of the records
+        """
+        lines = ['%-32s %10s %10s %10s %10s' % ('stage', 'seconds', 'MB', 'MB/s', 'peak MB')]
+        for r in self.records:
+            mb = r['bytes'] / 2**20
+            lines.append('%-32s %10.3f %10.1f %10.1f %10.1f' % (r['stage'], r['seconds'], mb,
+                                                               mb / r['seconds'] if r['seconds'] > 0 else 0.0, r['peak_mb']))
+        return '\n'.join(lines)
+
+
+def as_profile(stats) -> Union[Profile, None]:
+    """
+    The stats option of read_h5 and write_h5 as the Profile. None is not profiling, the callable is the callback of a new Profile
+    """
+    if stats is None or isinstance(stats, Profile):
+        return stats
+    if callable(stats):
+        return Profile(callback=stats)
+    raise TypeError('stats should be None, diopy.profiling.Profile or a callable')
+
+
+def stage(profile: Union[Profile, None],
+          name: str,
+          h5: Union[h5py.Group, None] = None,
+          path: Union[str, None] = None,
+          file: Union[str, None] = None):
+    """
+    The stage of the profile, doing nothing when the profile is None, see Profile.stage
+    """
+    if profile is None:
+        return contextlib.nullcontext()
+    return profile.stage(name, h5=h5, path=path, file=file)
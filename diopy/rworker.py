@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Introduction: The rds file is converted by the R package dior. Starting Rscript for every conversion pays the R startup and the loading 
+of dior, Seurat and SingleCellExperiment, which takes several seconds before any data moves. Here the R workers are started once 
+and kept alive, reading the conversion commands over the pipe, so the startup is paid only once per worker.
+"""
+
+###  import the packages
+import os
+import sys
+import queue
+import atexit
+import threading
+import subprocess
+import tempfile
+import shutil
+import contextlib
+from typing import Union
+
+_PREFIX = '__diopy__'
+
+
+class RWorkerError(RuntimeError):
+    """
+    The error of the R worker, including the error message of R
+    """
+    pass
+
+
+class RWorker:
+    """
+    The long-lived Rscript process running diorWorker.R
+
+    Parameters:
+    ----------
+    rscript : The Rscript executable. Default is 'Rscript'
+    ----------
+
+    Usage:
+    -----
+    >>> worker = RWorker()
+    >>> worker.run('rds_to_h5', 'scdata.rds', 'scdata_tmp.h5', 'seurat', 'RNA')
+    >>> worker.close()
+    -----
+    """
+    def __init__(self, rscript: str = 'Rscript'):
+        worker_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'R', 'diorWorker.R')
+        try:
+            self.proc = subprocess.Popen([rscript, worker_file], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         universal_newlines=True, bufsize=1)
+        except OSError as e:
+            raise RWorkerError('Failed to start %s: %s' % (rscript, e))
+        self._reply()
+
+    @property
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def _reply(self) -> str:
+        # the lines printed by R are passed to stdout, until the reply of the worker
+        for line in self.proc.stdout:
+            if line.startswith(_PREFIX + '\t'):
+                fields = line.rstrip('\n').split('\t', 2)
+                status = fields[1]
+                if status == 'ERROR':
+                    raise RWorkerError(fields[2].strip() if len(fields) > 2 else 'The R worker failed')
+                return status
+            sys.stdout.write(line)
+        code = self.proc.wait()
+        raise RWorkerError('The R worker exited with code %s, please check that R and the R package dior are installed' % code)
+
+    def run(self, command: str, *args: str) -> None:
+        """
+        The command is sent to the worker and waits for the reply
+
+        Parameters:
+        ----------
+        command : 'rds_to_h5' or 'h5_to_rds'
+        args : The rds file, the h5 file, the object type and the assay name
+        ----------
+        """
+        fields = [command] + [str(a) for a in args]
+        if any(('\t' in f) or ('\n' in f) for f in fields):
+            raise ValueError('The file names and the options should not contain tabs or newlines')
+        if not self.alive:
+            raise RWorkerError('The R worker exited with code %s' % self.proc.returncode)
+        try:
+            self.proc.stdin.write('\t'.join(fields) + '\n')
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise RWorkerError('The R worker is not available: %s' % e)
+        self._reply()
+
+    def close(self) -> None:
+        if self.alive:
+            try:
+                self.proc.stdin.write('quit\n')
+                self.proc.stdin.close()
+                self.proc.wait(timeout=10)
+            except (OSError, subprocess.TimeoutExpired):
+                self.proc.kill()
+                self.proc.wait()
+
+
+class RWorkerPool:
+    """
+    The pool of the R workers. The workers are started at the first use and reused by the following conversions, 
+    at most size conversions run at the same time.
+
+    Parameters:
+    ----------
+    size : The number of the R workers. Default is 1
+    rscript : The Rscript executable. Default is 'Rscript'
+    ----------
+
+    Usage:
+    -----
+    >>> pool = RWorkerPool(size=4)
+    >>> pool.run('rds_to_h5', 'scdata.rds', 'scdata_tmp.h5', 'seurat', 'RNA')
+    >>> pool.close()
+    -----
+    """
+    def __init__(self, size: int = 1, rscript: str = 'Rscript'):
+        if size < 1:
+            raise ValueError('The size of the pool should be at least 1')
+        self.size = size
+        self.rscript = rscript
+        # None is the free slot, which starts a new worker when it is taken
+        self._idle = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put(None)
+        self._lock = threading.Lock()
+        self._workers = []
+
+    def _acquire(self) -> RWorker:
+        worker = self._idle.get()
+        if worker is not None and worker.alive:
+            return worker
+        try:
+            worker = RWorker(rscript=self.rscript)
+        except BaseException:
+            self._idle.put(None)
+            raise
+        with self._lock:
+            self._workers.append(worker)
+        return worker
+
+    def _release(self, worker: RWorker) -> None:
+        if worker.alive:
+            self._idle.put(worker)
+        else:
+            with self._lock:
+                self._workers.remove(worker)
+            self._idle.put(None)
+
+    def run(self, command: str, *args: str) -> None:
+        """
+        The command runs on an idle worker, see RWorker.run
+        """
+        worker = self._acquire()
+        try:
+            worker.run(command, *args)
+        finally:
+            self._release(worker)
+
+    def close(self) -> None:
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.close()
+
+
+def scratch_dir(tmp_dir: Union[str, None] = None,
+                size: int = 0
+                ) -> str:
+    """
+    The directory of the intermediate h5 file handed to R
+
+    Parameters:
+    ----------
+    tmp_dir : The scratch directory. Default is None, the environment variable DIOPY_TMPDIR if it is set, else the RAM-backed /dev/shm 
+              if it is writable and its free space is more than twice size, else the temporary directory of the system. 
+              The /dev/shm of the docker container is 64MB by default, which is too small for most datasets.
+    size : The expected bytes of the intermediate h5 file. Default is 0
+    return str
+    ----------
+    """
+    if tmp_dir is None:
+        tmp_dir = os.environ.get('DIOPY_TMPDIR')
+    if tmp_dir is None:
+        shm = '/dev/shm'
+        if os.path.isdir(shm) and os.access(shm, os.W_OK | os.X_OK) and shutil.disk_usage(shm).free > 2 * size:
+            tmp_dir = shm
+        else:
+            tmp_dir = tempfile.gettempdir()
+    return tmp_dir
+
+
+@contextlib.contextmanager
+def tmp_h5(tmp_dir: Union[str, None] = None,
+           size: int = 0):
+    """
+    The name of the intermediate h5 file in the scratch directory, the file is removed on exit
+
+    Parameters:
+    ----------
+    tmp_dir : The scratch directory, see scratch_dir
+    size : The expected bytes of the intermediate h5 file, which decides whether /dev/shm is used, see scratch_dir. Default is 0
+    ----------
+
+    Usage:
+    -----
+    >>> with tmp_h5() as file:
+    ...     get_pool().run('rds_to_h5', 'scdata.rds', file, 'seurat', 'RNA')
+    -----
+    """
+    fd, file = tempfile.mkstemp(prefix='diopy_', suffix='_tmp.h5', dir=scratch_dir(tmp_dir, size=size))
+    os.close(fd)
+    try:
+        yield file
+    finally:
+        if os.path.exists(file):
+            os.remove(file)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(size: Union[int, None] = None,
+             rscript: Union[str, None] = None
+             ) -> RWorkerPool:
+    """
+    The shared pool of the R workers used by read_rds and write_rds
+
+    Parameters:
+    ----------
+    size : The number of the R workers. Default is None, keeping the current pool, or 1 worker for the new pool
+    rscript : The Rscript executable. Default is None, keeping the current pool, or 'Rscript' for the new pool
+    return RWorkerPool
+    ----------
+
+    Usage:
+    -----
+    >>> import diopy
+    >>> diopy.rworker.get_pool(size=4)
+    -----
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None and (size is None or size == _pool.size) and (rscript is None or rscript == _pool.rscript):
+            return _pool
+        if _pool is not None:
+            size = _pool.size if size is None else size
+            rscript = _pool.rscript if rscript is None else rscript
+            _pool.close()
+        _pool = RWorkerPool(size=1 if size is None else size, rscript='Rscript' if rscript is None else rscript)
+        return _pool
+
+
+def close_pool() -> None:
+    """
+    The R workers of the shared pool are stopped, the next conversion starts them again
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+atexit.register(close_pool)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Introduction: The per-cell and per-gene summary statistics are computed from the matrix in the h5 file by one pass over the blocks
+of rows, such as the total counts and the detected genes of each cell, and the mean, the variance and the fraction of the expressing
+cells of each gene. Only one block is in memory at a time, besides the statistics, and the blocks can be split among the processes.
+"""
+
+###  import the packages
+import os
+from typing import Union
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import h5py
+
+from .input import h5_attr_str, h5_to_str
+
+
+def merge_moments(n: Union[int, np.ndarray],
+                  mean: np.ndarray,
+                  m2: np.ndarray,
+                  n_b: Union[int, np.ndarray],
+                  mean_b: np.ndarray,
+                  m2_b: np.ndarray
+                  ) -> tuple:
+    """
+    The counts, the means and the sums of the squared deviations(M2) of two parts are merged by the pairwise update of Chan et al., 
+    which does not lose the precision as the difference E[x^2] - E[x]^2 does when the variance is small beside the mean.
+
+    return the tuple of the merged n, mean and M2
+    """
+    n_ab = n + n_b
+    delta = mean_b - mean
+    frac = np.divide(n_b, n_ab, out=np.zeros(np.shape(mean)), where=np.asarray(n_ab) > 0)
+    return n_ab, mean + delta * frac, m2 + m2_b + delta ** 2 * n * frac
+
+
+def block_bounds(indptr: Union[np.ndarray, None],
+                 start: int,
+                 stop: int,
+                 block_rows: int = 10000,
+                 block_nnz: int = 2 ** 24
+                 ) -> np.ndarray:
+    """
+    The first rows of the blocks from start to stop, closed by stop. Each block has at most block_rows rows and, for the sparse matrix 
+    whose 'indptr' from start is given, at most block_nnz non-zeros unless one row holds more, so the long rows of the column-major
+    matrix are read a few at a time.
+    """
+    if indptr is None:
+        return np.r_[np.arange(start, stop, block_rows), stop].astype(np.int64)
+    bounds = [start]
+    while bounds[-1] < stop:
+        b = bounds[-1]
+        e = start + int(np.searchsorted(indptr, indptr[b - start] + block_nnz, side='right')) - 1
+        bounds.append(min(max(e, b + 1), b + block_rows, stop))
+    return np.array(bounds, dtype=np.int64)
+
+
+def block_stats(h5mat: h5py.Group,
+                start: int,
+                stop: int,
+                n_cols: int,
+                block_rows: int = 10000,
+                block_nnz: int = 2 ** 24
+                ) -> dict:
+    """
+    The statistics over the rows from start to stop of the matrix saved in the h5 group. The row-major sparse matrix is read by the 
+    'indptr' range of each block, and the dense matrix by the rows of each block. The variances are kept as the sums of the squared 
+    deviations(M2) from the mean, computed in each block with the zeros counted, and merged over the blocks by merge_moments.
+
+    Parameters:
+    ----------
+    h5mat : The h5py.Group saving the matrix, whose rows are the cells or, for the column-major matrix, the genes
+    start : The first row
+    stop : The last row(exclusive)
+    n_cols : The number of the columns
+    block_rows : The number of rows read at a time. Default is 10000
+    block_nnz : The number of the non-zeros of the sparse matrix read at a time. Default is 2^24
+
+    return the dict of the row statistics 'row_sum', 'row_m2' and 'row_nnz', and the column statistics 'col_n', 'col_sum', 
+    'col_mean', 'col_m2' and 'col_nnz'
+    ----------
+    """
+    res = {'row_sum': np.zeros(stop - start), 'row_m2': np.zeros(stop - start), 'row_nnz': np.zeros(stop - start, dtype=np.int64),
+           'col_n': 0, 'col_sum': np.zeros(n_cols), 'col_mean': np.zeros(n_cols), 'col_m2': np.zeros(n_cols), 
+           'col_nnz': np.zeros(n_cols, dtype=np.int64)}
+    sparse = h5_attr_str(h5mat.attrs['datatype']) == 'SparseMatrix'
+    indptr = h5mat['indptr'][start:stop + 1].astype(np.int64) if sparse else None
+    bounds = block_bounds(indptr=indptr, start=start, stop=stop, block_rows=block_rows, block_nnz=block_nnz)
+    for b, e in zip(bounds[:-1], bounds[1:]):
+        m = e - b
+        if sparse:
+            ptr = indptr[b - start:e - start + 1]
+            x = h5mat['values'][ptr[0]:ptr[-1]].astype(np.float64)
+            ind = h5mat['indices'][ptr[0]:ptr[-1]].astype(np.int64)
+            nz = x != 0
+            rows = np.repeat(np.arange(m), np.diff(ptr))
+            row_sum = np.bincount(rows, weights=x, minlength=m)
+            row_nnz = np.bincount(rows[nz], minlength=m)
+            row_mean = row_sum / max(n_cols, 1)
+            # the zeros of each row deviate from the mean by the mean itself
+            row_m2 = np.bincount(rows, weights=(x - row_mean[rows]) ** 2, minlength=m) + (n_cols - np.diff(ptr)) * row_mean ** 2
+            col_sum = np.bincount(ind, weights=x, minlength=n_cols)
+            col_mean = col_sum / m
+            col_m2 = np.bincount(ind, weights=(x - col_mean[ind]) ** 2, minlength=n_cols) \
+                     + (m - np.bincount(ind, minlength=n_cols)) * col_mean ** 2
+            col_nnz = np.bincount(ind[nz], minlength=n_cols)
+        else:
+            x = h5mat['matrix'][b:e].astype(np.float64)
+            nz = x != 0
+            row_sum = x.sum(axis=1)
+            row_nnz = nz.sum(axis=1)
+            row_m2 = np.square(x - (row_sum / max(n_cols, 1))[:, None]).sum(axis=1)
+            col_sum = x.sum(axis=0)
+            col_mean = col_sum / m
+            col_m2 = np.square(x - col_mean).sum(axis=0)
+            col_nnz = nz.sum(axis=0)
+        res['row_sum'][b - start:e - start] = row_sum
+        res['row_m2'][b - start:e - start] = row_m2
+        res['row_nnz'][b - start:e - start] = row_nnz
+        res['col_n'], res['col_mean'], res['col_m2'] = merge_moments(res['col_n'], res['col_mean'], res['col_m2'], m, col_mean, col_m2)
+        res['col_sum'] += col_sum
+        res['col_nnz'] += col_nnz
+    return res
+
+
+def file_block_stats(file: str,
+                     key: str,
+                     start: int,
+                     stop: int,
+                     n_cols: int,
+                     block_rows: int = 10000,
+                     block_nnz: int = 2 ** 24
+                     ) -> dict:
+    """
+    block_stats with the separate file handle, which is used by the workers of stats(n_jobs=...)
+    """
+    with h5py.File(name=file, mode='r') as h5:
+        return block_stats(h5mat=h5[key], start=start, stop=stop, n_cols=n_cols, block_rows=block_rows, block_nnz=block_nnz)
+
+
+def stats(file: str,
+          key: str = 'data/X',
+          axis: Union[int, None] = None,
+          block_rows: int = 10000,
+          block_nnz: int = 2 ** 24,
+          n_jobs: int = 1
+          ) -> Union[pd.DataFrame, tuple]:
+    """
+    The summary statistics of the matrix in the h5 file are computed by one pass over the blocks of rows, without loading the matrix.
+
+    Parameters:
+    ----------
+    file : The h5 file written by diopy.output.write_h5 or the R package dior
+    key : The matrix in the h5 file, such as 'data/X', 'data/rawX' or 'layers/counts'. Default is 'data/X'
+    axis : Default is None, returning both statistics. 1 means the per-cell statistics, 'total_counts' and 'n_genes', the number of
+           the detected genes. 0 means the per-gene statistics, 'total_counts', 'mean', 'var'(ddof=1), 'n_cells', the number of
+           the expressing cells, and 'frac_cells', the fraction of the expressing cells
+    block_rows : The number of rows read at a time, which bounds the memory. Default is 10000
+    block_nnz : The number of the non-zeros of the sparse matrix read at a time, which bounds the memory when the rows are long, 
+                such as the genes of the column-major matrix. Default is 2^24
+    n_jobs : The number of processes reading the ranges of rows in parallel. Default is 1. -1 means using all CPUs
+
+    return pandas.core.frame.DataFrame, or the tuple of the per-cell and the per-gene DataFrame when axis is None
+    ----------
+
+    Usage:
+    ------
+    >>> import diopy
+    >>> cell_qc, gene_qc = diopy.stats(file='scdata.h5')
+    >>> gene_qc = diopy.stats(file='scdata.h5', key='data/rawX', axis=0, n_jobs=8)
+    -----
+    """
+    if axis not in [None, 0, 1]:
+        raise ValueError("axis should be None, 0 or 1, not %s" % axis)
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    with h5py.File(name=file, mode='r') as h5:
+        h5mat = h5[key]
+        n_obs, n_vars = int(h5mat['dims'][0]), int(h5mat['dims'][1])
+        # the column-major matrix is read by the genes, the sums of its rows are the sums of the genes
+        csc = h5_attr_str(h5mat.attrs.get('layout', 'csr')) == 'csc'
+        n_rows, n_cols = (n_vars, n_obs) if csc else (n_obs, n_vars)
+        obs_names = h5_to_str(h5['obs']['index']) if axis != 0 else None
+        var_key = 'rawX' if key == 'data/rawX' else 'X'
+        var_names = h5_to_str(h5['var'][var_key]['index']) if axis != 1 else None
+        sparse = h5_attr_str(h5mat.attrs['datatype']) == 'SparseMatrix'
+        indptr = h5mat['indptr'][()].astype(np.int64) if sparse else None
+        n_blocks = len(block_bounds(indptr=indptr, start=0, stop=n_rows, block_rows=block_rows, block_nnz=block_nnz)) - 1
+        if n_jobs > 1 and n_blocks > 1:
+            n_parts = min(n_jobs, n_blocks)
+            if sparse:
+                # the ranges of rows hold about the same number of the non-zeros
+                bounds = np.searchsorted(indptr, np.linspace(0, indptr[-1], n_parts + 1), side='left')
+                bounds[0], bounds[-1] = 0, n_rows
+                bounds = np.unique(bounds)
+            else:
+                bounds = np.unique(np.linspace(0, n_rows, n_parts + 1).astype(np.int64))
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                futures = [pool.submit(file_block_stats, h5.filename, key, int(b), int(e), n_cols, block_rows, block_nnz)
+                           for b, e in zip(bounds[:-1], bounds[1:])]
+                parts = [fu.result() for fu in futures]
+            res = {k: np.concatenate([p[k] for p in parts]) for k in ['row_sum', 'row_m2', 'row_nnz']}
+            res.update({k: np.sum([p[k] for p in parts], axis=0) for k in ['col_sum', 'col_nnz']})
+            res['col_n'], res['col_mean'], res['col_m2'] = parts[0]['col_n'], parts[0]['col_mean'], parts[0]['col_m2']
+            for p in parts[1:]:
+                res['col_n'], res['col_mean'], res['col_m2'] = merge_moments(res['col_n'], res['col_mean'], res['col_m2'],
+                                                                              p['col_n'], p['col_mean'], p['col_m2'])
+        else:
+            res = block_stats(h5mat=h5mat, start=0, stop=n_rows, n_cols=n_cols, block_rows=block_rows, block_nnz=block_nnz)
+    cell, gene = ('col_', 'row_') if csc else ('row_', 'col_')
+    cell_qc, gene_qc = None, None
+    if axis != 0:
+        cell_qc = pd.DataFrame({'total_counts': res[cell + 'sum'], 'n_genes': res[cell + 'nnz']}, index=pd.Index(obs_names, name='index'))
+    if axis != 1:
+        # the genes are the columns of the row-major matrix, whose moments are merged over the blocks, or the rows of the column-major matrix
+        mean = res['col_mean'] if gene == 'col_' else res['row_sum'] / max(n_obs, 1)
+        var = res[gene + 'm2'] / max(n_obs - 1, 1)
+        gene_qc = pd.DataFrame({'total_counts': res[gene + 'sum'], 'mean': mean, 'var': np.maximum(var, 0), 'n_cells': res[gene + 'nnz'],
+                                'frac_cells': res[gene + 'nnz'] / max(n_obs, 1)}, index=pd.Index(var_names, name='index'))
+    if axis == 1:
+        return cell_qc
+    if axis == 0:
+        return gene_qc
+    return cell_qc, gene_qc
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+The datasets extended by append_h5 are resizable with the chunks sized by the target bytes and the compression of the file, 
+even when they were written small and uncompressed by the first sample.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+h5py = pytest.importorskip('h5py')
+anndata = pytest.importorskip('anndata')
+pytest.importorskip('scanpy')
+from scipy import sparse
+
+from diopy.input import read_h5
+from diopy.output import write_h5, append_h5, concat_h5
+
+
+def sample(n_obs, seed, prefix):
+    X = sparse.random(n_obs, 50, density=0.2, format='csr', dtype=np.float32, random_state=seed)
+    obs = pd.DataFrame({'cl': pd.Categorical(np.array(['a', 'b', 'c'])[np.arange(n_obs) % 3])},
+                       index=['%s%d' % (prefix, i) for i in range(n_obs)])
+    var = pd.DataFrame(index=['gene%d' % i for i in range(50)])
+    return anndata.AnnData(X=X, obs=obs, var=var)
+
+
+def test_append_h5_chunks_and_compression(tmp_path):
+    file = str(tmp_path / 'atlas.h5')
+    first, second = sample(200, 0, 's1_'), sample(200, 1, 's2_')
+    write_h5(adata=first, file=file, compression='gzip')
+    with h5py.File(file, 'r') as h5:
+        assert h5['obs']['cl'].compression is None
+    append_h5(adata=second, file=file)
+    with h5py.File(file, 'r') as h5:
+        for dset in [h5['obs']['cl'], h5['obs']['index'], h5['data']['X']['indptr'], h5['data']['X']['values']]:
+            assert dset.maxshape[0] is None
+            assert dset.compression == 'gzip'
+            assert dset.chunks[0] > 401
+        assert h5['data']['X']['indptr'].shape == (401,)
+    adata = read_h5(file=file)
+    assert adata.shape == (400, 50)
+    assert (adata.X != sparse.vstack([first.X, second.X])).nnz == 0
+    assert list(adata.obs['cl']) == list(first.obs['cl']) + list(second.obs['cl'])
+
+
+def test_concat_h5_chunks_and_compression(tmp_path):
+    files = []
+    for i in range(3):
+        adata = sample(200, i, 's%d_' % i)
+        adata.obsm['X_pca'] = np.random.default_rng(i).random((200, 10)).astype(np.float32)
+        files.append(str(tmp_path / ('s%d.h5' % i)))
+        write_h5(adata=adata, file=files[-1])
+    out = str(tmp_path / 'atlas.h5')
+    concat_h5(files=files, out_file=out, batch_key='sample', compression='gzip')
+    with h5py.File(out, 'r') as h5:
+        for dset in [h5['dimR']['PCA'], h5['obs']['cl'], h5['obs']['sample'], h5['data']['X']['indptr']]:
+            assert dset.maxshape[0] is None
+            assert dset.compression == 'gzip'
+            assert dset.chunks[0] > 600
+        assert h5['dimR']['PCA'].shape == (600, 10)
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+The matrices read by read_h5(backed=True) stay in the h5 file as H5CSRMatrix, and their slices match the matrix in memory.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+h5py = pytest.importorskip('h5py')
+anndata = pytest.importorskip('anndata')
+pytest.importorskip('scanpy')
+from scipy import sparse
+
+from diopy.input import read_h5, close_h5, H5CSRMatrix
+from diopy.output import write_h5
+
+
+@pytest.fixture
+def adata():
+    X = sparse.random(60, 40, density=0.2, format='csr', dtype=np.float32, random_state=0)
+    obs = pd.DataFrame(index=['cell%d' % i for i in range(60)])
+    var = pd.DataFrame(index=['gene%d' % i for i in range(40)])
+    adata = anndata.AnnData(X=X, obs=obs, var=var)
+    adata.raw = adata
+    return adata
+
+
+def test_read_h5_backed_raw(tmp_path, adata):
+    write_h5(adata=adata, file=str(tmp_path / 'backed.h5'))
+    bk = read_h5(file=str(tmp_path / 'backed.h5'), backed=True)
+    try:
+        assert type(bk.X) is H5CSRMatrix
+        assert type(bk.raw.X) is H5CSRMatrix
+        assert (bk.raw.X.to_memory() != adata.raw.X).nnz == 0
+    finally:
+        close_h5(bk)
+    assert not bk.X.file.id.valid
+
+
+@pytest.mark.parametrize('key', [(0, 0), (5, slice(None)), (slice(None), 0), (slice(2, 9), 3), ([1, 2], 0), ([4, 1, 4], 7),
+                                 (slice(3, 20, 2), slice(1, 30)), ([7, 3], [0, 5]), (np.array([[2], [9]]), [1, 4, 6])])
+def test_h5csrmatrix_indexing(tmp_path, adata, key):
+    write_h5(adata=adata, file=str(tmp_path / 'backed.h5'))
+    expected = adata.X[key]
+    with h5py.File(tmp_path / 'backed.h5', 'r') as h5:
+        got = H5CSRMatrix(h5mat=h5['data/X'])[key]
+    if np.isscalar(expected):
+        assert got == expected
+    else:
+        # the fancy indexing of both rows and columns gives numpy.matrix
+        dense = lambda m: np.asarray(m.todense() if sparse.issparse(m) else m)
+        np.testing.assert_array_equal(dense(got), dense(expected))
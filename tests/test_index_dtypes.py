@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+The widths of 'indices' and 'indptr' on both sides of the 2^31 - 1 boundary. The matrices above the boundary are built from 
+the chunked datasets whose chunks are not written, so no 2^31-element array is allocated in memory or on the disk.
+"""
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip('h5py')
+pytest.importorskip('anndata')
+pytest.importorskip('scanpy')
+from scipy import sparse
+
+from diopy.input import sparse_index_dtype, h5_to_matrix, H5CSRMatrix
+from diopy.output import sparse_index_dtypes, matrix_to_h5
+
+INT32_MAX = np.iinfo(np.int32).max
+
+
+def test_sparse_index_dtypes_boundary():
+    assert sparse_index_dtypes(nnz=INT32_MAX, n_cols=30000) == (np.uint16, np.int32)
+    assert sparse_index_dtypes(nnz=INT32_MAX + 1, n_cols=30000) == (np.uint16, np.int64)
+    assert sparse_index_dtypes(nnz=10, n_cols=256)[0] == np.uint8
+    assert sparse_index_dtypes(nnz=10, n_cols=257)[0] == np.uint16
+    # the largest column position is n_cols - 1
+    assert sparse_index_dtypes(nnz=10, n_cols=INT32_MAX + 1)[0] == np.int32
+    assert sparse_index_dtypes(nnz=10, n_cols=INT32_MAX + 2)[0] == np.int64
+
+
+def test_sparse_index_dtype_boundary():
+    assert sparse_index_dtype(nnz=INT32_MAX, n_cols=30000) == np.int32
+    assert sparse_index_dtype(nnz=INT32_MAX + 1, n_cols=30000) == np.int64
+    assert sparse_index_dtype(nnz=10, n_cols=INT32_MAX) == np.int32
+    assert sparse_index_dtype(nnz=10, n_cols=INT32_MAX + 1) == np.int64
+
+
+@pytest.fixture
+def large_h5(tmp_path):
+    # 3 x 30000, the first row is empty, the second row holds 2^31 + 5 non-zeros left unwritten, the third row holds 2 non-zeros
+    nnz = INT32_MAX + 8
+    with h5py.File(tmp_path / 'large.h5', 'w') as h5:
+        h5mat = h5.create_group('X')
+        h5mat.create_dataset('values', shape=(nnz,), dtype=np.float32, chunks=(1024,))
+        h5mat.create_dataset('indices', shape=(nnz,), dtype=np.uint16, chunks=(1024,))
+        h5mat.create_dataset('indptr', data=np.array([0, 0, nnz - 2, nnz], dtype=np.int64))
+        h5mat.create_dataset('dims', data=np.array([3, 30000]))
+        h5mat.attrs['datatype'] = 'SparseMatrix'
+        h5mat['values'][nnz - 2:] = [1.5, 2.5]
+        h5mat['indices'][nnz - 2:] = [3, 29999]
+    return tmp_path / 'large.h5'
+
+
+def test_h5_to_matrix_above_boundary(large_h5):
+    with h5py.File(large_h5, 'r') as h5:
+        h5mat = h5['X']
+        assert sparse_index_dtype(nnz=h5mat['values'].shape[0], n_cols=30000) == np.int64
+        mat = h5_to_matrix(h5mat=h5mat, obs_indices=[0, 2])
+        assert mat.shape == (2, 30000)
+        np.testing.assert_array_equal(mat.indptr, [0, 0, 2])
+        np.testing.assert_array_equal(mat.indices, [3, 29999])
+        np.testing.assert_array_equal(mat.data, [1.5, 2.5])
+
+
+def test_h5csrmatrix_above_boundary(large_h5):
+    with h5py.File(large_h5, 'r') as h5:
+        mtx = h5_to_matrix(h5mat=h5['X'], backed=True)
+        assert isinstance(mtx, H5CSRMatrix)
+        assert mtx.shape == (3, 30000)
+        assert mtx.indptr.dtype == np.int64
+        assert mtx.indptr[-1] == INT32_MAX + 8
+        row = mtx.get_rows(np.array([2]))
+        np.testing.assert_array_equal(row.indices, [3, 29999])
+        np.testing.assert_array_equal(row.data, [1.5, 2.5])
+
+
+def test_matrix_to_h5_below_boundary(tmp_path):
+    mat = sparse.random(50, 200, density=0.1, format='csr', dtype=np.float32, random_state=0)
+    with h5py.File(tmp_path / 'small.h5', 'w') as h5:
+        matrix_to_h5(mat=mat, h5=h5, gr_name='X')
+        assert h5['X']['indices'].dtype == np.uint8
+        assert h5['X']['indptr'].dtype == np.int32
+        back = h5_to_matrix(h5mat=h5['X'])
+        assert back.indptr.dtype == np.int32
+        assert (back != mat).nnz == 0